@@ -1,16 +1,25 @@
 
 
 from collections import defaultdict
+import array
+import collections
 import random
 import argparse
+import itertools
 import codecs
 import os
+import sys
 import numpy
+import array_cache
+import instrument
+import worker_pool
 
 # Sequence - represents a sequence of hidden states and corresponding
 # output variables.
 
 class Sequence:
+    __slots__ = ("stateseq", "outputseq")
+
     def __init__(self, stateseq, outputseq):
         self.stateseq  = stateseq   # sequence of states
         self.outputseq = outputseq  # sequence of outputs
@@ -21,27 +30,1225 @@ class Sequence:
     def __len__(self):
         return len(self.outputseq)
 
+FORWARD_METHODS = ("prob", "scaled", "log")
+VITERBI_METHODS = ("prob", "log")
+
+# when the storage of a matrix is chosen automatically, it is kept sparse
+# if it has at least SPARSE_MIN_CELLS cells and at most SPARSE_DENSITY of
+# them are nonzero. Small matrices are faster dense whatever their density.
+SPARSE_DENSITY = 0.1
+SPARSE_MIN_CELLS = 1 << 16
+
+# DenseMatrix / SparseMatrix - the two storage forms of a probability
+# matrix M[i, j]. Both offer the operations the recurrences need, so
+# CompiledHMM works the same with either:
+#   left_multiply(x)        x @ M, for x of shape (R,) or (B, R)
+#   left_max(x, log)        max over i of x[i] + M[i, j] (log space) or
+#                           x[i] * M[i, j], and the arg max i
+#   column(o), log_column(o)          M[:, o] as an (R,) vector
+#   columns(obs), log_columns(obs)    M[:, obs[b]] for each b, as (B, R)
+
+class DenseMatrix:
+    def __init__(self, values):
+        self.values = values
+        self.shape = values.shape
+        self._log_values = None
+
+    @property
+    def log_values(self):
+        if self._log_values is None:
+            with numpy.errstate(divide='ignore'):
+                self._log_values = numpy.log(self.values)
+        return self._log_values
+
+    def nnz(self):
+        return int(numpy.count_nonzero(self.values))
+
+    def toarray(self):
+        return self.values
+
+    def nonzeros(self):
+        """returns (rows, cols, values) of the nonzero entries, row by row."""
+        rows, cols = numpy.nonzero(self.values)
+        return rows, cols, self.values[rows, cols]
+
+    def left_multiply(self, x):
+        return x @ self.values
+
+    def left_max(self, x, log=True):
+        if log:
+            candidates = x[..., :, None] + self.log_values
+        else:
+            candidates = x[..., :, None] * self.values
+        arg = candidates.argmax(axis=-2)
+        best = numpy.take_along_axis(candidates, arg[..., None, :], axis=-2)[..., 0, :]
+        return best, arg
+
+    def row_max(self, rows, x):
+        """log-space max restricted to some rows: for every column j that
+        rows reach, the max over r of x[r] + log M[rows[r], j]. Returns
+        (cols, best, arg), where arg indexes rows."""
+        candidates = x[:, None] + self.log_values[rows]
+        arg = candidates.argmax(axis=0)
+        best = candidates[arg, numpy.arange(self.shape[1])]
+        cols = numpy.flatnonzero(best > -numpy.inf)
+        return cols, best[cols], arg[cols]
+
+    def left_topk(self, x, k):
+        """the k best of x[r, i] + log M[i, j] over all (r, i), for every
+        column j; x is (k, R). Returns (best, arg), both (k, C) and sorted
+        best first, where arg is the flat index r * R + i."""
+        candidates = (x[:, :, None] + self.log_values).reshape(-1, self.shape[1])
+        if len(candidates) > k:
+            top = numpy.argpartition(-candidates, k - 1, axis=0)[:k]
+        else:
+            top = numpy.broadcast_to(numpy.arange(len(candidates))[:, None], candidates.shape).copy()
+        best = numpy.take_along_axis(candidates, top, axis=0)
+        order = numpy.argsort(-best, axis=0, kind='stable')
+        return numpy.take_along_axis(best, order, axis=0), numpy.take_along_axis(top, order, axis=0)
+
+    def log_entries(self, rows, col):
+        """returns log M[rows, col]."""
+        return self.log_values[rows, col]
+
+    def transpose(self):
+        return DenseMatrix(self.values.T)
+
+    def right_multiply(self, y):
+        """returns y @ M.T, i.e. M @ y for each row of y."""
+        return y @ self.values.T
+
+    def outer_counts(self, x, y):
+        """returns sum over b of x[b, i] * M[i, j] * y[b, j], shaped like
+        the stored values; x is (B, R) and y is (B, C)."""
+        return (x.T @ y) * self.values
+
+    def column_accumulate(self, counts, obs, weights):
+        """adds weights[b, i] to counts[i, obs[b]] for every b; counts is
+        shaped like the stored values."""
+        numpy.add.at(counts.T, obs, weights)
+
+    def normalized_rows(self, counts, pseudocount=0.0):
+        """returns a matrix of the same storage whose rows are counts (plus
+        pseudocount on every entry that is nonzero now) renormalized. Rows
+        with no counts keep their current values."""
+        counts = counts + pseudocount * (self.values > 0)
+        totals = counts.sum(axis=1, keepdims=True)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            return DenseMatrix(numpy.where(totals > 0, counts / totals, self.values))
+
+    def column(self, o):
+        return self.values[:, o]
+
+    def columns(self, obs):
+        return self.values[:, obs].T
+
+    def log_column(self, o):
+        return self.log_values[:, o]
+
+    def log_columns(self, obs):
+        return self.log_values[:, obs].T
+
+
+class SparseMatrix:
+    def __init__(self, shape, indptr, indices, values):
+        """compressed sparse column storage: the nonzeros of column j are
+        values[indptr[j]:indptr[j+1]], in rows indices[indptr[j]:indptr[j+1]]
+        (ascending). Grouping by column gives both the predecessors of each
+        state (transitions) and the states that emit each symbol (emissions)."""
+        self.shape = shape
+        self.indptr = indptr
+        self.indices = indices
+        self.values = values
+        self._counts = numpy.diff(indptr)
+        self._nonempty = numpy.flatnonzero(self._counts)
+        self._starts = indptr[:-1][self._nonempty]
+        self._cols = numpy.repeat(numpy.arange(shape[1]), self._counts)
+        self._log_values = None
+        self._transposed = None
+
+    @classmethod
+    def from_triplets(cls, shape, rows, cols, values):
+        order = numpy.lexsort((rows, cols))
+        indptr = numpy.zeros(shape[1] + 1, dtype=numpy.intp)
+        numpy.cumsum(numpy.bincount(cols, minlength=shape[1]), out=indptr[1:])
+        return cls(shape, indptr, rows[order].astype(numpy.intp), values[order].astype(float))
+
+    @property
+    def log_values(self):
+        if self._log_values is None:
+            with numpy.errstate(divide='ignore'):
+                self._log_values = numpy.log(self.values)
+        return self._log_values
+
+    def nnz(self):
+        return len(self.values)
+
+    def toarray(self):
+        dense = numpy.zeros(self.shape)
+        rows, cols, values = self.nonzeros()
+        dense[rows, cols] = values
+        return dense
+
+    def nonzeros(self):
+        """returns (rows, cols, values) of the stored entries, row by row."""
+        order = numpy.lexsort((self._cols, self.indices))
+        return self.indices[order], self._cols[order], self.values[order]
+
+    def left_multiply(self, x):
+        out = numpy.zeros(x.shape[:-1] + (self.shape[1],))
+        if len(self._starts):
+            out[..., self._nonempty] = numpy.add.reduceat(x[..., self.indices] * self.values,
+                                                          self._starts, axis=-1)
+        return out
+
+    def left_max(self, x, log=True):
+        if log:
+            candidates = x[..., self.indices] + self.log_values
+        else:
+            candidates = x[..., self.indices] * self.values
+        best = numpy.full(x.shape[:-1] + (self.shape[1],), -numpy.inf if log else 0.0)
+        arg = numpy.zeros(x.shape[:-1] + (self.shape[1],), dtype=numpy.intp)
+        if len(self._starts):
+            # max of each column's segment, then the first entry reaching it
+            # (rows are ascending, so ties go to the lowest row like argmax)
+            segment_best = numpy.maximum.reduceat(candidates, self._starts, axis=-1)
+            at_best = candidates == numpy.repeat(segment_best, self._counts[self._nonempty], axis=-1)
+            position = numpy.where(at_best, numpy.arange(len(self.indices)), len(self.indices))
+            first = numpy.minimum.reduceat(position, self._starts, axis=-1)
+            best[..., self._nonempty] = segment_best
+            arg[..., self._nonempty] = self.indices[first]
+        return best, arg
+
+    def row_max(self, rows, x):
+        """log-space max restricted to some rows: for every column j that
+        rows reach, the max over r of x[r] + log M[rows[r], j]. Returns
+        (cols, best, arg), where arg indexes rows. Only the stored entries
+        of those rows are visited."""
+        transposed = self.transpose()
+        which, positions = transposed._positions(rows)
+        cols = transposed.indices[positions]
+        scores = x[which] + transposed.log_values[positions]
+        # per column, the best score first (ties to the earliest row)
+        order = numpy.lexsort((which, -scores, cols))
+        first = numpy.ones(len(order), dtype=bool)
+        first[1:] = cols[order][1:] != cols[order][:-1]
+        keep = order[first]
+        keep = keep[scores[keep] > -numpy.inf]
+        return cols[keep], scores[keep], which[keep]
+
+    def left_topk(self, x, k):
+        """the k best of x[r, i] + log M[i, j] over all (r, i), for every
+        column j; x is (k, R). Returns (best, arg), both (k, C) and sorted
+        best first, where arg is the flat index r * R + i (-inf / 0 where a
+        column has fewer than k candidates)."""
+        candidates = (x[:, self.indices] + self.log_values).ravel()
+        cols = numpy.tile(self._cols, len(x))
+        flat = (numpy.arange(len(x))[:, None] * self.shape[0] + self.indices).ravel()
+        order = numpy.lexsort((-candidates, cols))
+        sorted_cols = cols[order]
+        rank = numpy.arange(len(order)) - numpy.searchsorted(sorted_cols, sorted_cols, side='left')
+        keep = rank < k
+        best = numpy.full((k, self.shape[1]), -numpy.inf)
+        arg = numpy.zeros((k, self.shape[1]), dtype=numpy.intp)
+        best[rank[keep], sorted_cols[keep]] = candidates[order][keep]
+        arg[rank[keep], sorted_cols[keep]] = flat[order][keep]
+        return best, arg
+
+    def log_entries(self, rows, col):
+        """returns log M[rows, col] for ascending rows, looking only at the
+        stored entries of column col."""
+        lo, hi = self.indptr[col], self.indptr[col + 1]
+        segment = self.indices[lo:hi]
+        at = numpy.searchsorted(segment, rows)
+        found = at < len(segment)
+        found[found] = segment[at[found]] == rows[found]
+        out = numpy.full(len(rows), -numpy.inf)
+        out[found] = self.log_values[lo + at[found]]
+        return out
+
+    def transpose(self):
+        if self._transposed is None:
+            rows, cols, values = self.nonzeros()
+            self._transposed = SparseMatrix.from_triplets((self.shape[1], self.shape[0]), cols, rows, values)
+        return self._transposed
+
+    def right_multiply(self, y):
+        """returns y @ M.T, i.e. M @ y for each row of y."""
+        return self.transpose().left_multiply(y)
+
+    def outer_counts(self, x, y):
+        """returns sum over b of x[b, i] * M[i, j] * y[b, j] for the stored
+        entries; x is (B, R) and y is (B, C)."""
+        return (x[:, self.indices] * y[:, self._cols]).sum(axis=0) * self.values
+
+    def _positions(self, obs):
+        """returns (b, position) pairs covering the stored entries of
+        column obs[b] for every b."""
+        counts = self._counts[obs]
+        rows = numpy.repeat(numpy.arange(len(obs)), counts)
+        offsets = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        return rows, numpy.repeat(self.indptr[obs], counts) + offsets
+
+    def column_accumulate(self, counts, obs, weights):
+        """adds weights[b, i] to the stored entry (i, obs[b]) for every b;
+        counts is shaped like the stored values."""
+        rows, positions = self._positions(numpy.asarray(obs))
+        counts += numpy.bincount(positions, weights=weights[rows, self.indices[positions]],
+                                 minlength=len(self.values))
+
+    def normalized_rows(self, counts, pseudocount=0.0):
+        """returns a matrix whose rows are counts (one per stored entry,
+        plus pseudocount each) renormalized. Rows with no counts keep their
+        current values. Entries that come out zero are dropped, as they are
+        from a DenseMatrix, so the matrix only shrinks over EM iterations."""
+        counts = counts + pseudocount
+        totals = numpy.bincount(self.indices, weights=counts, minlength=self.shape[0])[self.indices]
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            values = numpy.where(totals > 0, counts / totals, self.values)
+        kept = values > 0
+        return SparseMatrix.from_triplets(self.shape, self.indices[kept], self._cols[kept], values[kept])
+
+    def column(self, o):
+        out = numpy.zeros(self.shape[0])
+        lo, hi = self.indptr[o], self.indptr[o + 1]
+        out[self.indices[lo:hi]] = self.values[lo:hi]
+        return out
+
+    def columns(self, obs):
+        obs = numpy.asarray(obs)
+        out = numpy.zeros((len(obs), self.shape[0]))
+        rows, positions = self._positions(obs)
+        out[rows, self.indices[positions]] = self.values[positions]
+        return out
+
+    def log_column(self, o):
+        with numpy.errstate(divide='ignore'):
+            return numpy.log(self.column(o))
+
+    def log_columns(self, obs):
+        with numpy.errstate(divide='ignore'):
+            return numpy.log(self.columns(obs))
+
+
+def build_matrix(shape, rows, cols, values, sparse=None):
+    """builds a DenseMatrix or SparseMatrix from (row, col, value)
+    triplets. sparse=None decides from the size and density of the matrix."""
+    rows = numpy.asarray(rows, dtype=numpy.intp)
+    cols = numpy.asarray(cols, dtype=numpy.intp)
+    values = numpy.asarray(values, dtype=float)
+    nonzero = values != 0
+    if sparse is None:
+        cells = shape[0] * shape[1]
+        sparse = cells >= SPARSE_MIN_CELLS and nonzero.sum() <= SPARSE_DENSITY * cells
+    if sparse:
+        return SparseMatrix.from_triplets(shape, rows[nonzero], cols[nonzero], values[nonzero])
+    dense = numpy.zeros(shape)
+    dense[rows, cols] = values
+    return DenseMatrix(dense)
+
+
+# CompiledHMM - integer-indexed, array-backed form of an HMM.
+# States and output symbols are mapped to row/column numbers once, so that
+# forward and viterbi become matrix-vector recurrences instead of
+# string-keyed dict lookups.
+
+class CompiledHMM:
+    def __init__(self, states, symbols, start, trans, emit):
+        """states  - list of state names (row order)
+        symbols - list of output symbols (column order)
+        start   - start[i] = P(states[i] | #)
+        trans   - trans[i, j] = P(states[j] | states[i])
+        emit    - emit[i, o] = P(symbols[o] | states[i]), with one extra
+                  column at index len(symbols) for unseen symbols, all
+                  zero unless filled in by with_unknown.
+        trans and emit are DenseMatrix or SparseMatrix."""
+        self.states = states
+        self.symbols = symbols
+        self.state_index = dict(zip(states, range(len(states))))
+        self.symbol_index = dict(zip(symbols, range(len(symbols))))
+        self.start = start
+        self.trans = trans
+        self.emit = emit
+        self.unknown = None   # the with_unknown fallback in emit, if any
+        with numpy.errstate(divide='ignore'):
+            self.log_start = numpy.log(start)
+
+    @classmethod
+    def from_dicts(cls, transitions, emissions, sparse=None):
+        """builds the arrays from the dict-of-dicts tables kept by HMM.
+        States are numbered in the order of the transition table (without
+        '#'), which is the row order the dict-based forward/viterbi use.
+        sparse picks the matrix storage: True, False, or None to decide
+        per matrix from its density."""
+        states = [state for state in transitions if state != '#']
+        seen = set(states)
+        for table in (transitions, emissions):
+            for source, row in table.items():
+                for state in ([source] if table is emissions else row):
+                    if state != '#' and state not in seen:
+                        seen.add(state)
+                        states.append(state)
+        state_index = {state: i for i, state in enumerate(states)}
+
+        symbols = []
+        symbol_index = {}
+        for row in emissions.values():
+            for symbol in row:
+                if symbol not in symbol_index:
+                    symbol_index[symbol] = len(symbols)
+                    symbols.append(symbol)
+
+        n_states = len(states)
+        start = numpy.zeros(n_states)
+        if '#' in transitions:
+            for state, prob in transitions['#'].items():
+                if state != '#':
+                    start[state_index[state]] = float(prob)
+        elif n_states:
+            # no explicit start row - every state is equally likely
+            start[:] = 1.0 / n_states
+        rows, cols, values = [], [], []
+        for source, row in transitions.items():
+            if source == '#':
+                continue
+            for state, prob in row.items():
+                if state != '#':
+                    rows.append(state_index[source])
+                    cols.append(state_index[state])
+                    values.append(float(prob))
+        trans = build_matrix((n_states, n_states), rows, cols, values, sparse)
+        rows, cols, values = [], [], []
+        for state, row in emissions.items():
+            for symbol, prob in row.items():
+                rows.append(state_index[state])
+                cols.append(symbol_index[symbol])
+                values.append(float(prob))
+        emit = build_matrix((n_states, len(symbols) + 1), rows, cols, values, sparse)
+        return cls(states, symbols, start, trans, emit)
+
+    def with_unknown(self, unknown):
+        """returns a copy of the model whose emission column for unseen
+        symbols is filled in, so that an unseen symbol no longer makes
+        every path impossible. unknown is
+          None or "zero" - P(unseen | state) = 0, as without a fallback
+          a number p     - P(unseen | state) = p for every state, leaving
+                           the choice to the transitions
+          "good-turing"  - for each state, the probability it gives to its
+                           rarest symbols (those at its smallest nonzero
+                           emission probability). For a model counted from
+                           a corpus that is the share of the state's tokens
+                           that were words seen once: open classes like
+                           nouns get much more than determiners.
+          a dict         - P(unseen | state) by state name (0 if missing)
+        The column is a decoding aid: sampling, to_dicts and save ignore
+        it, and reestimated fills it in again by the same rule."""
+        n_states, width = self.emit.shape
+        rows, cols, values = self.emit.nonzeros()
+        known = cols < width - 1
+        rows, cols, values = rows[known], cols[known], values[known]
+        if unknown is None or unknown == "zero":
+            column = numpy.zeros(n_states)
+        elif unknown == "good-turing":
+            smallest = numpy.full(n_states, numpy.inf)
+            numpy.minimum.at(smallest, rows, values)
+            rare = values <= smallest[rows] * (1 + 1e-9)
+            column = numpy.bincount(rows[rare], values[rare], minlength=n_states)
+        elif isinstance(unknown, dict):
+            column = numpy.array([float(unknown.get(state, 0.0)) for state in self.states])
+        elif isinstance(unknown, (int, float)) and not isinstance(unknown, bool):
+            column = numpy.full(n_states, float(unknown))
+        else:
+            raise ValueError(f"unknown-symbol fallback must be None, 'zero', 'good-turing', "
+                             f"a probability or a dict, not {unknown!r}")
+        if not ((column >= 0) & (column <= 1)).all():
+            raise ValueError("unknown-symbol probabilities must be between 0 and 1")
+        filled = numpy.flatnonzero(column)
+        emit = build_matrix(self.emit.shape, numpy.concatenate((rows, filled)),
+                            numpy.concatenate((cols, numpy.full(len(filled), width - 1))),
+                            numpy.concatenate((values, column[filled])),
+                            sparse=isinstance(self.emit, SparseMatrix))
+        model = CompiledHMM(self.states, self.symbols, self.start, self.trans, emit)
+        model.unknown = None if unknown == "zero" else unknown
+        return model
+
+    def vocabulary(self):
+        """the symbols as a frozen Vocabulary (sharing symbol_index), which
+        maps every unseen symbol to the unseen-symbol column."""
+        return Vocabulary(self.symbols, frozen=True, index=self.symbol_index)
+
+    def state_vocabulary(self):
+        """the states as a frozen Vocabulary sharing state_index."""
+        return Vocabulary(self.states, frozen=True, index=self.state_index)
+
+    def sampler(self):
+        """returns the Sampler for this model, built on first use."""
+        if getattr(self, "_sampler", None) is None:
+            self._sampler = Sampler(self)
+        return self._sampler
+
+    def to_dicts(self):
+        """returns (transitions, emissions) as HMM keeps them, with every
+        nonzero probability written as the repr of its float."""
+        transitions = {'#': {}}
+        for i in numpy.flatnonzero(self.start):
+            transitions['#'][self.states[i]] = repr(float(self.start[i]))
+        emissions = {}
+        for matrix, table, names in ((self.trans, transitions, self.states),
+                                     (self.emit, emissions, self.symbols)):
+            rows, cols, values = matrix.nonzeros()
+            for i, j, value in zip(rows.tolist(), cols.tolist(), values.tolist()):
+                if j < len(names):   # not the unseen-symbol column
+                    table.setdefault(self.states[i], {})[names[j]] = repr(value)
+        return transitions, emissions
+
+    def encode(self, outputseq):
+        """maps a list of output symbols to column numbers. Symbols that
+        never appear in the emission table map to the all-zero column."""
+        unknown = len(self.symbols)
+        return numpy.array([self.symbol_index.get(symbol, unknown) for symbol in outputseq],
+                           dtype=numpy.intp)
+
+    def forward(self, obs, method="scaled"):
+        """runs the forward recurrence over encoded observations.
+        method is one of
+          "prob"   - raw probabilities, as in the textbook recurrence.
+                     Underflows to 0 after a few dozen low-probability steps.
+          "scaled" - alpha is renormalized at every step and the scale
+                     factors are accumulated in log space.
+          "log"    - the recurrence is carried out on log alpha with
+                     log-sum-exp.
+        returns (belief, log_likelihood): belief[i] = P(state_T = i | obs),
+        and log_likelihood = log P(obs). An impossible sequence gives an
+        all-zero belief and -inf."""
+        if method not in FORWARD_METHODS:
+            raise ValueError(f"unknown forward method {method!r}, expected one of {FORWARD_METHODS}")
+        if len(obs) == 0:
+            return self.start.copy(), 0.0
+        instrument.count("hmm.forward.cells", len(obs) * len(self.states))
+        with instrument.phase("hmm.forward.trellis"):
+            if method == "log":
+                return self._forward_log(obs)
+            return self._forward_scaled(obs, method)
+
+    def _forward_scaled(self, obs, method):
+        alpha = self.start * self.emit.column(obs[0])
+        log_likelihood = 0.0
+        for o in obs[1:]:
+            if method == "scaled":
+                scale = alpha.sum()
+                if scale <= 0:
+                    break
+                alpha = alpha / scale
+                log_likelihood += numpy.log(scale)
+            alpha = self.trans.left_multiply(alpha) * self.emit.column(o)
+        total = alpha.sum()
+        if total <= 0:
+            return numpy.zeros_like(alpha), -numpy.inf
+        return alpha / total, float(log_likelihood + numpy.log(total))
+
+    def _forward_log(self, obs):
+        log_alpha = self.log_start + self.emit.log_column(obs[0])
+        for o in obs[1:]:
+            top = log_alpha.max()
+            if top == -numpy.inf:
+                break
+            with numpy.errstate(divide='ignore'):
+                log_alpha = (numpy.log(self.trans.left_multiply(numpy.exp(log_alpha - top)))
+                             + top + self.emit.log_column(o))
+        top = log_alpha.max()
+        if top == -numpy.inf:
+            return numpy.zeros(len(self.states)), -numpy.inf
+        belief = numpy.exp(log_alpha - top)
+        total = belief.sum()
+        return belief / total, float(top + numpy.log(total))
+
+    def viterbi(self, obs, method="log", beam=None):
+        """runs the viterbi recurrence over encoded observations.
+        method is "log" (sums of log probabilities, stable on any length)
+        or "prob" (products of raw probabilities, which underflow on long
+        sequences). With beam, only the beam best states survive each step
+        (log method only); the result may then miss the true best path.
+        returns (best state path as row numbers, its log probability).
+        The path is empty when no state sequence can produce obs."""
+        if method not in VITERBI_METHODS:
+            raise ValueError(f"unknown viterbi method {method!r}, expected one of {VITERBI_METHODS}")
+        if beam is not None and beam < 1:
+            raise ValueError(f"beam must be at least 1, got {beam}")
+        if len(obs) == 0:
+            return [], 0.0
+        if beam is not None:
+            if method != "log":
+                raise ValueError("beam search runs in log space only")
+            return self._viterbi_beam(obs, beam)
+        instrument.count("hmm.viterbi.cells", len(obs) * len(self.states))
+        backpointers = numpy.zeros((len(obs), len(self.states)), dtype=numpy.int32)
+        with instrument.phase("hmm.viterbi.trellis"):
+            if method == "log":
+                delta = self.log_start + self.emit.log_column(obs[0])
+                for t in range(1, len(obs)):
+                    delta, backpointers[t] = self.trans.left_max(delta)
+                    delta = delta + self.emit.log_column(obs[t])
+                best = int(delta.argmax())
+                best_score = float(delta[best])
+            else:
+                delta = self.start * self.emit.column(obs[0])
+                for t in range(1, len(obs)):
+                    delta, backpointers[t] = self.trans.left_max(delta, log=False)
+                    delta = delta * self.emit.column(obs[t])
+                best = int(delta.argmax())
+                best_score = float(numpy.log(delta[best])) if delta[best] > 0 else -numpy.inf
+        if best_score == -numpy.inf:
+            return [], best_score
+        with instrument.phase("hmm.viterbi.backtrack"):
+            return self._backtrack(backpointers, best), best_score
+
+    def _viterbi_beam(self, obs, beam):
+        # active holds the surviving states in ascending order and scores
+        # their log deltas. Each step visits only the successors of active
+        # states, so its cost follows the beam, not the number of states.
+        delta = self.log_start + self.emit.log_column(obs[0])
+        active = numpy.flatnonzero(delta > -numpy.inf)
+        active, scores = self._prune(active, delta[active], beam)
+        history = []
+        for o in obs[1:]:
+            if not len(active):
+                return [], -numpy.inf
+            cols, best, arg = self.trans.row_max(active, scores)
+            best = best + self.emit.log_entries(cols, o)
+            alive = best > -numpy.inf
+            cols, best, previous = cols[alive], best[alive], active[arg[alive]]
+            keep = self._prune(numpy.arange(len(cols)), best, beam)[0]
+            active, scores = cols[keep], best[keep]
+            history.append((active, previous[keep]))
+        if instrument.enabled:
+            instrument.count("hmm.viterbi.cells", len(obs[:1]) * len(self.states)
+                             + sum(len(states) for states, _ in history))
+        if not len(active):
+            return [], -numpy.inf
+        best = int(scores.argmax())
+        state, score = int(active[best]), float(scores[best])
+        path = [state]
+        for states, previous in reversed(history):
+            state = int(previous[numpy.searchsorted(states, state)])
+            path.append(state)
+        return path[::-1], score
+
+    @staticmethod
+    def _prune(items, scores, beam):
+        """keeps the beam best-scoring items, in their original order."""
+        if len(items) <= beam:
+            return items, scores
+        keep = numpy.sort(numpy.argpartition(-scores, beam - 1)[:beam])
+        return items[keep], scores[keep]
+
+    def viterbi_kbest(self, obs, k):
+        """list viterbi: returns up to k [(path, log probability), ...] for
+        the k most probable distinct state paths, best first. Each step
+        keeps the k best partial paths into every state."""
+        if k < 1:
+            raise ValueError(f"k must be at least 1, got {k}")
+        if len(obs) == 0:
+            return [([], 0.0)]
+        n_states = len(self.states)
+        delta = numpy.full((k, n_states), -numpy.inf)
+        delta[0] = self.log_start + self.emit.log_column(obs[0])
+        backpointers = numpy.zeros((len(obs), k, n_states), dtype=numpy.intp)
+        for t in range(1, len(obs)):
+            delta, backpointers[t] = self.trans.left_topk(delta, k)
+            delta = delta + self.emit.log_column(obs[t])
+        flat = delta.ravel()
+        results = []
+        for index in numpy.argsort(-flat, kind='stable')[:k]:
+            if flat[index] == -numpy.inf:
+                break
+            rank, state = divmod(int(index), n_states)
+            path = [state]
+            for t in range(len(obs) - 1, 0, -1):
+                rank, state = divmod(int(backpointers[t, rank, state]), n_states)
+                path.append(state)
+            results.append((path[::-1], float(flat[index])))
+        return results
+
+    def _buckets(self, obs_list, batch_size):
+        """sorts the sequences by length and yields
+        (original indexes, lengths, padded observation matrix) for groups
+        of at most batch_size, so each group is padded only up to the
+        longest sequence in it. Padding uses the unseen-symbol column and
+        is masked out by the recurrences."""
+        order = sorted(range(len(obs_list)), key=lambda i: len(obs_list[i]))
+        for begin in range(0, len(order), batch_size):
+            indexes = order[begin:begin + batch_size]
+            lengths = numpy.array([len(obs_list[i]) for i in indexes], dtype=numpy.intp)
+            padded = numpy.full((len(indexes), max(int(lengths.max()), 1)), len(self.symbols),
+                                dtype=numpy.intp)
+            for row, i in enumerate(indexes):
+                padded[row, :lengths[row]] = obs_list[i]
+            yield indexes, lengths, padded
+
+    def forward_batch(self, obs_list, method="scaled", batch_size=256):
+        """runs forward over many encoded sequences at once, as (B, S)
+        matrix recurrences over each length bucket. method is "scaled" or
+        "log".
+        returns (beliefs, log_likelihoods): beliefs[n] is the final-state
+        belief of obs_list[n] and log_likelihoods[n] its log P(obs)."""
+        if method not in ("scaled", "log"):
+            raise ValueError(f"unknown batch forward method {method!r}, expected 'scaled' or 'log'")
+        beliefs = numpy.zeros((len(obs_list), len(self.states)))
+        log_likelihoods = numpy.zeros(len(obs_list))
+        for indexes, lengths, padded in self._buckets(obs_list, batch_size):
+            instrument.count("hmm.forward.cells", int(lengths.sum()) * len(self.states))
+            with instrument.phase("hmm.forward_batch.trellis"):
+                if method == "scaled":
+                    belief, log_likelihood = self._forward_batch_scaled(lengths, padded)
+                else:
+                    belief, log_likelihood = self._forward_batch_log(lengths, padded)
+            beliefs[indexes] = belief
+            log_likelihoods[indexes] = log_likelihood
+        return beliefs, log_likelihoods
+
+    def _forward_batch_scaled(self, lengths, padded):
+        alpha = self.start * self.emit.columns(padded[:, 0])
+        alpha[lengths == 0] = self.start
+        log_likelihood = numpy.zeros(len(lengths))
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            for t in range(padded.shape[1]):
+                active = t < lengths
+                if t > 0:
+                    stepped = self.trans.left_multiply(alpha) * self.emit.columns(padded[:, t])
+                    alpha = numpy.where(active[:, None], stepped, alpha)
+                scale = alpha.sum(axis=1)
+                log_likelihood[active] += numpy.log(scale[active])
+                alpha[active] /= numpy.where(scale[active] > 0, scale[active], 1.0)[:, None]
+        return alpha, log_likelihood
+
+    def _forward_batch_log(self, lengths, padded):
+        log_alpha = self.log_start + self.emit.log_columns(padded[:, 0])
+        log_alpha[lengths == 0] = self.log_start
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            for t in range(1, padded.shape[1]):
+                top = log_alpha.max(axis=1, keepdims=True)
+                top = numpy.where(numpy.isfinite(top), top, 0.0)
+                stepped = (numpy.log(self.trans.left_multiply(numpy.exp(log_alpha - top)))
+                           + top + self.emit.log_columns(padded[:, t]))
+                log_alpha = numpy.where((t < lengths)[:, None], stepped, log_alpha)
+            top = log_alpha.max(axis=1, keepdims=True)
+            alive = numpy.isfinite(top[:, 0])
+            belief = numpy.exp(log_alpha - numpy.where(alive[:, None], top, 0.0))
+            total = belief.sum(axis=1)
+            log_likelihood = numpy.where(alive, top[:, 0] + numpy.log(total), -numpy.inf)
+            belief = numpy.where(alive[:, None], belief / numpy.where(alive, total, 1.0)[:, None], 0.0)
+        return belief, log_likelihood
+
+    def viterbi_batch(self, obs_list, batch_size=256):
+        """runs log-space viterbi over many encoded sequences at once.
+        returns (paths, scores) in the order of obs_list, where paths[n]
+        is a list of row numbers (empty if obs_list[n] is impossible) and
+        scores[n] its log probability."""
+        paths = [None] * len(obs_list)
+        scores = numpy.zeros(len(obs_list))
+        for indexes, lengths, padded in self._buckets(obs_list, batch_size):
+            n_seqs, n_steps = padded.shape
+            instrument.count("hmm.viterbi.cells", int(lengths.sum()) * len(self.states))
+            rows = numpy.arange(n_seqs)
+            backpointers = numpy.zeros((n_seqs, n_steps, len(self.states)), dtype=numpy.int32)
+            with instrument.phase("hmm.viterbi_batch.trellis"):
+                delta = self.log_start + self.emit.log_columns(padded[:, 0])
+                for t in range(1, n_steps):
+                    stepped, backpointers[:, t] = self.trans.left_max(delta)
+                    stepped = stepped + self.emit.log_columns(padded[:, t])
+                    delta = numpy.where((t < lengths)[:, None], stepped, delta)
+
+            # walk every sequence back from its own last step at once
+            with instrument.phase("hmm.viterbi_batch.backtrack"):
+                best = delta.argmax(axis=1)
+                best_scores = delta[rows, best]
+                decoded = numpy.zeros((n_seqs, n_steps), dtype=numpy.intp)
+                current = best.copy()
+                for t in range(n_steps - 1, -1, -1):
+                    current = numpy.where(t == lengths - 1, best, current)
+                    decoded[:, t] = current
+                    current = numpy.where(t < lengths, backpointers[rows, t, current], current)
+            for row, i in enumerate(indexes):
+                alive = lengths[row] > 0 and best_scores[row] > -numpy.inf
+                paths[i] = decoded[row, :lengths[row]].tolist() if alive else []
+                scores[i] = best_scores[row] if lengths[row] > 0 else 0.0
+        return paths, scores
+
+    def _forward_backward(self, lengths, padded):
+        """scaled forward-backward over one padded bucket. Returns
+        (alpha, beta, scale, emitted, valid, alive), where for each step t
+          alpha[t], beta[t] - (B, S), with alpha[t] * beta[t] = P(state_t | obs)
+          scale[t]          - (B,) forward normalizers, 1 past a sequence's end
+          emitted[t]        - (B, S) emission probabilities of observation t
+          valid[t]          - (B,) whether t is inside each sequence
+        and alive marks the sequences the model can produce at all."""
+        n_seqs, n_steps = padded.shape
+        valid = numpy.arange(n_steps)[:, None] < lengths[None, :]
+        emitted = numpy.stack([self.emit.columns(padded[:, t]) for t in range(n_steps)])
+        alpha = numpy.zeros((n_steps, n_seqs, len(self.states)))
+        scale = numpy.ones((n_steps, n_seqs))
+        current = self.start * emitted[0]
+        for t in range(n_steps):
+            if t > 0:
+                current = self.trans.left_multiply(current) * emitted[t]
+            total = numpy.where(valid[t], current.sum(axis=1), 1.0)
+            current = current / numpy.where(total > 0, total, 1.0)[:, None]
+            alpha[t] = current
+            scale[t] = total
+        alive = (scale > 0).all(axis=0)
+        beta = numpy.ones_like(alpha)
+        for t in range(n_steps - 2, -1, -1):
+            stepped = self.trans.right_multiply(emitted[t + 1] * beta[t + 1])
+            stepped /= numpy.where(scale[t + 1] > 0, scale[t + 1], 1.0)[:, None]
+            beta[t] = numpy.where(valid[t + 1][:, None], stepped, 1.0)
+        return alpha, beta, scale, emitted, valid, alive
+
+    def posteriors_batch(self, obs_list, batch_size=256):
+        """forward-backward over many encoded sequences at once. Returns
+        (posteriors, log_likelihoods): posteriors[n] is a (len, S) array with
+        posteriors[n][t, i] = P(state_t = i | obs_list[n]), all zero for a
+        sequence the model cannot produce, and log_likelihoods[n] is
+        log P(obs_list[n])."""
+        posteriors = [None] * len(obs_list)
+        log_likelihoods = numpy.zeros(len(obs_list))
+        with numpy.errstate(divide='ignore'):
+            for indexes, lengths, padded in self._buckets(obs_list, batch_size):
+                alpha, beta, scale, _, valid, alive = self._forward_backward(lengths, padded)
+                gamma = alpha * beta
+                for row, i in enumerate(indexes):
+                    length = lengths[row]
+                    if alive[row]:
+                        posteriors[i] = gamma[:length, row]
+                        log_likelihoods[i] = numpy.log(scale[:length, row]).sum()
+                    else:
+                        posteriors[i] = numpy.zeros((length, len(self.states)))
+                        log_likelihoods[i] = -numpy.inf
+        return posteriors, log_likelihoods
+
+    def posteriors(self, obs):
+        """returns (posterior, log_likelihood) for one encoded sequence; see
+        posteriors_batch."""
+        posteriors, log_likelihoods = self.posteriors_batch([obs])
+        return posteriors[0], float(log_likelihoods[0])
+
+    def expected_counts(self, obs_list, batch_size=256):
+        """the E-step of Baum-Welch over encoded sequences. Returns
+        (start_counts, trans_counts, emit_counts, log_likelihood, n_impossible):
+        expected first states, transitions and emissions (the last two
+        shaped like trans.values / emit.values), the total log likelihood,
+        and how many sequences the model cannot produce (left out of the
+        counts)."""
+        n_states = len(self.states)
+        start_counts = numpy.zeros(n_states)
+        trans_counts = numpy.zeros_like(self.trans.values)
+        emit_counts = numpy.zeros_like(self.emit.values)
+        log_likelihood = 0.0
+        n_impossible = 0
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            for _, lengths, padded in self._buckets(obs_list, batch_size):
+                alpha, beta, scale, emitted, valid, alive = self._forward_backward(lengths, padded)
+                used = valid & alive[None, :]
+                gamma = alpha * beta * used[:, :, None]
+                start_counts += gamma[0].sum(axis=0)
+                self.emit.column_accumulate(emit_counts, padded.T.ravel(), gamma.reshape(-1, n_states))
+                if padded.shape[1] > 1:
+                    weights = emitted[1:] * beta[1:] / scale[1:, :, None] * used[1:, :, None]
+                    trans_counts += self.trans.outer_counts(alpha[:-1].reshape(-1, n_states),
+                                                            weights.reshape(-1, n_states))
+                log_likelihood += numpy.log(scale[used]).sum()
+                n_impossible += int((~alive & (lengths > 0)).sum())
+        return start_counts, trans_counts, emit_counts, float(log_likelihood), n_impossible
+
+    def reestimated(self, start_counts, trans_counts, emit_counts, pseudocount=0.0):
+        """the M-step of Baum-Welch: returns a new CompiledHMM whose rows are
+        the given expected counts renormalized. Only entries that are
+        nonzero now can become nonzero, so the model keeps its structure and
+        storage. pseudocount is added to each of those entries first. The
+        unseen-symbol column is not learned; a with_unknown fallback is
+        filled in again from the new emissions."""
+        start = start_counts + pseudocount * (self.start > 0)
+        start = start / start.sum() if start.sum() > 0 else self.start
+        emit = self.emit
+        if self.unknown is not None:
+            # renormalize the known columns only, with the last one emptied
+            if isinstance(emit, SparseMatrix):
+                known = emit.indptr[-2]
+                indptr = emit.indptr.copy()
+                indptr[-1] = known
+                emit = SparseMatrix(emit.shape, indptr, emit.indices[:known], emit.values[:known])
+                emit_counts = emit_counts[:known]
+            else:
+                emit = DenseMatrix(emit.values.copy())
+                emit.values[:, -1] = 0
+                emit_counts = emit_counts.copy()
+                emit_counts[:, -1] = 0
+        model = CompiledHMM(self.states, self.symbols, start,
+                            self.trans.normalized_rows(trans_counts, pseudocount),
+                            emit.normalized_rows(emit_counts, pseudocount))
+        return model.with_unknown(self.unknown) if self.unknown is not None else model
+
+    @staticmethod
+    def _backtrack(backpointers, best):
+        path = [best]
+        for t in range(len(backpointers) - 1, 0, -1):
+            best = int(backpointers[t, best])
+            path.append(best)
+        return path[::-1]
+
+
+# Sampler - draws state and output sequences from a CompiledHMM.
+# Each row distribution (start, transitions out of a state, emissions of a
+# state) is turned into a cumulative table once. The tables of all rows are
+# laid end to end with row r's cumulative values shifted up by r, so a
+# single searchsorted over r + u samples every sequence's next state (or
+# output) at once, whatever row each sequence is in.
+
+class Sampler:
+    def __init__(self, model):
+        self.model = model
+        self.start_cdf = numpy.cumsum(model.start / model.start.sum())
+        self.trans_table = self._table(model.trans)
+        self.emit_table = self._table(model.emit, len(model.symbols))
+
+    @staticmethod
+    def _table(matrix, n_cols=None):
+        """returns (keys, row_first, row_last, cols) for the rows of
+        matrix, over its first n_cols columns (all by default). A row with
+        no entries has row_first == row_last == -1."""
+        rows, cols, values = matrix.nonzeros()
+        if n_cols is not None:
+            kept = cols < n_cols
+            rows, cols, values = rows[kept], cols[kept], values[kept]
+        n_rows = matrix.shape[0]
+        counts = numpy.bincount(rows, minlength=n_rows)
+        ends = numpy.cumsum(counts)
+        firsts = ends - counts
+        totals = numpy.add.reduceat(values, firsts[counts > 0]) if len(values) else numpy.zeros(0)
+        row_totals = numpy.ones(n_rows)
+        row_totals[counts > 0] = totals
+        cumulative = numpy.cumsum(values / row_totals[rows])
+        # restart the running sum at each row, then shift row r up by r
+        offsets = numpy.zeros(n_rows)
+        offsets[counts > 0] = numpy.concatenate(([0.0], cumulative[ends[counts > 0][:-1] - 1]))
+        keys = cumulative - offsets[rows] + rows
+        empty = counts == 0
+        return keys, numpy.where(empty, -1, firsts), numpy.where(empty, -1, ends - 1), cols
+
+    @staticmethod
+    def _draw(table, current, u):
+        """draws a column of each row in current. An empty row keeps the
+        sample where it is, which for transitions is a self-loop."""
+        keys, firsts, lasts, cols = table
+        position = numpy.searchsorted(keys, current + u, side='right')
+        # rounding can leave a row's last key just under 1; stay in the row
+        position = numpy.clip(position, firsts[current], lasts[current])
+        return numpy.where(firsts[current] < 0, current, cols[position])
+
+    def sample(self, n_seqs, length, rng):
+        """returns (states, outputs): two (n_seqs, length) int32 arrays of
+        state rows and symbol columns, drawn with the numpy Generator rng."""
+        states = numpy.empty((n_seqs, length), dtype=numpy.int32)
+        outputs = numpy.empty((n_seqs, length), dtype=numpy.int32)
+        if length == 0:
+            return states, outputs
+        current = numpy.minimum(numpy.searchsorted(self.start_cdf, rng.random(n_seqs), side='right'),
+                                len(self.start_cdf) - 1)
+        for t in range(length):
+            if t > 0:
+                current = self._draw(self.trans_table, current, rng.random(n_seqs))
+            states[:, t] = current
+            outputs[:, t] = self._emit(current, rng.random(n_seqs))
+        return states, outputs
+
+    def _emit(self, current, u):
+        """draws a symbol for each state in current. A state with no
+        emissions has none to give."""
+        silent = self.emit_table[1][current] < 0
+        if silent.any():
+            state = self.model.states[int(current[silent.argmax()])]
+            raise ValueError(f"state {state!r} has no emissions to sample")
+        return self._draw(self.emit_table, current, u)
+
+    def stream(self, n_seqs, length, seed=None, chunk_size=4096):
+        """yields (states, outputs) array pairs of at most chunk_size
+        sequences until n_seqs have been drawn. The same seed and
+        chunk_size always give the same sequences."""
+        rng = numpy.random.default_rng(seed)
+        for begin in range(0, n_seqs, chunk_size):
+            yield self.sample(min(chunk_size, n_seqs - begin), length, rng)
+
+
+# Compiled model cache. basename.hmmc holds the CompiledHMM of
+# basename.trans/basename.emit so that load can skip parsing the text
+# files. It is an array_cache container stamped with both source files.
+
+CACHE_SUFFIX = ".hmmc"
+CACHE_MAGIC = b"HMMCACHE\x01"
+
+
+def _source_paths(basename):
+    return {"trans": basename + ".trans", "emit": basename + ".emit"}
+
+
+def _matrix_arrays(prefix, matrix):
+    if isinstance(matrix, SparseMatrix):
+        return {prefix + ".indptr": matrix.indptr, prefix + ".indices": matrix.indices,
+                prefix + ".values": matrix.values}
+    return {prefix + ".values": matrix.values}
+
+
+def _matrix_from_arrays(prefix, kind, shape, arrays):
+    if kind == "sparse":
+        return SparseMatrix(tuple(shape), arrays[prefix + ".indptr"], arrays[prefix + ".indices"],
+                            arrays[prefix + ".values"])
+    return DenseMatrix(arrays[prefix + ".values"])
+
+
+def write_cache(model, basename):
+    """writes model to basename.hmmc, stamped with the current state of
+    basename.trans and basename.emit. Returns False if the cache could
+    not be written."""
+    arrays = {
+        "states": numpy.frombuffer("\n".join(model.states).encode(), dtype=numpy.uint8),
+        "symbols": numpy.frombuffer("\n".join(model.symbols).encode(), dtype=numpy.uint8),
+        "start": model.start,
+    }
+    arrays.update(_matrix_arrays("trans", model.trans))
+    arrays.update(_matrix_arrays("emit", model.emit))
+    matrices = {
+        "trans": ["sparse" if isinstance(model.trans, SparseMatrix) else "dense", list(model.trans.shape)],
+        "emit": ["sparse" if isinstance(model.emit, SparseMatrix) else "dense", list(model.emit.shape)],
+    }
+    return array_cache.write(basename + CACHE_SUFFIX, CACHE_MAGIC, arrays, _source_paths(basename),
+                             {"matrices": matrices})
+
+
+def read_cache(basename, sparse=None):
+    """returns the CompiledHMM cached in basename.hmmc, or None if there is
+    no cache, it is unreadable, or either source file has changed since it
+    was written. With sparse=True/False a cache in the other storage
+    counts as a miss."""
+    cached = array_cache.read(basename + CACHE_SUFFIX, CACHE_MAGIC, _source_paths(basename))
+    if cached is None:
+        return None
+    header, arrays = cached
+    try:
+        kinds = {name: kind for name, (kind, shape) in header["matrices"].items()}
+    except (KeyError, TypeError, ValueError):
+        return None
+    if sparse is not None and any((kind == "sparse") != sparse for kind in kinds.values()):
+        return None
+
+    matrices = {name: _matrix_from_arrays(name, kind, shape, arrays)
+                for name, (kind, shape) in header["matrices"].items()}
+    states = bytes(arrays["states"]).decode().split("\n") if len(arrays["states"]) else []
+    symbols = bytes(arrays["symbols"]).decode().split("\n") if len(arrays["symbols"]) else []
+    return CompiledHMM(states, symbols, arrays["start"], matrices["trans"], matrices["emit"])
+
+
+# ForwardFilter - the forward algorithm run one observation at a time.
+# Only the current belief over states is kept, so each update is one
+# S x S matrix-vector product and memory does not grow with the stream.
+
+class ForwardFilter:
+    def __init__(self, model):
+        """model is a CompiledHMM."""
+        self.model = model
+        self.reset()
+
+    def reset(self):
+        self.belief = None         # P(current state | observations so far)
+        self.log_likelihood = 0.0  # log P(observations so far)
+        self.steps = 0
+
+    def update(self, symbol):
+        """folds in one observation and returns the new belief.
+        An observation no state can emit is skipped: the belief becomes the
+        one-step prediction and log_likelihood drops to -inf. Raises
+        ValueError, leaving the filter as it was, if the model has no
+        transition out of any state the belief is on."""
+        model = self.model
+        o = model.symbol_index.get(symbol, len(model.symbols))
+        prior = model.start if self.belief is None else model.trans.left_multiply(self.belief)
+        if not prior.sum() > 0:
+            raise ValueError(f"no transitions out of state {self.state()!r}; reset() to start over")
+        belief = prior * model.emit.column(o)
+        total = belief.sum()
+        if total > 0:
+            self.belief = belief / total
+            self.log_likelihood += numpy.log(total)
+        else:
+            self.belief = prior / prior.sum()
+            self.log_likelihood = -numpy.inf
+        self.steps += 1
+        return self.belief
+
+    def state(self):
+        """returns the most likely current state."""
+        return self.model.states[int(self.belief.argmax())]
+
+    def run(self, symbols):
+        """yields the most likely current state after each of symbols."""
+        for symbol in symbols:
+            self.update(symbol)
+            yield self.state()
+
+
+# FixedLagViterbi - online viterbi that commits to the state at time t - lag
+# once observation t arrives, by backtracking from the current best state.
+# Only the last lag rows of backpointers are kept.
+
+class FixedLagViterbi:
+    def __init__(self, model, lag):
+        """model is a CompiledHMM; lag is how many observations a decision
+        waits for (0 gives the filtered argmax)."""
+        self.model = model
+        self.lag = lag
+        self.reset()
+
+    def reset(self):
+        self.delta = None
+        self.backpointers = collections.deque(maxlen=self.lag if self.lag > 0 else None)
+        self.steps = 0
+
+    def update(self, symbol):
+        """folds in one observation. Returns (t, state) for the time step
+        t = steps - 1 - lag that is now decided, or None while fewer than
+        lag + 1 observations have arrived. Raises ValueError, leaving the
+        decoder as it was, if the model has no transition out of any
+        state still possible."""
+        model = self.model
+        o = model.symbol_index.get(symbol, len(model.symbols))
+        if self.delta is None:
+            prior = model.log_start
+        else:
+            prior, backpointer = model.trans.left_max(self.delta)
+            if prior.max() == -numpy.inf:
+                state = model.states[int(self.delta.argmax())]
+                raise ValueError(f"no transitions out of state {state!r}; reset() to start over")
+            if self.lag > 0:
+                self.backpointers.append(backpointer)
+        delta = prior + model.emit.log_column(o)
+        top = delta.max()
+        if top == -numpy.inf:
+            # no state emits this symbol - keep the prediction instead
+            delta, top = prior, prior.max()
+        # shift so the best score is 0; this keeps precision on endless
+        # streams and does not change any comparison
+        self.delta = delta - top
+        self.steps += 1
+        if self.steps <= self.lag:
+            return None
+        best = int(self.delta.argmax())
+        for backpointer in reversed(self.backpointers):
+            best = int(backpointer[best])
+        return self.steps - 1 - self.lag, model.states[best]
+
+    def flush(self):
+        """returns [(t, state), ...] for the time steps still waiting on
+        their lag, from the best path ending at the last observation."""
+        if self.delta is None:
+            return []
+        best = int(self.delta.argmax())
+        path = [best]
+        for backpointer in reversed(self.backpointers):
+            best = int(backpointer[best])
+            path.append(best)
+        path = path[::-1]
+        pending = min(self.lag, self.steps)
+        first = self.steps - pending
+        return [(first + i, self.model.states[s]) for i, s in enumerate(path[-pending:])] if pending else []
+
+    def run(self, symbols):
+        """yields (t, state) decisions for a stream of symbols, in order,
+        including the final flush."""
+        for symbol in symbols:
+            decided = self.update(symbol)
+            if decided is not None:
+                yield decided
+        yield from self.flush()
+
+
 # HMM model
 class HMM:
-    def __init__(self, transitions={}, emissions={}):
+    def __init__(self, transitions=None, emissions=None, unknown=None):
         """creates a model from transition and emission probabilities
         e.g. {'happy': {'silent': '0.2', 'meow': '0.3', 'purr': '0.5'},
               'grumpy': {'silent': '0.5', 'meow': '0.4', 'purr': '0.1'},
-              'hungry': {'silent': '0.2', 'meow': '0.6', 'purr': '0.2'}}"""
+              'hungry': {'silent': '0.2', 'meow': '0.6', 'purr': '0.2'}}
+        unknown is the emission fallback for symbols not in the table
+        (see CompiledHMM.with_unknown); by default they are impossible."""
+
+        # fresh dicts per instance - a shared {} default would leak one
+        # model's tables into every other HMM() that calls load.
+        self.transitions = transitions if transitions is not None else {}
+        self.emissions = emissions if emissions is not None else {}
+        self.unknown = unknown
+        self.model = None
+
+    # when load is served from the binary cache, the dict tables are only
+    # rebuilt from the compiled model if something asks for them.
+    @property
+    def transitions(self):
+        if self._transitions is None:
+            self._transitions, self._emissions = self.model.to_dicts()
+        return self._transitions
+
+    @transitions.setter
+    def transitions(self, value):
+        self._transitions = value
 
+    @property
+    def emissions(self):
+        if self._emissions is None:
+            self._transitions, self._emissions = self.model.to_dicts()
+        return self._emissions
 
+    @emissions.setter
+    def emissions(self, value):
+        self._emissions = value
 
-        self.transitions = transitions
-        self.emissions = emissions
+    def compile(self, sparse=None):
+        """builds the array-backed CompiledHMM from the current
+        transition and emission dicts and keeps it in self.model.
+        sparse forces sparse (True) or dense (False) matrices; None picks
+        per matrix from its size and density."""
+        model = CompiledHMM.from_dicts(self.transitions, self.emissions, sparse)
+        self.model = model.with_unknown(self.unknown) if self.unknown is not None else model
+        return self.model
+
+    def compiled(self):
+        """returns the compiled model, building it on first use."""
+        if self.model is None:
+            self.compile()
+        return self.model
 
     ## part 1 - you do this.
-    def load(self, basename):
+    @instrument.timed("hmm.load")
+    def load(self, basename, sparse=None, cache=False, unknown=None):
         """reads HMM structure from transition (basename.trans),
         and emission (basename.emit) files,
-        as well as the probabilities."""
+        as well as the probabilities.
+        sparse is passed on to compile. With cache, the compiled model is
+        read from basename.hmmc when that is up to date with both files,
+        and written there after parsing when it is not. A model loaded from
+        the cache rebuilds transitions/emissions only on first access, with
+        the probabilities written as float reprs. unknown, if given,
+        replaces the model's fallback for unseen symbols."""
+        if unknown is not None:
+            self.unknown = unknown
+        if cache:
+            with instrument.phase("hmm.load.cache"):
+                model = read_cache(basename, sparse)
+            instrument.count("hmm.load.cache_miss" if model is None else "hmm.load.cache_hit")
+            if model is not None:
+                self.model = model.with_unknown(self.unknown) if self.unknown is not None else model
+                self._transitions = self._emissions = None
+                return
         basename_emissions = basename + ".emit"
         basename_transition = basename + ".trans"
-        with open(basename_emissions, 'r') as f_emit:
+        with instrument.phase("hmm.load.parse_emit"), open(basename_emissions, 'r') as f_emit:
             for line in f_emit:
                 line = line.strip()
                 if not line:
@@ -54,7 +1261,7 @@ class HMM:
                     self.emissions[state] = {}
                 self.emissions[state][observation] = probability
 
-        with open(basename_transition, 'r') as f_transition:
+        with instrument.phase("hmm.load.parse_trans"), open(basename_transition, 'r') as f_transition:
             for line in f_transition:
                 line = line.strip()
                 if not line:
@@ -65,8 +1272,132 @@ class HMM:
                 if from_state not in self.transitions:
                     self.transitions[from_state] = {}
                 self.transitions[from_state][to_state] = probability
-        
+        with instrument.phase("hmm.load.compile"):
+            self.compile(sparse)
+        if cache:
+            # the cache holds the model as the files give it
+            with instrument.phase("hmm.load.write_cache"):
+                write_cache(self.model if self.unknown is None else self.model.with_unknown(None), basename)
+
+    def save(self, basename):
+        """writes the model to basename.trans and basename.emit in the
+        format load reads: one "from to probability" line per entry."""
+        for path, table in ((basename + ".trans", self.transitions), (basename + ".emit", self.emissions)):
+            with open(path, 'w') as f:
+                for source, row in table.items():
+                    for target, probability in row.items():
+                        f.write(f"{source} {target} {probability}\n")
+
+    @instrument.timed("hmm.generate")
     def generate(self, n):
+        """returns (Sequence, observations) for one random sequence of
+        length n. The draw is seeded from the random module, so
+        random.seed still makes it repeatable."""
+        model = self.compiled()
+        rng = numpy.random.default_rng(random.getrandbits(64))
+        states, outputs = model.sampler().sample(1, n, rng)
+        instrument.count("hmm.generate.tokens", n)
+        observations = [model.symbols[o] for o in outputs[0]]
+        sequence = Sequence([model.states[i] for i in states[0]], observations)
+        return sequence, observations
+
+    @instrument.timed("hmm.generate")
+    def generate_many(self, n_seqs, length, seed=None):
+        """returns n_seqs random Sequences of the given length, all drawn
+        together. seed is anything numpy.random.default_rng accepts."""
+        model = self.compiled()
+        states, outputs = model.sampler().sample(n_seqs, length, numpy.random.default_rng(seed))
+        instrument.count("hmm.generate.tokens", n_seqs * length)
+        state_names = numpy.array(model.states, dtype=object)
+        symbol_names = numpy.array(model.symbols, dtype=object)
+        return [Sequence(list(state_names[row_states]), list(symbol_names[row_outputs]))
+                for row_states, row_outputs in zip(states, outputs)]
+
+    def generate_stream(self, n_seqs, length, seed=None, chunk_size=4096):
+        """yields (states, outputs) int32 array chunks of at most chunk_size
+        sequences, for writing corpora too large to hold at once. Rows are
+        model.states / model.symbols indexes."""
+        return self.compiled().sampler().stream(n_seqs, length, seed, chunk_size)
+
+    def forward(self, sequence, method="scaled", return_loglik=False):
+        """returns the most likely final state for sequence.outputseq,
+        using the compiled matrices. method picks the numeric scheme
+        ("prob", "scaled" or "log", see CompiledHMM.forward). With
+        return_loglik, returns (state, log P(outputseq)) from the same pass."""
+        model = self.compiled()
+        with instrument.phase("hmm.encode"):
+            obs = model.encode(sequence.outputseq)
+        belief, log_likelihood = model.forward(obs, method)
+        state = model.states[int(belief.argmax())]
+        return (state, log_likelihood) if return_loglik else state
+
+    def log_likelihood(self, sequence, method="scaled"):
+        """returns log P(sequence.outputseq) under the model."""
+        model = self.compiled()
+        return model.forward(model.encode(sequence.outputseq), method)[1]
+
+    def viterbi(self, sequence, method="log", return_score=False, beam=None):
+        """returns the most likely state sequence for sequence.outputseq,
+        using the compiled matrices. method is "log" or "prob". beam keeps
+        only that many states alive per step. With return_score, returns
+        (states, log probability of that path)."""
+        model = self.compiled()
+        with instrument.phase("hmm.encode"):
+            obs = model.encode(sequence.outputseq)
+        path, score = model.viterbi(obs, method, beam)
+        states = [model.states[i] for i in path]
+        return (states, score) if return_score else states
+
+    def viterbi_kbest(self, sequence, k):
+        """returns the k most likely state sequences for sequence.outputseq
+        as [(states, log probability), ...], best first."""
+        model = self.compiled()
+        return [([model.states[i] for i in path], score)
+                for path, score in model.viterbi_kbest(model.encode(sequence.outputseq), k)]
+
+    def forward_batch(self, sequences, method="scaled", batch_size=256, return_loglik=False):
+        """forward over a list of Sequences, decoded together in padded
+        length buckets. Returns the most likely final state of each, or
+        (states, log likelihoods) with return_loglik."""
+        model = self.compiled()
+        with instrument.phase("hmm.encode"):
+            obs_list = [model.encode(sequence.outputseq) for sequence in sequences]
+        beliefs, log_likelihoods = model.forward_batch(obs_list, method, batch_size)
+        states = [model.states[i] for i in beliefs.argmax(axis=1)]
+        return (states, log_likelihoods.tolist()) if return_loglik else states
+
+    def viterbi_batch(self, sequences, batch_size=256, return_score=False):
+        """log-space viterbi over a list of Sequences, decoded together in
+        padded length buckets. Returns the state sequence of each, or
+        (state sequences, log scores) with return_score."""
+        model = self.compiled()
+        with instrument.phase("hmm.encode"):
+            obs_list = [model.encode(sequence.outputseq) for sequence in sequences]
+        paths, scores = model.viterbi_batch(obs_list, batch_size)
+        states = [[model.states[i] for i in path] for path in paths]
+        return (states, scores.tolist()) if return_score else states
+
+    def posteriors(self, sequence, return_loglik=False):
+        """returns a (len(sequence), S) array of per-step state posteriors
+        P(state_t | outputseq), from one forward-backward pass. Columns
+        follow self.compiled().states. With return_loglik, returns
+        (posteriors, log P(outputseq))."""
+        model = self.compiled()
+        posterior, log_likelihood = model.posteriors(model.encode(sequence.outputseq))
+        return (posterior, log_likelihood) if return_loglik else posterior
+
+    def posteriors_batch(self, sequences, batch_size=256):
+        """per-step state posteriors for a list of Sequences, computed
+        together in padded length buckets; a list of (len, S) arrays."""
+        model = self.compiled()
+        return model.posteriors_batch([model.encode(sequence.outputseq) for sequence in sequences],
+                                      batch_size)[0]
+
+    ## dict-based versions of generate, forward and viterbi. These are the
+    ## original loop implementations, kept as the reference the compiled
+    ## ones are checked against.
+    def generate_reference(self, n):
+        """the original dict-based generate, one random.choices call per draw."""
         # start in a random initial state that is "transitionable" from #.
         next_states = list(self.transitions['#'].keys())    
         if "#" in next_states:
@@ -108,9 +1439,8 @@ class HMM:
 
         sequence = Sequence(final_states, observations)
         return sequence, observations
-        
 
-    def forward(self, sequence):
+    def forward_reference(self, sequence):
         observation_cols = sequence.outputseq  # cols - observations (meow, purr, silent)
         state_rows = list(self.transitions.keys()) # rows - states (happy, grumpy, hungry)
 
@@ -142,7 +1472,7 @@ class HMM:
         return state_rows[max_index]
     
 
-    def viterbi(self, sequence):
+    def viterbi_reference(self, sequence):
         observation_cols = sequence.outputseq  # cols - observations (meow, purr, silent)
         state_rows = list(self.transitions.keys()) # rows - states (happy, grumpy, hungry)
 
@@ -194,37 +1524,378 @@ class HMM:
 
 
 
+def read_sequences(path):
+    """yields a Sequence (with no states) for every non-blank line of an
+    .obs file, without reading the whole file into memory."""
+    with open(path, 'r') as f:
+        for line in f:
+            outputs = line.split()
+            if outputs:
+                yield Sequence([], outputs)
+
+
+def read_tagged_tokens(path):
+    """yields (states, outputs) token lists for every (states line,
+    outputs line) pair of a .tagged.obs file. Blank lines are skipped."""
+    with open(path, 'r') as f:
+        pending = None
+        for line in f:
+            tokens = line.split()
+            if not tokens:
+                continue
+            if pending is None:
+                pending = tokens
+            else:
+                if len(pending) != len(tokens):
+                    raise ValueError(f"{path}: {len(pending)} states for {len(tokens)} outputs: {' '.join(tokens)}")
+                yield pending, tokens
+                pending = None
+        if pending is not None:
+            raise ValueError(f"{path}: states line without an outputs line at the end of the file")
+
+
+# Vocabulary - names interned to consecutive ids. A frozen vocabulary
+# (such as CompiledHMM.vocabulary()) maps every name it does not know to
+# the one id len(names), which is the model's unseen-symbol column; an
+# open one gives each new name the next id.
+
+class Vocabulary:
+    __slots__ = ("names", "index", "frozen")
+
+    def __init__(self, names=(), frozen=False, index=None):
+        """index, if given, is the name -> id dict for names, shared
+        rather than rebuilt."""
+        self.names = names if index is not None else [sys.intern(name) for name in names]
+        self.index = index if index is not None else {name: i for i, name in enumerate(self.names)}
+        self.frozen = frozen
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def unknown(self):
+        """the id of names a frozen vocabulary does not know."""
+        return len(self.names)
+
+    def intern(self, name):
+        i = self.index.get(name)
+        if i is None:
+            if self.frozen:
+                return len(self.names)
+            i = self.index[name] = len(self.names)
+            self.names.append(sys.intern(name))
+        return i
+
+    def encode(self, tokens, out=None):
+        """appends the ids of tokens to out, an array('i') (a new one by
+        default), and returns it."""
+        if out is None:
+            out = array.array('i')
+        if self.frozen:
+            get, unknown = self.index.get, len(self.names)
+            out.extend(get(token, unknown) for token in tokens)
+        else:
+            out.extend(map(self.intern, tokens))
+        return out
+
+    def decode(self, ids):
+        """the names of ids; the unknown id gives None."""
+        names = self.names
+        return [names[i] if i < len(names) else None for i in ids]
+
+
+# EncodedSequence - a Sequence as arrays of state and symbol ids, 4 bytes
+# a token instead of a pointer to a str object. Either array may be a
+# memoryview into an EncodedCorpus; states is empty for untagged lines.
+
+class EncodedSequence:
+    __slots__ = ("states", "outputs")
+
+    def __init__(self, states, outputs):
+        self.states = states
+        self.outputs = outputs
+
+    def __len__(self):
+        return len(self.outputs)
+
+    def observations(self):
+        """the symbol ids as a numpy array sharing the buffer, ready for
+        the CompiledHMM methods."""
+        return numpy.frombuffer(self.outputs, dtype=numpy.intc)
+
+    def decoded(self, states, symbols):
+        """the Sequence, given the state and symbol Vocabularies. Unseen
+        symbols come back as None."""
+        return Sequence(states.decode(self.states), symbols.decode(self.outputs))
+
+
+def read_encoded(path, symbols, states=None):
+    """yields an EncodedSequence for every line of an .obs file, or, with
+    a state Vocabulary, for every line pair of a .tagged.obs file. Tokens
+    go straight from each line into the id arrays through the
+    Vocabularies (frozen ones, such as a model's, map unseen names to
+    their unknown id; open ones grow)."""
+    if states is None:
+        with open(path, 'r') as f:
+            for line in f:
+                outputs = symbols.encode(line.split())
+                if outputs:
+                    yield EncodedSequence(array.array('i'), outputs)
+        return
+    for state_tokens, output_tokens in read_tagged_tokens(path):
+        yield EncodedSequence(states.encode(state_tokens), symbols.encode(output_tokens))
+
+
+# EncodedCorpus - many EncodedSequences packed end to end in three flat
+# arrays, so a corpus costs a few bytes per token and no Python object
+# per sequence. Indexing gives EncodedSequences over memoryviews, and
+# the arrays cannot grow while any such view is alive, so append first.
+# A corpus is either all tagged or all untagged.
+
+class EncodedCorpus:
+    __slots__ = ("states", "outputs", "offsets")
+
+    def __init__(self):
+        self.states = array.array('i')
+        self.outputs = array.array('i')
+        self.offsets = array.array('q', [0])   # sequence i is outputs[offsets[i]:offsets[i + 1]]
+
+    @classmethod
+    def read(cls, path, symbols, states=None):
+        """packs read_encoded(path, symbols, states) into a corpus."""
+        corpus = cls()
+        for sequence in read_encoded(path, symbols, states):
+            corpus.append(sequence)
+        return corpus
+
+    def append(self, sequence):
+        tagged = len(sequence.states) > 0
+        if tagged and len(sequence.states) != len(sequence.outputs):
+            raise ValueError(f"{len(sequence.states)} states for {len(sequence.outputs)} outputs")
+        if len(self.states) != (len(self.outputs) if tagged else 0):
+            raise ValueError("a corpus cannot mix tagged and untagged sequences")
+        self.outputs.extend(sequence.outputs)
+        self.states.extend(sequence.states)
+        self.offsets.append(len(self.outputs))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if not -len(self) <= i < len(self):
+            raise IndexError("corpus index out of range")
+        i %= len(self)
+        begin, end = self.offsets[i], self.offsets[i + 1]
+        states = memoryview(self.states)[begin:end] if self.states else memoryview(self.states)
+        return EncodedSequence(states, memoryview(self.outputs)[begin:end])
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def observations(self):
+        """every sequence's symbol ids as numpy views of the one buffer."""
+        flat = numpy.frombuffer(self.outputs, dtype=numpy.intc)
+        offsets = self.offsets
+        return [flat[offsets[i]:offsets[i + 1]] for i in range(len(self))]
+
+    @property
+    def nbytes(self):
+        return sum(a.itemsize * len(a) for a in (self.states, self.outputs, self.offsets))
+
+
+def read_tokens(f):
+    """yields the whitespace-separated tokens of a file object one at a
+    time, as they arrive (so it can follow stdin)."""
+    for line in f:
+        yield from line.split()
+
+
+def chunks(iterable, size):
+    """groups an iterable into lists of at most size items."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+# number of lines read from an .obs file before handing them to a batch
+# decode; bucketing across a larger chunk keeps padding low.
+READ_CHUNK = 16384
+
+# number of lines in each chunk handed to a worker process.
+TASK_CHUNK = 2048
+
+VALID_LANDING = ["2,5", "3,4", "4,3", "4,4", "5,5"]
+
+
+def describe_state(basename, state):
+    """formats a forward result; lander results say whether it is safe to land."""
+    if basename != "lander":
+        return state
+    return f"{state} - " + ("Safe to land" if state in VALID_LANDING else "Unsafe to land")
+
+
+def decode_sequences(model, mode, outputs, batch_size=256, beam=None, k=1):
+    """decodes a list of output lists with a CompiledHMM. mode "forward"
+    gives the most likely final state of each, "viterbi" the state sequence
+    (beam-pruned with beam), "kbest" the k best [(states, log probability)]
+    and "posterior" the (state, probability) of the most probable state at
+    each step."""
+    obs_list = [model.encode(output) for output in outputs]
+    if mode == "kbest":
+        return [[([model.states[i] for i in path], score) for path, score in model.viterbi_kbest(obs, k)]
+                for obs in obs_list]
+    if mode == "viterbi" and beam is not None:
+        return [[model.states[i] for i in model.viterbi(obs, beam=beam)[0]] for obs in obs_list]
+    if mode == "posterior":
+        posteriors, _ = model.posteriors_batch(obs_list, batch_size=batch_size)
+        return [[(model.states[i], float(p[t, i])) for t, i in enumerate(p.argmax(axis=1))]
+                for p in posteriors]
+    if mode == "forward":
+        beliefs, _ = model.forward_batch(obs_list, batch_size=batch_size)
+        return [model.states[i] for i in beliefs.argmax(axis=1)]
+    paths, _ = model.viterbi_batch(obs_list, batch_size=batch_size)
+    return [[model.states[i] for i in path] for path in paths]
+
+
+def decode_file(hmm, path, mode, batch_size=256, workers=1, chunk_size=None, beam=None, k=1):
+    """yields (sequence, result) for every line of an .obs file, in file
+    order. With workers > 1 the file is cut into chunks that a process
+    pool decodes; at most 2 * workers chunks are in flight, so memory stays
+    bounded however long the file is."""
+    model = hmm.compiled()
+    if workers <= 1:
+        for chunk in chunks(read_sequences(path), chunk_size or READ_CHUNK):
+            outputs = [sequence.outputseq for sequence in chunk]
+            yield from zip(chunk, decode_sequences(model, mode, outputs, batch_size, beam, k))
+        return
+
+    with worker_pool.model_pool(model, workers) as pool:
+        pending = collections.deque()
+        for chunk in chunks(read_sequences(path), chunk_size or TASK_CHUNK):
+            outputs = [sequence.outputseq for sequence in chunk]
+            pending.append((chunk, worker_pool.submit(pool, decode_sequences, mode, outputs, batch_size, beam, k)))
+            if len(pending) >= 2 * workers:
+                chunk, result = pending.popleft()
+                yield from zip(chunk, result.get())
+        while pending:
+            chunk, result = pending.popleft()
+            yield from zip(chunk, result.get())
+
+
+def parse_unknown(text):
+    """argparse type for --unknown: zero, good-turing or a probability."""
+    if text in ("zero", "good-turing"):
+        return text
+    try:
+        return float(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected zero, good-turing or a probability, not {text!r}") from None
+
+
 def main():
     parser = argparse.ArgumentParser(description="HMM")
     parser.add_argument("basename", type=str, help="basename for trans & emit")
     parser.add_argument("--generate", type=int, help="generate a sequence of length n", default=None)
-    parser.add_argument("--forward", type=str, help="file to open to create a sequence for forward")
-    parser.add_argument("--viterbi", type=str, help="file to open to create a sequence for viterbi")
+    parser.add_argument("--count", type=int, default=1,
+                        help="with --generate, number of sequences to write (one per line)")
+    parser.add_argument("--seed", type=int, default=None, help="random seed for --generate")
+    parser.add_argument("--forward", type=str, help="file of sequences (one per line) to run forward on")
+    parser.add_argument("--viterbi", type=str, help="file of sequences (one per line) to run viterbi on")
+    parser.add_argument("--beam", type=int, default=None,
+                        help="with --viterbi, keep only this many states per step")
+    parser.add_argument("--kbest", type=int, default=None,
+                        help="with --viterbi, write the k best state sequences with their log probabilities")
+    parser.add_argument("--posterior", type=str,
+                        help="file of sequences to write each step's most probable state and its probability for")
+    parser.add_argument("--output", type=str, default=None,
+                        help="file to write forward/viterbi results to (default: stdout)")
+    parser.add_argument("--batch-size", type=int, default=256,
+                        help="number of sequences decoded together")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of processes to decode with")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="always parse .trans/.emit instead of using the .hmmc cache")
+    parser.add_argument("--storage", choices=["auto", "dense", "sparse"], default="auto",
+                        help="matrix storage for the compiled model")
+    parser.add_argument("--unknown", type=parse_unknown, default=None,
+                        help="emission probability for unseen symbols: zero (default), good-turing, or a number")
+    parser.add_argument("--filter", type=str, default=None,
+                        help="file (or - for stdin) of observations to track online, one decision per observation")
+    parser.add_argument("--lag", type=int, default=0,
+                        help="with --filter, wait this many observations and decide by fixed-lag viterbi")
+    instrument.add_arguments(parser)
     args = parser.parse_args()
+    if args.beam is not None and args.kbest:
+        parser.error("--beam and --kbest cannot be combined")
+    for flag, value in (("--beam", args.beam), ("--kbest", args.kbest)):
+        if value is not None and value < 1:
+            parser.error(f"{flag} must be at least 1")
+    instrument.from_arguments(args)
 
     hmm1 = HMM()
-    hmm1.load(args.basename)
-
-    valid_landing = ["2,5", "3,4", "4,3", "4,4", "5,5"]
+    hmm1.load(args.basename, sparse={"auto": None, "dense": False, "sparse": True}[args.storage],
+              cache=not args.no_cache, unknown=args.unknown)
 
     if args.generate:
-        sequence, observations = hmm1.generate(args.generate)
-        with open(args.basename + "_sequence.obs", "w") as f:
-            f.write(" ".join(observations))
-    
-    # sequence.outputseq = ["purr", "silent", "silent", "meow", "meow"]
-    sequence = Sequence([], [])
-    if args.forward:
-        with open(args.forward, 'r') as f:
-            sequence.outputseq = f.readline().strip().split(" ")
-            likely_state = hmm1.forward(sequence)
-        print(likely_state if args.basename != "lander" else (f"{likely_state} - " + ("Safe to land" if  likely_state in valid_landing else "Unsafe to land")))
-    
-    if args.viterbi:
-        with open(args.forward, 'r') as f:
-            sequence.outputseq = f.readline().strip().split(" ")
-        print(hmm1.viterbi(sequence))
+        if args.count == 1 and args.seed is None:
+            sequence, observations = hmm1.generate(args.generate)
+            with open(args.basename + "_sequence.obs", "w") as f:
+                f.write(" ".join(observations))
+        else:
+            # one sequence per line, written chunk by chunk
+            symbol_names = numpy.array(hmm1.compiled().symbols, dtype=object)
+            with open(args.basename + "_sequence.obs", "w") as f:
+                for states, outputs in hmm1.generate_stream(args.count, args.generate, args.seed):
+                    f.writelines(" ".join(row) + "\n" for row in symbol_names[outputs])
+
+    out = open(args.output, "w") if args.output else sys.stdout
+    try:
+        # forward writes one final state per input line; viterbi writes
+        # the .tagged.obs format: a line of states, then the line of outputs.
+        if args.forward:
+            for sequence, state in decode_file(hmm1, args.forward, "forward",
+                                               args.batch_size, args.workers):
+                out.write(describe_state(args.basename, state) + "\n")
+
+        if args.viterbi and args.kbest:
+            # k lines of "log probability states", then the line of outputs
+            for sequence, paths in decode_file(hmm1, args.viterbi, "kbest", args.batch_size,
+                                               args.workers, k=args.kbest):
+                for states, score in paths:
+                    out.write(f"{score:.4f} " + " ".join(states) + "\n")
+                out.write(" ".join(sequence.outputseq) + "\n")
+        elif args.viterbi:
+            for sequence, states in decode_file(hmm1, args.viterbi, "viterbi", args.batch_size,
+                                                args.workers, beam=args.beam):
+                out.write(" ".join(states) + "\n" + " ".join(sequence.outputseq) + "\n")
+
+        if args.posterior:
+            for sequence, marginals in decode_file(hmm1, args.posterior, "posterior",
+                                                   args.batch_size, args.workers):
+                out.write(" ".join(f"{state}:{p:.4f}" for state, p in marginals) + "\n")
+
+        # online mode: one "t state" line per decision, flushed as it is made
+        if args.filter:
+            source = sys.stdin if args.filter == "-" else open(args.filter, "r")
+            try:
+                model = hmm1.compiled()
+                if args.lag > 0:
+                    decisions = FixedLagViterbi(model, args.lag).run(read_tokens(source))
+                else:
+                    decisions = enumerate(ForwardFilter(model).run(read_tokens(source)))
+                for t, state in decisions:
+                    out.write(f"{t} {describe_state(args.basename, state)}\n")
+                    out.flush()
+            finally:
+                if source is not sys.stdin:
+                    source.close()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
 
-    
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
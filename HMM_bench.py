@@ -0,0 +1,274 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy
+import HMM
+
+# Benchmarks for HMM.py. Every run times load, generate, forward and
+# viterbi on the bundled models and on synthetic models scaled in states,
+# vocabulary and sequence length, and cross-checks the compiled paths
+# against the dict-based reference implementations.
+#   python HMM_bench.py --save-baseline baseline.json
+#   python HMM_bench.py --compare baseline.json
+# A comparison fails (exit status 1) when some operation lost more than
+# --threshold of its baseline throughput, or when a cross-check fails.
+
+MODELS = ("cat", "lander", "partofspeech")
+
+# each scaling curve varies one of these, holding the others at BASE.
+BASE = {"states": 64, "symbols": 256, "length": 100}
+SCALING = {"states": (16, 64, 256, 1024),
+           "symbols": (16, 256, 4096),
+           "length": (10, 100, 1000)}
+
+
+def synthetic_hmm(n_states, n_symbols, branching=8, emitting=16, seed=0):
+    """returns an HMM with random probabilities in which every state can
+    move to at most branching states and emit at most emitting symbols,
+    so large models stay as sparse as real ones."""
+    rng = numpy.random.default_rng(seed)
+    states = [f"s{i}" for i in range(n_states)]
+    symbols = [f"o{i}" for i in range(n_symbols)]
+
+    def row(names, width):
+        chosen = rng.choice(len(names), min(width, len(names)), replace=False)
+        weights = rng.dirichlet(numpy.ones(len(chosen)))
+        return {names[i]: repr(float(w)) for i, w in zip(chosen, weights)}
+
+    transitions = {"#": row(states, n_states)}
+    for state in states:
+        transitions[state] = row(states, branching)
+    emissions = {state: row(symbols, emitting) for state in states}
+    return HMM.HMM(transitions, emissions)
+
+
+def measure(fn, repeat=3):
+    """returns (best wall time in seconds over repeat calls, peak bytes
+    traced during one more call)."""
+    best = numpy.inf
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - begin)
+    tracemalloc.start()
+    try:
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return best, peak
+
+
+def _result(name, operation, tokens, seconds, peak):
+    return {"name": name, "operation": operation, "tokens": tokens, "seconds": seconds,
+            "tokens_per_s": tokens / seconds if seconds > 0 else numpy.inf, "peak_bytes": peak}
+
+
+def bench_model(name, hmm, length, n_tokens, repeat=3, basename=None):
+    """times one model and returns a list of result dicts. The corpus is
+    n_tokens tokens in sequences of the given length, sampled from the
+    model. With basename, load is timed from the files there, both
+    parsing and from the binary cache."""
+    results = []
+    if basename is not None:
+        tokens = sum(len(row) for row in hmm.transitions.values()) + sum(len(row) for row in hmm.emissions.values())
+        HMM.HMM().load(basename, cache=True)  # make sure the cache is current
+        for operation, cache in (("load", False), ("load_cached", True)):
+            seconds, peak = measure(lambda: HMM.HMM().load(basename, cache=cache), repeat)
+            results.append(_result(name, operation, tokens, seconds, peak))
+    hmm.compiled()
+    n_seqs = max(n_tokens // length, 1)
+    tokens = n_seqs * length
+    sequences = hmm.generate_many(n_seqs, length, seed=0)
+    operations = [
+        ("generate", lambda: hmm.generate_many(n_seqs, length, seed=0)),
+        ("forward", lambda: [hmm.forward(sequence) for sequence in sequences]),
+        ("forward_batch", lambda: hmm.forward_batch(sequences)),
+        ("viterbi", lambda: [hmm.viterbi(sequence) for sequence in sequences]),
+        ("viterbi_batch", lambda: hmm.viterbi_batch(sequences)),
+    ]
+    for operation, fn in operations:
+        seconds, peak = measure(fn, repeat)
+        results.append(_result(name, operation, tokens, seconds, peak))
+    return results
+
+
+def path_log_probability(model, path, obs):
+    """log probability of the state path (row numbers) and encoded obs."""
+    trans = model.trans.toarray()
+    with numpy.errstate(divide='ignore'):
+        score = model.log_start[path[0]] + model.emit.log_column(obs[0])[path[0]]
+        for t in range(1, len(path)):
+            score += numpy.log(trans[path[t - 1], path[t]]) + model.emit.log_column(obs[t])[path[t]]
+    return float(score)
+
+
+def cross_check(name, hmm, sequences, rtol=1e-9):
+    """compares the compiled decoders with each other and with the
+    reference implementations on sequences sampled from hmm. Returns a
+    list of failure messages, empty when everything agrees. Ties may be
+    broken differently, so viterbi paths are compared by score and
+    forward results by the probability of the chosen state."""
+    failures = []
+    model = hmm.compiled()
+    obs_list = [model.encode(sequence.outputseq) for sequence in sequences]
+    beliefs, batch_logliks = model.forward_batch(obs_list)
+    paths, batch_scores = model.viterbi_batch(obs_list)
+    for i, (sequence, obs) in enumerate(zip(sequences, obs_list)):
+        where = f"{name} sequence {i}"
+        belief, loglik = model.forward(obs)
+        if not numpy.isfinite(loglik):
+            failures.append(f"{where}: sampled sequence has zero probability")
+            continue
+        # raw probabilities underflow on long sequences
+        for method in ("log", "prob") if len(obs) <= 50 else ("log",):
+            other = model.forward(obs, method)[1]
+            if not numpy.isclose(other, loglik, rtol=rtol):
+                failures.append(f"{where}: forward {method} log likelihood {other} != scaled {loglik}")
+        if not numpy.isclose(batch_logliks[i], loglik, rtol=rtol):
+            failures.append(f"{where}: forward_batch log likelihood {batch_logliks[i]} != {loglik}")
+        reference_state = model.state_index[hmm.forward_reference(sequence)]
+        if not numpy.isclose(belief[reference_state], belief.max(), rtol=rtol):
+            failures.append(f"{where}: forward picks {model.states[int(belief.argmax())]}, "
+                            f"reference {model.states[reference_state]}")
+
+        path, score = model.viterbi(obs)
+        for label, other in (("prob", model.viterbi(obs, "prob")[1] if len(obs) <= 50 else score),
+                             ("batch", batch_scores[i]),
+                             ("full beam", model.viterbi(obs, beam=len(model.states))[1]),
+                             ("k-best", model.viterbi_kbest(obs, 1)[0][1])):
+            if not numpy.isclose(other, score, rtol=rtol):
+                failures.append(f"{where}: viterbi {label} score {other} != {score}")
+        if not numpy.isclose(path_log_probability(model, path, obs), score, rtol=rtol):
+            failures.append(f"{where}: viterbi path does not score {score}")
+        reference = [model.state_index[state] for state in hmm.viterbi_reference(sequence)]
+        reference_score = path_log_probability(model, reference, obs)
+        if not numpy.isclose(reference_score, score, rtol=rtol):
+            failures.append(f"{where}: reference viterbi path scores {reference_score}, compiled {score}")
+    return failures
+
+
+def scaling_curves(n_tokens, repeat=3):
+    """times generate, forward_batch and viterbi_batch on synthetic models
+    while each of BASE's dimensions in turn takes the values in SCALING.
+    Returns (results, exponents), where exponents maps
+    "dimension/operation" to the slope of log time against log size."""
+    results, exponents = [], {}
+    for dimension, values in SCALING.items():
+        for value in values:
+            size = dict(BASE, **{dimension: value})
+            hmm = synthetic_hmm(size["states"], size["symbols"])
+            name = f"synthetic/{dimension}={value}"
+            for result in bench_model(name, hmm, size["length"], n_tokens, repeat):
+                if result["operation"] in ("generate", "forward_batch", "viterbi_batch"):
+                    result["dimension"], result["size"] = dimension, value
+                    results.append(result)
+        for operation in ("generate", "forward_batch", "viterbi_batch"):
+            rows = [r for r in results if r.get("dimension") == dimension and r["operation"] == operation]
+            # time per sequence, so a longer length counts against it
+            per_sequence = [r["seconds"] / (r["tokens"] // dict(BASE, **{dimension: r["size"]})["length"])
+                            for r in rows]
+            slope = numpy.polyfit(numpy.log([r["size"] for r in rows]), numpy.log(per_sequence), 1)[0]
+            exponents[f"{dimension}/{operation}"] = float(slope)
+    return results, exponents
+
+
+def compare(results, baseline, threshold=0.2):
+    """returns a message for every (name, operation) whose throughput is
+    more than threshold below its entry in the baseline."""
+    previous = {(r["name"], r["operation"]): r for r in baseline["results"]}
+    regressions = []
+    for result in results:
+        old = previous.get((result["name"], result["operation"]))
+        if old is None:
+            continue
+        if result["tokens_per_s"] < old["tokens_per_s"] * (1 - threshold):
+            regressions.append(f"{result['name']} {result['operation']}: "
+                               f"{result['tokens_per_s']:.0f} tokens/s, baseline {old['tokens_per_s']:.0f}")
+    return regressions
+
+
+def environment():
+    return {"python": platform.python_version(), "numpy": numpy.__version__,
+            "machine": platform.machine(), "processor": platform.processor(),
+            "cpus": os.cpu_count()}
+
+
+def write_table(results, out=sys.stdout):
+    out.write(f"{'model':<28} {'operation':<14} {'tokens':>8} {'seconds':>10} {'tokens/s':>12} {'peak KiB':>10}\n")
+    for r in results:
+        out.write(f"{r['name']:<28} {r['operation']:<14} {r['tokens']:>8} {r['seconds']:>10.4f} "
+                  f"{r['tokens_per_s']:>12.0f} {r['peak_bytes'] / 1024:>10.1f}\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark HMM load/generate/forward/viterbi")
+    parser.add_argument("--models", nargs="*", default=list(MODELS), help="basenames of models to time")
+    parser.add_argument("--length", type=int, default=20, help="sequence length for the bundled models")
+    parser.add_argument("--tokens", type=int, default=20000, help="tokens decoded per timing")
+    parser.add_argument("--repeat", type=int, default=3, help="timings per operation; the best is kept")
+    parser.add_argument("--no-scaling", action="store_true", help="skip the synthetic scaling curves")
+    parser.add_argument("--no-check", action="store_true", help="skip the cross-checks against the reference")
+    parser.add_argument("--save-baseline", type=str, default=None, help="write the results to this JSON file")
+    parser.add_argument("--compare", type=str, default=None, help="JSON baseline to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="fractional throughput loss that counts as a regression")
+    args = parser.parse_args()
+
+    results, failures = [], []
+    workdir = tempfile.mkdtemp()
+    try:
+        for basename in args.models:
+            # time loads from a copy, so the cache files land in workdir
+            copy = os.path.join(workdir, os.path.basename(basename))
+            for suffix in (".trans", ".emit"):
+                shutil.copyfile(basename + suffix, copy + suffix)
+            hmm = HMM.HMM()
+            hmm.load(copy)
+            name = os.path.basename(basename)
+            results.extend(bench_model(name, hmm, args.length, args.tokens, args.repeat, copy))
+            if not args.no_check:
+                failures.extend(cross_check(name, hmm, hmm.generate_many(20, min(args.length, 20), seed=1)))
+    finally:
+        shutil.rmtree(workdir)
+    if not args.no_check:
+        hmm = synthetic_hmm(BASE["states"], BASE["symbols"])
+        failures.extend(cross_check("synthetic", hmm, hmm.generate_many(5, 20, seed=1)))
+    write_table(results)
+
+    report = {"environment": environment(), "results": results}
+    if not args.no_scaling:
+        scaling, exponents = scaling_curves(args.tokens, args.repeat)
+        print()
+        write_table(scaling)
+        print()
+        for key, slope in exponents.items():
+            print(f"time per sequence ~ {key.split('/')[0]}^{slope:.2f} for {key.split('/')[1]}")
+        results = results + scaling
+        report["results"] = results
+        report["scaling"] = exponents
+
+    for failure in failures:
+        print("cross-check failed:", failure)
+    regressions = []
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for regression in regressions:
+            print("regression:", regression)
+        if not regressions:
+            print(f"no regressions against {args.compare}")
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=1)
+    sys.exit(1 if failures or regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,343 @@
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import json
+import os
+import sys
+import time
+import numpy
+import array_cache
+import HMM
+import instrument
+
+# HMM_server - a long-lived decoding service. The model is loaded once
+# and requests arrive as JSON lines over TCP or a unix socket, one object
+# per line, answered with one line each (in completion order, so a client
+# with several requests in flight matches answers by "id"):
+#   {"id": 1, "op": "viterbi", "observations": ["the", "pilot", "flies"]}
+#     -> {"id": 1, "states": ["DET", "NOUN", "VERB"], "log_probability": -21.3}
+#   {"id": 2, "op": "forward", "observations": ["1,1", "1,2", "2,2"]}
+#     -> {"id": 2, "state": "2,2", "log_likelihood": -4.1,
+#         "description": "2,2 - Unsafe to land"}
+#   {"id": 3, "op": "metrics"}   counters, queue depths, batch sizes (and,
+#                                with --instrument, the phase timings)
+#   {"id": 4, "op": "reload"}    reload .trans/.emit now
+# Sequences waiting for the same operation are decoded together: a batch
+# closes when it has max_batch sequences or max_delay seconds after its
+# first one arrived, and runs with viterbi_batch/forward_batch on a
+# worker thread while the next batch collects. The .trans/.emit files
+# are polled and the model is swapped in when they change; batches
+# already running finish with the old model.
+#   python HMM_server.py partofspeech --port 8765
+#   python HMM_server.py lander --unix /tmp/lander.sock --max-delay 0.002
+
+OPERATIONS = ("viterbi", "forward")
+
+
+def _bucket(size):
+    """the batch-size histogram bucket of size: 1, 2-3, 4-7, 8-15, ..."""
+    low = 1 << (size.bit_length() - 1)
+    return str(low) if low == 1 else f"{low}-{2 * low - 1}"
+
+
+def _decode(model, op, outputs, batch_size):
+    """runs one batch on a CompiledHMM and returns a response body per
+    sequence."""
+    obs_list = [model.encode(output) for output in outputs]
+    if op == "viterbi":
+        paths, scores = model.viterbi_batch(obs_list, batch_size)
+        return [{"states": [model.states[i] for i in path], "log_probability": float(score)}
+                for path, score in zip(paths, scores)]
+    beliefs, log_likelihoods = model.forward_batch(obs_list, batch_size=batch_size)
+    return [{"state": model.states[i], "log_likelihood": float(log_likelihood)}
+            for i, log_likelihood in zip(beliefs.argmax(axis=1), log_likelihoods)]
+
+
+# MicroBatcher - collects the sequences submitted for one operation into
+# batches and keeps that operation's metrics.
+
+class MicroBatcher:
+    def __init__(self, server, op, max_batch, max_delay):
+        self.server = server
+        self.op = op
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue = asyncio.Queue()
+        self.requests = 0
+        self.decoded = 0
+        self.batches = 0
+        self.max_queue_depth = 0
+        self.batch_sizes = collections.Counter()
+        self.latencies = collections.deque(maxlen=4096)   # seconds, most recent requests
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def submit(self, outputs):
+        """queues one sequence and returns its response body."""
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((outputs, future, time.perf_counter()))
+        self.requests += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+        return await future
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_delay
+        while len(batch) < self.max_batch:
+            if self.queue.empty():
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            else:
+                batch.append(self.queue.get_nowait())
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            # every sequence in a batch sees the same model, even if a
+            # reload lands while it runs
+            model = self.server.model
+            try:
+                results = await loop.run_in_executor(self.server.executor, _decode, model, self.op,
+                                                     [outputs for outputs, _, _ in batch], self.max_batch)
+            except Exception as error:
+                results = [error] * len(batch)
+            self.batches += 1
+            self.decoded += len(batch)
+            self.batch_sizes[_bucket(len(batch))] += 1
+            done = time.perf_counter()
+            for (_, future, begin), result in zip(batch, results):
+                self.latencies.append(done - begin)
+                if future.done():
+                    continue   # the client went away
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def metrics(self):
+        latencies = numpy.array(self.latencies) if self.latencies else numpy.zeros(1)
+        return {
+            "requests": self.requests,
+            "batches": self.batches,
+            "mean_batch_size": self.decoded / self.batches if self.batches else 0.0,
+            "batch_sizes": dict(sorted(self.batch_sizes.items(), key=lambda item: int(item[0].split("-")[0]))),
+            "queue_depth": self.queue.qsize(),
+            "max_queue_depth": self.max_queue_depth,
+            "latency_ms": {f"p{q}": float(numpy.percentile(latencies, q)) * 1e3 for q in (50, 95, 99)},
+        }
+
+
+# DecodingServer - the model, one MicroBatcher per operation, the file
+# watcher and the socket handlers.
+
+class DecodingServer:
+    def __init__(self, basename, max_batch=256, max_delay=0.005, reload_interval=1.0, sparse=None,
+                 unknown=None):
+        """max_delay is the longest a sequence waits for its batch to
+        fill, in seconds. reload_interval is how often the model files are
+        checked for changes (None: never). unknown is the fallback for
+        unseen symbols (see CompiledHMM.with_unknown)."""
+        self.basename = basename
+        self.name = os.path.basename(basename)
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.reload_interval = reload_interval
+        self.sparse = sparse
+        self.unknown = unknown
+        self.executor = concurrent.futures.ThreadPoolExecutor(1)
+        self.model = None
+        self.stamps = None
+        self.reloads = 0
+        self.reload_error = None
+        self.connections = 0
+        self.started = time.time()
+        self.batchers = {}
+        self.servers = []
+        self.watcher = None
+
+    def _stamps(self):
+        return {name: array_cache.source_stamp(path, digest=False)
+                for name, path in HMM._source_paths(self.basename).items()}
+
+    def load(self):
+        """(re)reads the model files, through the .hmmc cache."""
+        stamps = self._stamps()
+        hmm = HMM.HMM()
+        hmm.load(self.basename, sparse=self.sparse, cache=True, unknown=self.unknown)
+        self.model, self.stamps = hmm.compiled(), stamps
+
+    async def reload(self):
+        """loads the model files on the worker thread and swaps the new
+        model in. A file that does not parse keeps the old model serving;
+        the error is reported in the metrics."""
+        try:
+            await asyncio.get_running_loop().run_in_executor(self.executor, self.load)
+        except Exception as error:
+            self.reload_error = f"{type(error).__name__}: {error}"
+            return False
+        self.reloads += 1
+        self.reload_error = None
+        return True
+
+    async def _watch(self):
+        seen = self.stamps
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            try:
+                current = self._stamps()
+            except OSError:
+                continue   # a file is being replaced
+            # files that failed to load are retried when they change again
+            if current != seen and current != self.stamps:
+                seen = current
+                await self.reload()
+
+    def metrics(self):
+        return {
+            "model": self.name,
+            "states": len(self.model.states),
+            "symbols": len(self.model.symbols),
+            "uptime_s": time.time() - self.started,
+            "connections": self.connections,
+            "reloads": self.reloads,
+            "reload_error": self.reload_error,
+            "operations": {op: batcher.metrics() for op, batcher in self.batchers.items()},
+            **({"instrument": instrument.snapshot()} if instrument.enabled else {}),
+        }
+
+    async def handle(self, request):
+        """answers one decoded request object."""
+        response = {"id": request.get("id")} if isinstance(request, dict) else {"id": None}
+        if not isinstance(request, dict):
+            return dict(response, error="a request is a JSON object")
+        op = request.get("op")
+        if op == "metrics":
+            return dict(response, **self.metrics())
+        if op == "reload":
+            if await self.reload():
+                return dict(response, reloaded=True)
+            return dict(response, reloaded=False, error=self.reload_error)
+        if op not in OPERATIONS:
+            expected = ", ".join(OPERATIONS + ("metrics", "reload"))
+            return dict(response, error=f"unknown op {op!r}, expected one of {expected}")
+        outputs = request.get("observations")
+        if isinstance(outputs, str):
+            outputs = outputs.split()
+        if not isinstance(outputs, list) or not outputs or not all(isinstance(o, str) for o in outputs):
+            return dict(response, error="observations must be a non-empty list of strings")
+        result = await self.batchers[op].submit(outputs)
+        if op == "forward":
+            result = dict(result, description=HMM.describe_state(self.name, result["state"]))
+        return dict(response, **result)
+
+    async def _answer(self, line, writer):
+        try:
+            request = json.loads(line)
+        except ValueError as error:
+            response = {"id": None, "error": f"bad JSON: {error}"}
+        else:
+            try:
+                response = await self.handle(request)
+            except Exception as error:
+                response = {"id": request.get("id") if isinstance(request, dict) else None,
+                            "error": f"{type(error).__name__}: {error}"}
+        if not writer.is_closing():
+            writer.write(json.dumps(response).encode() + b"\n")
+            await writer.drain()
+
+    async def _client(self, reader, writer):
+        self.connections += 1
+        pending = set()
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except (ConnectionError, ValueError):
+                    break   # reset, or a line over the reader limit
+                if not line:
+                    break
+                if line.strip():
+                    task = asyncio.create_task(self._answer(line, writer))
+                    pending.add(task)
+                    task.add_done_callback(pending.discard)
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    async def start(self, host=None, port=None, path=None):
+        """loads the model and starts listening on host:port and/or the
+        unix socket path. Returns the asyncio servers."""
+        if self.model is None:
+            await asyncio.get_running_loop().run_in_executor(self.executor, self.load)
+        for op in OPERATIONS:
+            self.batchers[op] = MicroBatcher(self, op, self.max_batch, self.max_delay)
+        if port is not None:
+            self.servers.append(await asyncio.start_server(self._client, host, port, limit=1 << 24))
+        if path is not None:
+            self.servers.append(await asyncio.start_unix_server(self._client, path, limit=1 << 24))
+        if self.reload_interval:
+            self.watcher = asyncio.get_running_loop().create_task(self._watch())
+        return self.servers
+
+    async def close(self):
+        tasks = [batcher.task for batcher in self.batchers.values()] + ([self.watcher] if self.watcher else [])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for server in self.servers:
+            server.close()
+            await server.wait_closed()
+        self.executor.shutdown(wait=False)
+
+
+async def serve(args):
+    server = DecodingServer(args.basename, args.max_batch, args.max_delay, args.reload_interval or None,
+                            {"auto": None, "dense": False, "sparse": True}[args.storage], args.unknown)
+    servers = await server.start(args.host, args.port, args.unix)
+    for listener in servers:
+        for sock in listener.sockets:
+            print(f"serving {server.name} on {sock.getsockname()}", file=sys.stderr)
+    try:
+        await asyncio.gather(*(listener.serve_forever() for listener in servers))
+    finally:
+        await server.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="serve viterbi/forward decoding of an HMM over a socket")
+    parser.add_argument("basename", type=str, help="basename for trans & emit")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="address to listen on with --port")
+    parser.add_argument("--port", type=int, default=None, help="TCP port to listen on")
+    parser.add_argument("--unix", type=str, default=None, help="unix socket path to listen on")
+    parser.add_argument("--max-batch", type=int, default=256, help="most sequences decoded together")
+    parser.add_argument("--max-delay", type=float, default=0.005,
+                        help="seconds a sequence may wait for its batch to fill")
+    parser.add_argument("--reload-interval", type=float, default=1.0,
+                        help="seconds between checks of the model files for changes (0: never)")
+    parser.add_argument("--storage", choices=["auto", "dense", "sparse"], default="auto",
+                        help="matrix storage for the compiled model")
+    parser.add_argument("--unknown", type=HMM.parse_unknown, default=None,
+                        help="emission probability for unseen symbols: zero (default), good-turing, or a number")
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    if args.port is None and args.unix is None:
+        parser.error("give --port and/or --unix")
+    instrument.from_arguments(args)
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
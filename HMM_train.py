@@ -0,0 +1,155 @@
+from collections import Counter, defaultdict
+import argparse
+import numpy
+import HMM
+import worker_pool
+
+# Training for the HMM in HMM.py. Both estimators write the same
+# basename.trans / basename.emit files that HMM.load reads.
+#   supervised - relative-frequency counts from a .tagged.obs file
+#                (a line of states, then the line of outputs).
+#   baumwelch  - EM from an untagged .obs file, starting from an existing
+#                model. The E-step runs batched forward-backward and can
+#                be spread over a process pool.
+
+# number of sequences in each E-step task handed to a worker.
+TASK_CHUNK = 2048
+
+
+def read_tagged(path):
+    """yields a Sequence for every (states line, outputs line) pair of a
+    .tagged.obs file. Blank lines are skipped."""
+    for states, outputs in HMM.read_tagged_tokens(path):
+        yield HMM.Sequence(states, outputs)
+
+
+def estimate_supervised(sequences, smoothing=0.0):
+    """returns an HMM whose probabilities are the relative frequencies of
+    the start states, state transitions and emissions in the tagged
+    sequences. smoothing adds that count to every (state, state) pair and
+    every (state, seen output) pair before normalizing."""
+    transitions = defaultdict(Counter)
+    emissions = defaultdict(Counter)
+    states = set()
+    vocabulary = set()
+    for sequence in sequences:
+        previous = '#'
+        for state, output in zip(sequence.stateseq, sequence.outputseq):
+            transitions[previous][state] += 1
+            emissions[state][output] += 1
+            states.add(state)
+            vocabulary.add(output)
+            previous = state
+
+    if smoothing > 0:
+        for source in ['#'] + sorted(states):
+            for state in states:
+                transitions[source][state] += smoothing
+        for state in states:
+            for output in vocabulary:
+                emissions[state][output] += smoothing
+
+    def normalized(table):
+        result = {}
+        for source, counts in table.items():
+            total = sum(counts.values())
+            result[source] = {target: repr(count / total) for target, count in counts.items()}
+        return result
+
+    return HMM.HMM(normalized(transitions), normalized(emissions))
+
+
+def _expected_counts(shared, begin, end, batch_size):
+    model, encoded = shared
+    return model.expected_counts(encoded[begin:end], batch_size)
+
+
+def e_step(model, encoded, workers=1, batch_size=256):
+    """returns the summed expected counts of model over the encoded
+    sequences (see CompiledHMM.expected_counts). With workers > 1 the
+    sequences are split into ranges; the workers get the model and the
+    corpus once, and each task only names its range."""
+    if workers <= 1:
+        return model.expected_counts(encoded, batch_size)
+    with worker_pool.model_pool((model, encoded), workers) as pool:
+        results = [worker_pool.submit(pool, _expected_counts, begin, min(begin + TASK_CHUNK, len(encoded)), batch_size)
+                   for begin in range(0, len(encoded), TASK_CHUNK)]
+        parts = [result.get() for result in results]
+    start, trans, emit, log_likelihood, n_impossible = parts[0]
+    for part in parts[1:]:
+        start = start + part[0]
+        trans = trans + part[1]
+        emit = emit + part[2]
+        log_likelihood += part[3]
+        n_impossible += part[4]
+    return start, trans, emit, log_likelihood, n_impossible
+
+
+def baum_welch(hmm, outputs, iterations=10, tolerance=1e-4, pseudocount=0.0,
+               workers=1, batch_size=256, report=None):
+    """re-estimates hmm from untagged output sequences (lists of symbols,
+    or an HMM.EncodedCorpus encoded with hmm's vocabulary) with EM, and
+    returns the trained HMM. Training stops after iterations rounds, or
+    once the log likelihood per token improves by less than tolerance.
+    Entries that are zero in hmm stay zero, and outputs the model has
+    never seen make their sequence impossible, so it is left out, unless
+    hmm has an unknown-symbol fallback. report, if given, is called with
+    (iteration, log likelihood, number of sequences left out) after every
+    E-step."""
+    model = hmm.compiled()
+    if isinstance(outputs, HMM.EncodedCorpus):
+        encoded = outputs.observations()
+    else:
+        encoded = [model.encode(output) for output in outputs]
+    n_tokens = max(sum(len(obs) for obs in encoded), 1)
+    previous = -numpy.inf
+    for iteration in range(iterations):
+        start, trans, emit, log_likelihood, n_impossible = e_step(model, encoded, workers, batch_size)
+        if report is not None:
+            report(iteration, log_likelihood, n_impossible)
+        if (log_likelihood - previous) / n_tokens < tolerance:
+            break
+        model = model.reestimated(start, trans, emit, pseudocount)
+        previous = log_likelihood
+    trained = HMM.HMM(*model.to_dicts())
+    trained.model = model
+    return trained
+
+
+def main():
+    parser = argparse.ArgumentParser(description="train an HMM and write basename.trans/.emit")
+    subparsers = parser.add_subparsers(dest="mode", required=True)
+
+    supervised = subparsers.add_parser("supervised", help="count from a .tagged.obs file")
+    supervised.add_argument("tagged", type=str, help=".tagged.obs file to count from")
+    supervised.add_argument("output", type=str, help="basename to write the model to")
+    supervised.add_argument("--smoothing", type=float, default=0.0, help="add-k smoothing count")
+
+    baumwelch = subparsers.add_parser("baumwelch", help="EM from an untagged .obs file")
+    baumwelch.add_argument("basename", type=str, help="basename of the starting model")
+    baumwelch.add_argument("observations", type=str, help=".obs file, one sequence per line")
+    baumwelch.add_argument("output", type=str, help="basename to write the model to")
+    baumwelch.add_argument("--iterations", type=int, default=10)
+    baumwelch.add_argument("--tolerance", type=float, default=1e-4,
+                           help="stop when log likelihood per token improves by less than this")
+    baumwelch.add_argument("--pseudocount", type=float, default=0.0)
+    baumwelch.add_argument("--workers", type=int, default=1, help="processes for the E-step")
+    baumwelch.add_argument("--batch-size", type=int, default=256)
+    args = parser.parse_args()
+
+    if args.mode == "supervised":
+        trained = estimate_supervised(read_tagged(args.tagged), args.smoothing)
+    else:
+        hmm1 = HMM.HMM()
+        hmm1.load(args.basename)
+        # packed ids rather than lists of strings: a few bytes per token
+        outputs = HMM.EncodedCorpus.read(args.observations, hmm1.compiled().vocabulary())
+        trained = baum_welch(hmm1, outputs, args.iterations, args.tolerance, args.pseudocount,
+                             args.workers, args.batch_size,
+                             report=lambda i, ll, skipped: print(f"iteration {i}: log likelihood {ll:.4f}"
+                                                                 + (f" ({skipped} sequences skipped)" if skipped else "")))
+    trained.save(args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,28 @@
+import os
+import shutil
+import sys
+import tempfile
+import asyncio
+import json
 import unittest
+from unittest import mock
+import numpy
 import HMM
+import HMM_train
+import HMM_bench
+import HMM_server
+import instrument
+
+def copy_model(test, name):
+    """copies name.trans and name.emit into a temporary directory that is
+    removed after test, and returns the basename of the copy."""
+    directory = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, directory)
+    basename = os.path.join(directory, name)
+    for suffix in (".trans", ".emit"):
+        shutil.copyfile(name + suffix, basename + suffix)
+    return basename
+
 
 class TestHMM(unittest.TestCase):
     def test_load(self):
@@ -21,4 +44,382 @@ class TestHMM(unittest.TestCase):
 
         # Check if the result is as expected
         self.assertEqual(h1.emissions, expected_emissions)  
-        self.assertEqual(h1.transitions, expected_transitions)  
\ No newline at end of file
+        self.assertEqual(h1.transitions, expected_transitions)  
+
+    def test_compiled_matches_reference(self):
+        for basename, outputs in [("cat", "silent meow silent purr silent"),
+                                  ("lander", "1,1 1,2 2,2 2,4 4,5"),
+                                  ("partofspeech", "the pilot flies the plane .")]:
+            h = HMM.HMM()
+            h.load(basename)
+            sequence = HMM.Sequence([], outputs.split(" "))
+            self.assertEqual(h.forward(sequence), h.forward_reference(sequence))
+            self.assertEqual(h.viterbi(sequence), h.viterbi_reference(sequence))
+
+    def test_instances_do_not_share_tables(self):
+        h1 = HMM.HMM()
+        h1.load("cat")
+        h2 = HMM.HMM()
+        self.assertEqual(h2.transitions, {})
+        self.assertEqual(h2.emissions, {})
+
+    def test_long_sequence_is_stable(self):
+        h = HMM.HMM()
+        h.load("cat")
+        sequence = HMM.Sequence([], "silent meow silent purr silent".split(" ") * 1000)
+        self.assertEqual(h.viterbi(sequence, method="prob"), [])
+        self.assertEqual(len(h.viterbi(sequence, method="log")), len(sequence))
+        scaled = h.log_likelihood(sequence, method="scaled")
+        logspace = h.log_likelihood(sequence, method="log")
+        self.assertTrue(numpy.isfinite(scaled))
+        self.assertAlmostEqual(scaled, logspace, places=6)
+
+    def test_viterbi_batch_tags_ambiguous_sents(self):
+        h = HMM.HMM()
+        h.load("partofspeech")
+        sequences = list(HMM.read_sequences("ambiguous_sents.obs"))
+        with open("ambiguous_sents.tagged.obs") as f:
+            lines = [line.split() for line in f if line.strip()]
+        expected = lines[0::2]
+        self.assertEqual(h.viterbi_batch(sequences, batch_size=3), expected)
+        self.assertEqual(h.forward_batch(sequences), [h.forward(s) for s in sequences])
+
+    def test_cli_streams_every_line(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        sequences = list(HMM.read_sequences("ambiguous_sents.obs"))
+        observations = os.path.join(directory, "sentences.obs")
+        with open(observations, "w") as f:
+            f.write("\n\n".join(" ".join(s.outputseq) for s in sequences) + "\n")
+        h = HMM.HMM()
+        h.load("partofspeech")
+        for mode, expected in (("--viterbi", "ambiguous_sents.tagged.obs"), ("--forward", None)):
+            output = os.path.join(directory, mode[2:] + ".out")
+            argv = ["HMM.py", "partofspeech", "--no-cache", mode, observations, "--output", output,
+                    "--batch-size", "2"]
+            # chunks of two lines, so the file is read in several pieces
+            with mock.patch.object(sys, "argv", argv), mock.patch.object(HMM, "READ_CHUNK", 2):
+                HMM.main()
+            with open(output) as f:
+                written = f.read().splitlines()
+            if expected:
+                with open(expected) as f:
+                    self.assertEqual(written, [line.strip() for line in f if line.strip()])
+            else:
+                self.assertEqual(written, [h.forward(s) for s in sequences])
+
+    def test_parallel_decode_keeps_input_order(self):
+        h = HMM.HMM()
+        h.load("partofspeech")
+        serial = list(HMM.decode_file(h, "ambiguous_sents.obs", "viterbi"))
+        parallel = list(HMM.decode_file(h, "ambiguous_sents.obs", "viterbi", workers=2, chunk_size=2))
+        self.assertEqual([s.outputseq for s, _ in parallel], [s.outputseq for s, _ in serial])
+        self.assertEqual([states for _, states in parallel], [states for _, states in serial])
+
+    def test_online_filter_and_fixed_lag(self):
+        h = HMM.HMM()
+        h.load("lander")
+        sequence = HMM.Sequence([], "1,1 1,2 2,2 2,4 4,5".split(" "))
+        f = HMM.ForwardFilter(h.compiled())
+        self.assertEqual(list(f.run(sequence.outputseq))[-1], h.forward(sequence))
+        self.assertAlmostEqual(f.log_likelihood, h.log_likelihood(sequence))
+        smoother = HMM.FixedLagViterbi(h.compiled(), lag=len(sequence))
+        decisions = list(smoother.run(sequence.outputseq))
+        self.assertEqual([state for _, state in decisions], h.viterbi(sequence))
+
+        # "end" has no way out, so the step after reaching it is an error
+        dead_end = HMM.HMM({"#": {"go": "1.0"}, "go": {"end": "1.0"}},
+                           {"go": {"x": "1.0"}, "end": {"y": "1.0"}}).compiled()
+        for online in (HMM.ForwardFilter(dead_end), HMM.FixedLagViterbi(dead_end, lag=1)):
+            with self.assertRaisesRegex(ValueError, "no transitions out of state 'end'"):
+                list(online.run(["x", "y", "y"]))
+            self.assertEqual(online.steps, 2)
+
+    def test_sparse_matches_dense(self):
+        dense = HMM.HMM()
+        dense.load("lander", sparse=False)
+        sparse = HMM.HMM()
+        sparse.load("lander", sparse=True)
+        self.assertIsInstance(sparse.model.trans, HMM.SparseMatrix)
+        numpy.testing.assert_allclose(sparse.model.trans.toarray(), dense.model.trans.toarray())
+        sequence = HMM.Sequence([], "1,1 1,2 2,2 2,4 4,5".split(" "))
+        self.assertEqual(sparse.viterbi(sequence), dense.viterbi(sequence))
+        self.assertEqual(sparse.forward(sequence), dense.forward(sequence))
+        self.assertAlmostEqual(sparse.log_likelihood(sequence), dense.log_likelihood(sequence))
+
+    def test_binary_cache(self):
+        basename = copy_model(self, "cat")
+        parsed = HMM.HMM()
+        parsed.load(basename, cache=True)
+        self.assertTrue(os.path.exists(basename + ".hmmc"))
+
+        cached = HMM.HMM()
+        cached.load(basename, cache=True)
+        self.assertIsNone(cached._transitions)
+        sequence = HMM.Sequence([], "silent meow silent purr silent".split(" "))
+        self.assertEqual(cached.viterbi(sequence), parsed.viterbi(sequence))
+        self.assertEqual(cached.emissions, parsed.emissions)
+
+        with open(basename + ".emit", "a") as f:
+            f.write("happy yawn 0.0\n")
+        stale = HMM.HMM()
+        stale.load(basename, cache=True)
+        self.assertIn("yawn", stale.emissions["happy"])
+
+    def test_generate_many_is_seeded_and_follows_the_model(self):
+        h = HMM.HMM()
+        h.load("cat")
+        first = h.generate_many(4, 6, seed=7)
+        second = h.generate_many(4, 6, seed=7)
+        self.assertEqual([s.stateseq for s in first], [s.stateseq for s in second])
+        self.assertEqual([s.outputseq for s in first], [s.outputseq for s in second])
+        self.assertEqual([len(s) for s in first], [6] * 4)
+
+        states, outputs = h.compiled().sampler().sample(20000, 2, numpy.random.default_rng(0))
+        happy = h.compiled().state_index["happy"]
+        following = numpy.bincount(states[states[:, 0] == happy, 1], minlength=3)
+        numpy.testing.assert_allclose(following / following.sum(),
+                                      h.compiled().trans.toarray()[happy], atol=0.03)
+
+        # b is reachable but emits nothing; c has no way out and loops
+        silent = HMM.HMM({"#": {"a": "1.0"}, "a": {"b": "0.5", "c": "0.5"}, "b": {"c": "1.0"}},
+                         {"a": {"x": "1.0"}, "c": {"y": "1.0"}})
+        with self.assertRaisesRegex(ValueError, "'b' has no emissions"):
+            silent.generate_many(50, 3, seed=0)
+        looping = HMM.HMM({"#": {"a": "1.0"}, "a": {"c": "1.0"}}, {"a": {"x": "1.0"}, "c": {"y": "1.0"}})
+        self.assertEqual(looping.generate_many(1, 4, seed=0)[0].outputseq, ["x", "y", "y", "y"])
+
+    def test_posteriors(self):
+        h = HMM.HMM()
+        h.load("lander")
+        sequence = HMM.Sequence([], "1,1 1,2 2,2 2,4 4,5".split(" "))
+        posterior, log_likelihood = h.posteriors(sequence, return_loglik=True)
+        self.assertEqual(posterior.shape, (len(sequence), len(h.compiled().states)))
+        numpy.testing.assert_allclose(posterior.sum(axis=1), 1.0)
+        self.assertAlmostEqual(log_likelihood, h.log_likelihood(sequence))
+        model = h.compiled()
+        belief, _ = model.forward(model.encode(sequence.outputseq))
+        numpy.testing.assert_allclose(posterior[-1], belief, atol=1e-12)
+        batch = h.posteriors_batch([sequence, HMM.Sequence([], sequence.outputseq[:2])])
+        numpy.testing.assert_allclose(batch[0], posterior)
+
+    def test_beam_and_kbest_viterbi(self):
+        h = HMM.HMM()
+        h.load("partofspeech")
+        n_states = len(h.compiled().states)
+        for sparse in (False, True):
+            h.compile(sparse=sparse)
+            for sequence in HMM.read_sequences("ambiguous_sents.obs"):
+                states, score = h.viterbi(sequence, return_score=True)
+                self.assertEqual(h.viterbi(sequence, return_score=True, beam=n_states), (states, score))
+                best = h.viterbi_kbest(sequence, 4)
+                self.assertEqual(best[0][0], states)
+                self.assertAlmostEqual(best[0][1], score)
+                scores = [s for _, s in best]
+                self.assertEqual(scores, sorted(scores, reverse=True))
+                self.assertEqual(len({tuple(p) for p, _ in best}), len(best))
+        with self.assertRaises(ValueError):
+            h.viterbi(sequence, method="prob", beam=2)
+        with self.assertRaisesRegex(ValueError, "beam must be at least 1"):
+            h.viterbi(sequence, beam=0)
+        with self.assertRaisesRegex(ValueError, "k must be at least 1"):
+            h.viterbi_kbest(sequence, 0)
+
+    def test_unknown_symbol_fallback(self):
+        sequence = HMM.Sequence([], "the zorblax flies the plane .".split())
+        h = HMM.HMM()
+        h.load("partofspeech")
+        self.assertEqual(h.viterbi(sequence), [])
+        for unknown in ("good-turing", 1e-4):
+            for sparse in (False, True):
+                g = HMM.HMM(unknown=unknown)
+                g.load("partofspeech", sparse=sparse)
+                states, score = g.viterbi(sequence, return_score=True)
+                self.assertEqual(states, ["DET", "NOUN", "VERB", "DET", "NOUN", "."])
+                self.assertGreater(score, -numpy.inf)
+                self.assertEqual(g.compiled().to_dicts(), h.compiled().to_dicts())
+        model = HMM.HMM(unknown=0.5)
+        model.load("cat")
+        compiled = model.compiled()
+        self.assertTrue((compiled.sampler().sample(50, 20, numpy.random.default_rng(0))[1] < 3).all())
+        unseen = len(compiled.symbols)
+        numpy.testing.assert_allclose(compiled.emit.column(unseen), 0.5)
+        encoded = compiled.encode(["purr", "hiss", "meow"])
+        trained = compiled.reestimated(*compiled.expected_counts([encoded])[:3])
+        numpy.testing.assert_allclose(trained.emit.toarray()[:, :unseen].sum(axis=1), 1.0)
+        numpy.testing.assert_allclose(trained.emit.column(unseen), 0.5)
+        with self.assertRaises(ValueError):
+            compiled.with_unknown("sometimes")
+
+    def test_encoded_corpus(self):
+        h = HMM.HMM()
+        h.load("partofspeech")
+        model = h.compiled()
+        corpus = HMM.EncodedCorpus.read("ambiguous_sents.obs", model.vocabulary())
+        sequences = list(HMM.read_sequences("ambiguous_sents.obs"))
+        self.assertEqual(len(corpus), len(sequences))
+        for encoded, sequence in zip(corpus, sequences):
+            self.assertEqual(encoded.decoded(model.state_vocabulary(), model.vocabulary()).outputseq,
+                             sequence.outputseq)
+        paths, _ = model.viterbi_batch(corpus.observations())
+        self.assertEqual([[model.states[i] for i in path] for path in paths], h.viterbi_batch(sequences))
+
+        states, symbols = HMM.Vocabulary(), HMM.Vocabulary(["<s>"])
+        tagged = HMM.EncodedCorpus.read("ambiguous_sents.tagged.obs", symbols, states)
+        first = tagged[0].decoded(states, symbols)
+        self.assertEqual((first.stateseq, first.outputseq),
+                         ("PRON VERB DET NOUN .".split(), "i shot the elephant .".split()))
+        self.assertEqual(symbols.index["i"], 1)
+        frozen = HMM.Vocabulary(["a", "b"], frozen=True)
+        self.assertEqual(list(frozen.encode(["b", "c", "a"])), [1, 2, 0])
+        self.assertEqual(frozen.decode([1, 2]), ["b", None])
+        with self.assertRaises(ValueError):
+            corpus.append(tagged[0])
+
+
+class TestBench(unittest.TestCase):
+    def test_cross_check_and_compare(self):
+        h = HMM.HMM()
+        h.load("lander")
+        self.assertEqual(HMM_bench.cross_check("lander", h, h.generate_many(5, 8, seed=0)), [])
+        synthetic = HMM_bench.synthetic_hmm(12, 30, seed=1)
+        self.assertEqual(HMM_bench.cross_check("synthetic", synthetic, synthetic.generate_many(3, 10, seed=0)), [])
+        results = HMM_bench.bench_model("synthetic", synthetic, 10, 200, repeat=1)
+        self.assertEqual([r["operation"] for r in results],
+                         ["generate", "forward", "forward_batch", "viterbi", "viterbi_batch"])
+        faster = {"results": [dict(r, tokens_per_s=r["tokens_per_s"] * 2) for r in results]}
+        self.assertEqual(len(HMM_bench.compare(results, faster)), len(results))
+        self.assertEqual(HMM_bench.compare(results, {"results": results}), [])
+
+
+class TestServer(unittest.TestCase):
+    def test_micro_batching_and_reload(self):
+        basename = copy_model(self, "lander")
+        directory = os.path.dirname(basename)
+        hmm = HMM.HMM()
+        hmm.load("lander")
+        sequences = hmm.generate_many(40, 6, seed=2)
+
+        async def ask(reader, writer, requests):
+            for request in requests:
+                writer.write(json.dumps(request).encode() + b"\n")
+            await writer.drain()
+            responses = [json.loads(await reader.readline()) for _ in requests]
+            return {response["id"]: response for response in responses}
+
+        async def scenario():
+            server = HMM_server.DecodingServer(basename, max_batch=16, max_delay=0.05, reload_interval=0.05)
+            path = os.path.join(directory, "socket")
+            await server.start(path=path)
+            try:
+                reader, writer = await asyncio.open_unix_connection(path)
+                requests = [{"id": i, "op": "viterbi", "observations": sequence.outputseq}
+                            for i, sequence in enumerate(sequences)]
+                requests += [{"id": 100 + i, "op": "forward", "observations": " ".join(sequence.outputseq)}
+                             for i, sequence in enumerate(sequences)]
+                answers = await ask(reader, writer, requests + [{"id": "bad", "op": "viterbi"}])
+                for i, sequence in enumerate(sequences):
+                    self.assertEqual(answers[i]["states"], hmm.viterbi(sequence))
+                    self.assertEqual(answers[100 + i]["state"], hmm.forward(sequence))
+                    self.assertIn("land", answers[100 + i]["description"])
+                self.assertIn("error", answers["bad"])
+                metrics = (await ask(reader, writer, [{"id": 0, "op": "metrics"}]))[0]["operations"]
+                self.assertEqual(metrics["viterbi"]["requests"], 40)
+                self.assertLess(metrics["viterbi"]["batches"], 40)
+                self.assertEqual(metrics["forward"]["queue_depth"], 0)
+
+                # a new start state is picked up without a restart
+                with open(basename + ".trans", "w") as f:
+                    f.write("# 5,5 1.0\n5,5 5,5 1.0\n")
+                for _ in range(100):
+                    await asyncio.sleep(0.05)
+                    if server.reloads:
+                        break
+                answer = (await ask(reader, writer, [{"id": 0, "op": "viterbi", "observations": ["4,5", "5,5"]}]))[0]
+                self.assertEqual(answer["states"], ["5,5", "5,5"])
+                writer.close()
+            finally:
+                await server.close()
+
+        asyncio.run(scenario())
+
+
+class TestInstrument(unittest.TestCase):
+    def setUp(self):
+        instrument.reset()
+        instrument.enable()
+        self.addCleanup(instrument.reset)
+        self.addCleanup(instrument.disable)
+
+    def test_phases_counters_and_dump(self):
+        basename = copy_model(self, "lander")
+        directory = os.path.dirname(basename)
+        for _ in range(2):
+            h = HMM.HMM()
+            h.load(basename, cache=True)
+        sequences = h.generate_many(3, 5, seed=0)
+        h.viterbi(sequences[0])
+        h.forward(sequences[0])
+        h.viterbi_batch(sequences)
+        stats = instrument.snapshot()
+        n_states = len(h.compiled().states)
+        self.assertEqual(stats["counters"]["hmm.load.cache_miss"], 1)
+        self.assertEqual(stats["counters"]["hmm.load.cache_hit"], 1)
+        self.assertEqual(stats["counters"]["hmm.generate.tokens"], 15)
+        self.assertEqual(stats["counters"]["hmm.viterbi.cells"], 20 * n_states)
+        self.assertEqual(stats["counters"]["hmm.forward.cells"], 5 * n_states)
+        for name in ("hmm.load", "hmm.load.parse_emit", "hmm.load.compile", "hmm.viterbi.trellis",
+                     "hmm.viterbi_batch.backtrack", "hmm.forward.trellis", "hmm.encode"):
+            self.assertGreater(stats["phases"][name]["count"], 0, name)
+        self.assertEqual(stats["phases"]["hmm.load"]["count"], 2)
+        self.assertEqual(sum(stats["phases"]["hmm.encode"]["histogram_us"].values()),
+                         stats["phases"]["hmm.encode"]["count"])
+
+        path = os.path.join(directory, "stats.json")
+        self.assertEqual(instrument.dump(path), [path])
+        with open(path) as f:
+            self.assertEqual(json.load(f)["counters"], stats["counters"])
+
+        # switched off, the hooks record nothing
+        instrument.disable()
+        instrument.reset()
+        h.viterbi(sequences[0])
+        self.assertEqual(instrument.snapshot(), {"counters": {}, "phases": {}})
+
+
+class TestTrain(unittest.TestCase):
+    def test_supervised_counts(self):
+        h = HMM_train.estimate_supervised(HMM_train.read_tagged("ambiguous_sents.tagged.obs"))
+        self.assertAlmostEqual(float(h.transitions["#"]["PRON"]), 5 / 11)
+        sequence = HMM.Sequence([], "i shot the elephant .".split(" "))
+        self.assertEqual(h.viterbi(sequence), ["PRON", "VERB", "DET", "NOUN", "."])
+
+    def test_baum_welch_improves_likelihood(self):
+        h = HMM.HMM()
+        h.load("cat")
+        outputs = [s.outputseq for s in h.generate_many(200, 15, seed=0)]
+        history = []
+        HMM_train.baum_welch(h, outputs, iterations=5, tolerance=0,
+                             report=lambda i, ll, skipped: history.append(ll))
+        self.assertEqual(len(history), 5)
+        for before, after in zip(history, history[1:]):
+            self.assertGreaterEqual(after, before - 1e-9)
+
+    def test_baum_welch_drops_zeros_in_either_storage(self):
+        outputs = [s.outputseq for s in HMM.read_sequences("ambiguous_sents.obs")]
+        trained = []
+        for sparse in (False, True):
+            h = HMM.HMM()
+            h.load("partofspeech")
+            h.compile(sparse=sparse)
+            trained.append(HMM_train.baum_welch(h, outputs, iterations=3).compiled())
+        self.assertIsInstance(trained[1].emit, HMM.SparseMatrix)
+        self.assertEqual(trained[1].emit.nnz(), trained[0].emit.nnz())
+        dense, sparse = trained[0].to_dicts(), trained[1].to_dicts()
+        for dense_table, sparse_table in zip(dense, sparse):
+            self.assertEqual({k: set(row) for k, row in dense_table.items()},
+                             {k: set(row) for k, row in sparse_table.items()})
+            for state, row in sparse_table.items():
+                for key, value in row.items():
+                    self.assertGreater(float(value), 0.0)
+                    self.assertAlmostEqual(float(value), float(dense_table[state][key]))
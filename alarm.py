@@ -1,59 +1,35 @@
-from pgmpy.models import BayesianNetwork
-from pgmpy.inference import VariableElimination
+import argparse
+import os
+import bn_model
+import instrument
+from bn_inference import CachedInference, JunctionTree
 
-alarm_model = BayesianNetwork(
-    [
-        ("Burglary", "Alarm"),
-        ("Earthquake", "Alarm"),
-        ("Alarm", "JohnCalls"),
-        ("Alarm", "MaryCalls"),
-    ]
-)
+# The network is declared in alarm.bn. Loading goes through the .bnc cache
+# of compiled CPT arrays, and pgmpy is only imported once alarm_model is
+# used or alarm_infer answers its first query.
+alarm_network = bn_model.load_network(os.path.join(os.path.dirname(os.path.abspath(__file__)), "alarm.bn"),
+                                      cache=True)
 
-# Defining the parameters using CPT
-from pgmpy.factors.discrete import TabularCPD
+alarm_infer = CachedInference(alarm_network)
 
-cpd_burglary = TabularCPD(
-    variable="Burglary", variable_card=2, values=[[0.999], [0.001]],
-    state_names={"Burglary":['no','yes']},
-)
-cpd_earthquake = TabularCPD(
-    variable="Earthquake", variable_card=2, values=[[0.998], [0.002]],
-    state_names={"Earthquake":["no","yes"]},
-)
-cpd_alarm = TabularCPD(
-    variable="Alarm",
-    variable_card=2,
-    values=[[0.999, 0.71, 0.06, 0.05], [0.001, 0.29, 0.94, 0.95]],
-    evidence=["Burglary", "Earthquake"],
-    evidence_card=[2, 2],
-    state_names={"Burglary":['no','yes'], "Earthquake":['no','yes'], 'Alarm':['yes','no']},
-)
-cpd_johncalls = TabularCPD(
-    variable="JohnCalls",
-    variable_card=2,
-    values=[[0.95, 0.1], [0.05, 0.9]],
-    evidence=["Alarm"],
-    evidence_card=[2],
-    state_names={"Alarm":['yes','no'], "JohnCalls":['yes', 'no']},
-)
-cpd_marycalls = TabularCPD(
-    variable="MaryCalls",
-    variable_card=2,
-    values=[[0.1, 0.7], [0.9, 0.3]],
-    evidence=["Alarm"],
-    evidence_card=[2],
-state_names={"Alarm":['yes','no'], "MaryCalls":['yes', 'no']},
-)
+# compiled once; alarm_tree.marginals(evidence) gives every posterior in one pass
+alarm_tree = JunctionTree(alarm_network)
 
-# Associating the parameters with the model structure
-alarm_model.add_cpds(
-    cpd_burglary, cpd_earthquake, cpd_alarm, cpd_johncalls, cpd_marycalls)
 
-alarm_infer = VariableElimination(alarm_model)
+def __getattr__(name):
+    # alarm_model, the pgmpy BayesianNetwork, is built on first access
+    if name == "alarm_model":
+        return alarm_network.to_model()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def main():
+    # the network is loaded at import, so --instrument covers the queries;
+    # INSTRUMENT_STATS in the environment covers the load as well
+    parser = argparse.ArgumentParser(description="alarm network queries")
+    instrument.add_arguments(parser)
+    instrument.from_arguments(parser.parse_args())
+
     # print(alarm_infer.query(variables=["JohnCalls"],evidence={"Earthquake":"yes"}))
     # print(alarm_infer.query(variables=["JohnCalls", "Earthquake"],evidence={"Burglary":"yes","MaryCalls":"yes"}))
     
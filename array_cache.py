@@ -0,0 +1,104 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+import numpy
+
+# The binary container behind the compiled-model caches of HMM.py (.hmmc)
+# and bn_model.py (.bnc). Layout:
+#   magic, 8-byte little-endian header length, JSON header,
+#   then each array's raw bytes at an ALIGN-aligned offset.
+# The header records the size, mtime and sha1 of every source file the
+# arrays were built from, so a cache is only used while its sources are
+# unchanged, and the arrays are mapped read-only with mmap rather than
+# copied in.
+
+ALIGN = 64
+
+
+def source_stamp(path, digest=True):
+    """returns {"size", "mtime_ns"} of the file at path, plus its "sha1"
+    with digest."""
+    stat = os.stat(path)
+    stamp = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if digest:
+        with open(path, 'rb') as f:
+            stamp["sha1"] = hashlib.sha1(f.read()).hexdigest()
+    return stamp
+
+
+def _matches(source, cached):
+    """whether the file at source is still the one cached was taken of.
+    Sources whose size and mtime match are trusted; otherwise their sha1
+    decides."""
+    current = source_stamp(source, digest=False)
+    if current == {"size": cached["size"], "mtime_ns": cached["mtime_ns"]}:
+        return True
+    return current["size"] == cached["size"] and source_stamp(source)["sha1"] == cached["sha1"]
+
+
+def _aligned(n):
+    return -(-n // ALIGN) * ALIGN
+
+
+def write(path, magic, arrays, sources, header=None):
+    """writes arrays (a dict of name -> numpy array) to path, stamped
+    with the current state of sources (a dict of name -> source file
+    path). header is extra JSON metadata kept beside them. The file is
+    written beside the final one and renamed into place, so readers never
+    see half a cache. Returns False, leaving things as they were, when
+    the file cannot be written: a read-only model directory just means no
+    cache."""
+    header = dict(header or {}, sources={name: source_stamp(source) for name, source in sources.items()},
+                  arrays={})
+    offset = 0
+    for name, array in arrays.items():
+        header["arrays"][name] = [array.dtype.str, list(array.shape), offset]
+        offset += _aligned(array.nbytes)
+    encoded = json.dumps(header).encode()
+    data_start = _aligned(len(magic) + 8 + len(encoded))
+
+    temp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(temp, 'wb') as f:
+            f.write(magic + struct.pack("<Q", len(encoded)) + encoded)
+            for name, array in arrays.items():
+                f.seek(data_start + header["arrays"][name][2])
+                f.write(numpy.ascontiguousarray(array).tobytes())
+        os.replace(temp, path)
+    except OSError:
+        if os.path.exists(temp):
+            os.remove(temp)
+        return False
+    return True
+
+
+def read(path, magic, sources):
+    """returns (header, arrays) from the file at path, with arrays as
+    read-only views of the mapped file, or None if there is no such file,
+    it is not a magic container, or any of sources changed since it was
+    written."""
+    try:
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    try:
+        if mapped[:len(magic)] != magic:
+            return None
+        length, = struct.unpack_from("<Q", mapped, len(magic))
+        header = json.loads(mapped[len(magic) + 8:len(magic) + 8 + length])
+        if set(header["sources"]) != set(sources):
+            return None
+        if not all(_matches(source, header["sources"][name]) for name, source in sources.items()):
+            return None
+        data_start = _aligned(len(magic) + 8 + length)
+        arrays = {}
+        for name, (dtype, shape, offset) in header["arrays"].items():
+            count = int(numpy.prod(shape)) if shape else 1
+            arrays[name] = numpy.frombuffer(mapped, dtype=numpy.dtype(dtype), count=count,
+                                            offset=data_start + offset).reshape(shape)
+        return header, arrays
+    except (KeyError, TypeError, ValueError, struct.error, OSError):
+        return None
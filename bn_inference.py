@@ -0,0 +1,480 @@
+from collections import OrderedDict, namedtuple
+import itertools
+import numpy
+import instrument
+
+# Inference helpers for the belief networks in alarm.py and carnet.py.
+# Everything here works on DiscreteNetwork's numpy tables; pgmpy is only
+# imported when a pgmpy object (a model, DiscreteFactor or
+# VariableElimination) is actually needed, since importing it is slow.
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+
+def query_key(variables, evidence=None):
+    """normalizes a query so that the same question asked with the
+    variables in another order, or the evidence in another dict order,
+    maps to the same key."""
+    return frozenset(variables), tuple(sorted((evidence or {}).items()))
+
+
+def model_fingerprint(model):
+    """identifies the current CPDs and edges of model. add_cpds and
+    remove_cpds replace CPD objects, so comparing ids is enough as long as
+    the old CPDs stay referenced (CachedInference keeps them)."""
+    return tuple(map(id, model.cpds)), tuple(model.edges())
+
+
+# CachedInference - wraps an inference engine (VariableElimination by
+# default) with an LRU cache of query results. The engine is rebuilt and
+# the cache emptied whenever the model's CPDs or edges change. model may
+# also be a DiscreteNetwork, whose pgmpy model is built on the first query.
+
+class CachedInference:
+    def __init__(self, model, maxsize=1024, engine=None):
+        self.model = model
+        self.maxsize = maxsize
+        self.engine = engine
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._inference = None
+        self._fingerprint = None
+        self._cpds = []
+
+    def inference(self):
+        """returns the engine for the model as it is now, rebuilding it
+        (and emptying the cache) if the model changed since the last
+        query."""
+        model = self.model.to_model() if isinstance(self.model, DiscreteNetwork) else self.model
+        fingerprint = model_fingerprint(model)
+        if fingerprint != self._fingerprint:
+            if self.engine is None:
+                from pgmpy.inference import VariableElimination
+                self.engine = VariableElimination
+            self._cache.clear()
+            with instrument.phase("bn.query.engine_build"):
+                self._inference = self.engine(model)
+            self._fingerprint = fingerprint
+            self._cpds = list(model.cpds)
+        return self._inference
+
+    @instrument.timed("bn.query")
+    def query(self, variables, evidence=None, virtual_evidence=None,
+              elimination_order="greedy", joint=True, show_progress=False):
+        """same arguments and result as VariableElimination.query. Results
+        are cached per (set of variables, evidence), so a joint result may
+        list its variables in the order of the first query that computed
+        it. Each call returns its own copy. Queries with virtual evidence
+        are not cached."""
+        inference = self.inference()
+        if virtual_evidence is not None:
+            return inference.query(variables, evidence, virtual_evidence, elimination_order,
+                                   joint, show_progress)
+        key = query_key(variables, evidence) + (elimination_order, joint)
+        result = self._cache.get(key)
+        if result is not None:
+            self.hits += 1
+            instrument.count("bn.query.cache_hit")
+            self._cache.move_to_end(key)
+        else:
+            self.misses += 1
+            instrument.count("bn.query.cache_miss")
+            with instrument.phase("bn.query.engine"):
+                result = inference.query(list(variables), evidence, None, elimination_order,
+                                         joint, show_progress)
+            self._cache[key] = result
+            if len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        if joint:
+            return result.copy()
+        return {variable: factor.copy() for variable, factor in result.items()}
+
+    def cache_info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._cache))
+
+    def cache_clear(self):
+        """empties the cache and resets the counters."""
+        self._cache.clear()
+        self.hits = self.misses = 0
+
+
+def topological_order(variables, parents):
+    """returns variables ordered so that every variable comes after its
+    parents, keeping the given order where it is free. Raises ValueError
+    on a cycle."""
+    order, placed = [], set()
+    pending = list(variables)
+    while pending:
+        ready = [v for v in pending if all(p in placed for p in parents[v])]
+        if not ready:
+            raise ValueError(f"the parents of {', '.join(map(str, pending))} form a cycle")
+        order.extend(ready)
+        placed.update(ready)
+        pending = [v for v in pending if v not in placed]
+    return order
+
+
+# DiscreteNetwork - the variables, state names and CPT arrays of a
+# belief network, with variables in topological order. tables[v] has
+# axes (v, *parents[v]), like pgmpy's TabularCPD.values. Once to_model
+# has built the pgmpy model, that model is the one users change, so
+# current() re-reads the network after its CPDs or edges are replaced.
+
+class DiscreteNetwork:
+    def __init__(self, states, parents, tables):
+        """states, parents and tables are dicts keyed by variable."""
+        self.variables = topological_order(list(states), parents)
+        self.index = {variable: i for i, variable in enumerate(self.variables)}
+        self.states = {v: list(states[v]) for v in self.variables}
+        self.parents = {v: list(parents[v]) for v in self.variables}
+        self.tables = {v: tables[v] for v in self.variables}
+        self.cardinality = {v: len(self.states[v]) for v in self.variables}
+        self._model = None
+        self._fingerprint = None
+        self._cpds = []
+        self._current = None
+
+    @classmethod
+    def from_model(cls, model):
+        """reads the CPDs of a pgmpy BayesianNetwork."""
+        states, parents, tables = {}, {}, {}
+        for variable in model.nodes():
+            cpd = model.get_cpds(variable)
+            if cpd is None:
+                raise ValueError(f"no CPD for {variable}")
+            states[variable] = cpd.state_names[variable]
+            parents[variable] = cpd.variables[1:]
+            tables[variable] = numpy.asarray(cpd.values, dtype=float)
+        network = cls(states, parents, tables)
+        network._attach(model)
+        return network
+
+    def _attach(self, model):
+        self._model = model
+        self._fingerprint = model_fingerprint(model)
+        self._cpds = list(model.cpds)   # keeps the ids in the fingerprint unique
+
+    def to_model(self):
+        """returns the network as a pgmpy BayesianNetwork, built on the
+        first call."""
+        if self._model is None:
+            from pgmpy.factors.discrete import TabularCPD
+            from pgmpy.models import BayesianNetwork
+            model = BayesianNetwork([(p, v) for v in self.variables for p in self.parents[v]])
+            model.add_nodes_from(self.variables)
+            for v in self.variables:
+                family = [v] + self.parents[v]
+                model.add_cpds(TabularCPD(v, self.cardinality[v], self.tables[v].reshape(self.cardinality[v], -1),
+                                          evidence=self.parents[v] or None,
+                                          evidence_card=[self.cardinality[p] for p in self.parents[v]] or None,
+                                          state_names={u: self.states[u] for u in family}))
+            self._attach(model)
+        return self._model
+
+    def fingerprint(self):
+        """identifies the CPDs and edges of the pgmpy model as it is now
+        (None before to_model has built it)."""
+        return None if self._model is None else model_fingerprint(self._model)
+
+    def current(self):
+        """returns the network as its pgmpy model now stands: self, or a
+        network re-read from the model if CPDs or edges were replaced
+        since to_model built it."""
+        fingerprint = self.fingerprint()
+        if fingerprint == self._fingerprint:
+            return self
+        if self._current is None or self._current._fingerprint != fingerprint:
+            self._current = DiscreteNetwork.from_model(self._model)
+        return self._current
+
+    def ancestors(self, variables):
+        """returns the set of variables and all of their ancestors."""
+        found = set()
+        pending = list(variables)
+        while pending:
+            v = pending.pop()
+            if v not in found:
+                found.add(v)
+                pending.extend(self.parents[v])
+        return found
+
+    def state_index(self, variable, state):
+        """returns the position of state among variable's state names."""
+        try:
+            return self.states[variable].index(state)
+        except KeyError:
+            raise ValueError(f"unknown variable {variable!r}") from None
+        except ValueError:
+            raise ValueError(f"{variable} has no state {state!r}, expected one of {self.states[variable]}") from None
+
+    def evidence_codes(self, table):
+        """encodes an evidence table, either a pandas DataFrame with one
+        column per observed variable or a list of evidence dicts, as
+        (variables, (rows, variables) int array of state indexes). None
+        and NaN mark a variable that a row leaves unobserved (-1)."""
+        if hasattr(table, "columns"):
+            variables = list(table.columns)
+            columns = [list(table[v]) for v in variables]
+        else:
+            variables = sorted({v for row in table for v in row}, key=lambda v: self.index.get(v, -1))
+            columns = [[row.get(v) for row in table] for v in variables]
+        codes = numpy.full((len(columns[0]) if columns else len(table), len(variables)), -1, dtype=numpy.intp)
+        for j, (variable, column) in enumerate(zip(variables, columns)):
+            if variable not in self.index:
+                raise ValueError(f"unknown variable {variable!r}")
+            lookup = {state: i for i, state in enumerate(self.states[variable])}
+            for i, state in enumerate(column):
+                if state is None or state != state:
+                    continue
+                if state not in lookup:
+                    self.state_index(variable, state)  # raises with the valid states
+                codes[i, j] = lookup[state]
+        return variables, codes
+
+    @instrument.timed("bn.batch_query")
+    def batch_query(self, target, table):
+        """returns a (rows, states of target) array with P(target | row)
+        for every row of an evidence table (see evidence_codes). Identical
+        rows are evaluated once, and rows observing the same variables are
+        evaluated together as one einsum over the CPD arrays with a batch
+        axis. Rows whose evidence has probability zero get NaN."""
+        current = self.current()
+        if current is not self:
+            return current.batch_query(target, table)
+        if target not in self.index:
+            raise ValueError(f"unknown variable {target!r}")
+        variables, codes = self.evidence_codes(table)
+        patterns, inverse = numpy.unique(codes, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        instrument.count("bn.batch_query.rows", len(codes))
+        instrument.count("bn.batch_query.distinct_rows", len(patterns))
+        posteriors = numpy.empty((len(patterns), self.cardinality[target]))
+        observed = patterns >= 0
+        masks, group = numpy.unique(observed, axis=0, return_inverse=True)
+        for g, mask in enumerate(masks):
+            rows = numpy.flatnonzero(group.reshape(-1) == g)
+            given = [v for v, seen in zip(variables, mask) if seen]
+            operands = [(numpy.ones(len(rows)), [_BATCH])]
+            for v, seen in zip(variables, mask):
+                if seen:
+                    indicator = numpy.zeros((len(rows), self.cardinality[v]))
+                    indicator[numpy.arange(len(rows)), patterns[rows, variables.index(v)]] = 1.0
+                    operands.append((indicator, [_BATCH, v]))
+            # nodes that are neither the target, observed, nor an ancestor
+            # of either sum out to one, so their CPDs are left out
+            relevant = self.ancestors([target, *given])
+            for v in self.variables:
+                if v in relevant:
+                    operands.append((self.tables[v], [v] + self.parents[v]))
+            joint = _contract(operands, [_BATCH, target], optimize=True)
+            total = joint.sum(axis=1, keepdims=True)
+            with numpy.errstate(invalid='ignore', divide='ignore'):
+                posteriors[rows] = numpy.where(total > 0, joint / total, numpy.nan)
+        return posteriors[inverse]
+
+    def factor(self, variables, values):
+        """wraps an array with axes in the order of variables as a pgmpy
+        DiscreteFactor."""
+        from pgmpy.factors.discrete import DiscreteFactor
+        return DiscreteFactor(list(variables), [self.cardinality[v] for v in variables], values,
+                              state_names={v: self.states[v] for v in variables})
+
+
+# einsum label for the batch axis of batch_query
+_BATCH = ("batch",)
+
+
+def as_network(model):
+    """returns model as a DiscreteNetwork, reading it if it is a pgmpy
+    BayesianNetwork, and as its pgmpy model now stands if it is one."""
+    return model.current() if isinstance(model, DiscreteNetwork) else DiscreteNetwork.from_model(model)
+
+
+def batch_query(model, target, table):
+    """P(target | evidence) for every row of an evidence table over a
+    pgmpy model or DiscreteNetwork; see DiscreteNetwork.batch_query."""
+    return as_network(model).batch_query(target, table)
+
+
+def _contract(operands, output, optimize=False):
+    """einsum over (array, variable names) pairs, keeping the output
+    variables in that order; labels are numbered per call."""
+    labels = {}
+    args = []
+    for array, axes in operands:
+        args += [array, [labels.setdefault(v, len(labels)) for v in axes]]
+    args.append([labels[v] for v in output])
+    return numpy.einsum(*args, optimize=optimize)
+
+
+def _triangulate(network):
+    """eliminates the variables of the moral graph by min-fill (ties by
+    degree, then topological position) and returns the maximal cliques
+    of the resulting chordal graph."""
+    graph = {v: set() for v in network.variables}
+    for variable in network.variables:
+        family = [variable] + network.parents[variable]
+        for a, b in itertools.combinations(family, 2):
+            graph[a].add(b)
+            graph[b].add(a)
+
+    def fill_in(v):
+        return sum(1 for a, b in itertools.combinations(graph[v], 2) if b not in graph[a])
+
+    cliques = []
+    while graph:
+        v = min(graph, key=lambda v: (fill_in(v), len(graph[v]), network.index[v]))
+        neighbours = graph.pop(v)
+        cliques.append(frozenset(neighbours | {v}))
+        for a, b in itertools.combinations(neighbours, 2):
+            graph[a].add(b)
+            graph[b].add(a)
+        for n in neighbours:
+            graph[n].discard(v)
+    maximal = []
+    for clique in cliques:
+        if not any(clique <= other for other in maximal) and not any(clique < other for other in cliques):
+            maximal.append(clique)
+    return maximal
+
+
+# JunctionTree - exact inference by message passing on a clique tree that
+# is built once from the model. Each evidence set costs one calibration
+# (a collect and a distribute pass), after which every marginal is a sum
+# over a single clique. model is a DiscreteNetwork or a pgmpy model; like
+# CachedInference, the tree is rebuilt when the CPDs or edges of the
+# pgmpy model (for a DiscreteNetwork, the one to_model built) change.
+
+class JunctionTree:
+    def __init__(self, model):
+        self.model = model
+        self._fingerprint = None
+        self.compile()
+
+    def _model_fingerprint(self):
+        if isinstance(self.model, DiscreteNetwork):
+            return self.model.fingerprint()
+        return model_fingerprint(self.model)
+
+    def compile(self):
+        """triangulates the moral graph, joins the maximal cliques into a
+        maximum-sepset spanning tree and multiplies every CPD into one
+        clique that holds its family."""
+        self._fingerprint = self._model_fingerprint()
+        network = self.network = as_network(self.model)
+        self._cpds = list(network._model.cpds) if network._model is not None else []
+        order = network.index.get
+        self.cliques = [sorted(clique, key=order) for clique in _triangulate(network)]
+
+        # Kruskal on sepset size; empty sepsets join separate components
+        pairs = sorted(itertools.combinations(range(len(self.cliques)), 2),
+                       key=lambda p: -len(set(self.cliques[p[0]]) & set(self.cliques[p[1]])))
+        component = list(range(len(self.cliques)))
+
+        def find(i):
+            while component[i] != i:
+                component[i] = component[component[i]]
+                i = component[i]
+            return i
+
+        neighbours = [[] for _ in self.cliques]
+        for a, b in pairs:
+            if find(a) != find(b):
+                component[find(a)] = find(b)
+                neighbours[a].append(b)
+                neighbours[b].append(a)
+
+        # root at clique 0; order lists every clique after its parent
+        self.parent = [None] * len(self.cliques)
+        self.children = [[] for _ in self.cliques]
+        self.order = [0]
+        for c in self.order:
+            for n in neighbours[c]:
+                if n != self.parent[c] and n != 0 and self.parent[n] is None:
+                    self.parent[n] = c
+                    self.children[c].append(n)
+                    self.order.append(n)
+        self.sepsets = [None if p is None else [v for v in self.cliques[c] if v in self.cliques[p]]
+                        for c, p in enumerate(self.parent)]
+
+        # each variable is read from (and observed in) its smallest clique
+        self.home = {}
+        for c in sorted(range(len(self.cliques)), key=lambda c: len(self.cliques[c]), reverse=True):
+            for v in self.cliques[c]:
+                self.home[v] = c
+        self.potentials = []
+        for clique in self.cliques:
+            shape = [network.cardinality[v] for v in clique]
+            self.potentials.append(numpy.ones(shape))
+        for variable in network.variables:
+            family = [variable] + network.parents[variable]
+            c = next(c for c, clique in enumerate(self.cliques) if set(family) <= set(clique))
+            self.potentials[c] = _contract([(self.potentials[c], self.cliques[c]),
+                                            (network.tables[variable], family)], self.cliques[c])
+
+    @instrument.timed("bn.jt.calibrate")
+    def calibrate(self, evidence=None):
+        """runs one collect and one distribute pass with evidence (a dict
+        of variable -> state name) entered. Returns (clique beliefs, each
+        normalized to sum to one, probability of the evidence)."""
+        if self._model_fingerprint() != self._fingerprint:
+            with instrument.phase("bn.jt.compile"):
+                self.compile()
+        network = self.network
+        potentials = list(self.potentials)
+        for variable, state in (evidence or {}).items():
+            indicator = numpy.zeros(network.cardinality.get(variable, 0))
+            indicator[network.state_index(variable, state)] = 1.0
+            c = self.home[variable]
+            potentials[c] = _contract([(potentials[c], self.cliques[c]), (indicator, [variable])],
+                                      self.cliques[c])
+
+        up = [None] * len(self.cliques)
+        for c in reversed(self.order[1:]):
+            up[c] = _contract([(potentials[c], self.cliques[c])]
+                              + [(up[child], self.sepsets[child]) for child in self.children[c]],
+                              self.sepsets[c])
+        down = [None] * len(self.cliques)
+        beliefs = [None] * len(self.cliques)
+        for c in self.order:
+            incoming = [(up[child], self.sepsets[child]) for child in self.children[c]]
+            if down[c] is not None:
+                incoming.append((down[c], self.sepsets[c]))
+            beliefs[c] = _contract([(potentials[c], self.cliques[c])] + incoming, self.cliques[c])
+            for i, child in enumerate(self.children[c]):
+                others = incoming[:i] + incoming[i + 1:]
+                down[child] = _contract([(potentials[c], self.cliques[c])] + others, self.sepsets[child])
+        probability = float(beliefs[0].sum())
+        if probability <= 0:
+            raise ValueError(f"evidence {evidence} has probability zero")
+        return [belief / belief.sum() for belief in beliefs], probability
+
+    def probabilities(self, evidence=None, variables=None):
+        """returns {variable: array of state probabilities} with the
+        posterior of every variable (or of the given ones) after a single
+        calibration. Observed variables get a point mass on their observed
+        state."""
+        beliefs, _ = self.calibrate(evidence)
+        result = {}
+        for variable in variables or self.network.variables:
+            c = self.home[variable]
+            axes = tuple(i for i, v in enumerate(self.cliques[c]) if v != variable)
+            result[variable] = beliefs[c].sum(axis=axes)
+        return result
+
+    def marginals(self, evidence=None, variables=None):
+        """probabilities as pgmpy DiscreteFactors."""
+        return {variable: self.network.factor([variable], values)
+                for variable, values in self.probabilities(evidence, variables).items()}
+
+    def query(self, variables, evidence=None):
+        """the joint posterior of variables as a DiscreteFactor, like
+        VariableElimination.query. The variables must all lie in one
+        clique, which always holds for a single variable or a family."""
+        variables = list(variables)
+        beliefs, _ = self.calibrate(evidence)
+        for c, clique in enumerate(self.cliques):
+            if set(variables) <= set(clique):
+                return self.network.factor(variables, _contract([(beliefs[c], clique)], variables))
+        raise ValueError(f"{variables} do not share a clique; use VariableElimination for this query")
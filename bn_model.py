@@ -0,0 +1,177 @@
+import itertools
+import os
+import shlex
+import numpy
+import array_cache
+import instrument
+from bn_inference import DiscreteNetwork, topological_order
+
+# Belief networks stored as text, in the spirit of the HMM .trans/.emit
+# files. A .bn file has one declaration per line:
+#   variable NAME STATE STATE ...          the states of NAME, in order
+#   parents NAME PARENT PARENT ...         its parents (omitted for a root)
+#   prob NAME [PARENT STATES ...] P P ...  one CPT row: P(NAME = each state)
+#                                          given the parents in those states
+# Lines are split like a shell command line, so names with spaces or
+# quotes go in double quotes, and # starts a comment. Declarations may
+# come in any order.
+#
+# load_network checks the structure (known names, no cycles, exactly one
+# row per parent configuration) and that every row is a distribution, and
+# with cache=True keeps the CPT arrays in a binary .bnc file beside the
+# source (an array_cache container), so a later load maps them in
+# without parsing.
+
+TOLERANCE = 1e-6
+
+CACHE_SUFFIX = ".bnc"
+CACHE_MAGIC = b"BNCACHE\x02"
+
+
+def _quote(name):
+    if name and all(c.isalnum() or c in "_-.,:/+=<>" for c in name):
+        return name
+    return '"' + name.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def parse_network(path):
+    """reads a .bn file and returns the validated DiscreteNetwork.
+    Problems are reported as ValueError("path:line: ...")."""
+    states, parents, rows = {}, {}, {}
+    where = {}
+    with open(path, 'r') as f:
+        for lineno, line in enumerate(f, 1):
+            try:
+                tokens = shlex.split(line, comments=True)
+            except ValueError as error:
+                raise ValueError(f"{path}:{lineno}: {error}") from None
+            if not tokens:
+                continue
+            keyword, args = tokens[0], tokens[1:]
+            if not args:
+                raise ValueError(f"{path}:{lineno}: {keyword} without a variable name")
+            name = args[0]
+            if keyword == "variable":
+                if name in states:
+                    raise ValueError(f"{path}:{lineno}: {name} already declared on line {where[name]}")
+                if len(args) < 2 or len(set(args[1:])) != len(args) - 1:
+                    raise ValueError(f"{path}:{lineno}: {name} needs distinct state names")
+                states[name] = args[1:]
+                where[name] = lineno
+            elif keyword == "parents":
+                if name in parents:
+                    raise ValueError(f"{path}:{lineno}: second parents line for {name}")
+                parents[name] = (args[1:], lineno)
+            elif keyword == "prob":
+                rows.setdefault(name, []).append((args[1:], lineno))
+            else:
+                raise ValueError(f"{path}:{lineno}: unknown declaration {keyword!r}")
+
+    for name, (names, lineno) in parents.items():
+        for v in [name] + names:
+            if v not in states:
+                raise ValueError(f"{path}:{lineno}: undeclared variable {v}")
+        if len(set(names)) != len(names) or name in names:
+            raise ValueError(f"{path}:{lineno}: repeated parent of {name}")
+    parents = {v: parents[v][0] if v in parents else [] for v in states}
+    try:
+        topological_order(list(states), parents)
+    except ValueError as error:
+        raise ValueError(f"{path}: {error}") from None
+    for name, name_rows in rows.items():
+        if name not in states:
+            raise ValueError(f"{path}:{name_rows[0][1]}: prob for undeclared variable {name}")
+
+    tables = {}
+    for name in states:
+        shape = [len(states[name])] + [len(states[p]) for p in parents[name]]
+        table = numpy.full(shape, numpy.nan)
+        lookups = [{state: i for i, state in enumerate(states[p])} for p in parents[name]]
+        for args, lineno in rows.get(name, []):
+            if len(args) != len(shape) - 1 + shape[0]:
+                raise ValueError(f"{path}:{lineno}: expected {len(shape) - 1} parent states and "
+                                 f"{shape[0]} probabilities for {name}, got {len(args)} values")
+            configuration = []
+            for parent, lookup, state in zip(parents[name], lookups, args):
+                if state not in lookup:
+                    raise ValueError(f"{path}:{lineno}: {parent} has no state {state!r}")
+                configuration.append(lookup[state])
+            try:
+                probabilities = [float(p) for p in args[len(configuration):]]
+            except ValueError as error:
+                raise ValueError(f"{path}:{lineno}: {error}") from None
+            if any(not p >= 0 for p in probabilities) or abs(sum(probabilities) - 1) > TOLERANCE:
+                raise ValueError(f"{path}:{lineno}: probabilities for {name} are not a distribution")
+            index = (slice(None),) + tuple(configuration)
+            if not numpy.isnan(table[index]).all():
+                raise ValueError(f"{path}:{lineno}: repeated row for {name}")
+            table[index] = probabilities
+        if numpy.isnan(table).any():
+            missing = next(c for c in itertools.product(*(range(n) for n in shape[1:]))
+                           if numpy.isnan(table[(slice(None),) + c]).all())
+            given = ", ".join(f"{p}={states[p][i]}" for p, i in zip(parents[name], missing))
+            raise ValueError(f"{path}: no prob row for {name}" + (f" given {given}" if given else ""))
+        tables[name] = table
+    return DiscreteNetwork(states, parents, tables)
+
+
+def write_network(network, path):
+    """writes a DiscreteNetwork (or pgmpy model) as a .bn file."""
+    if not isinstance(network, DiscreteNetwork):
+        network = DiscreteNetwork.from_model(network)
+    with open(path, 'w') as f:
+        for v in network.variables:
+            f.write(" ".join(["variable", _quote(v)] + [_quote(s) for s in network.states[v]]) + "\n")
+            if network.parents[v]:
+                f.write(" ".join(["parents", _quote(v)] + [_quote(p) for p in network.parents[v]]) + "\n")
+            table = network.tables[v]
+            for configuration in itertools.product(*(range(n) for n in table.shape[1:])):
+                given = [_quote(network.states[p][i]) for p, i in zip(network.parents[v], configuration)]
+                probabilities = [repr(float(x)) for x in table[(slice(None),) + configuration]]
+                f.write(" ".join(["prob", _quote(v)] + given + probabilities) + "\n")
+            f.write("\n")
+
+
+def _cache_path(path):
+    return os.path.splitext(path)[0] + CACHE_SUFFIX
+
+
+def write_cache(network, path):
+    """writes the tables of network to the .bnc file for the .bn file at
+    path, stamped with that file's current state. Returns False if the
+    cache could not be written."""
+    arrays = {v: numpy.asarray(network.tables[v], dtype="<f8") for v in network.variables}
+    return array_cache.write(_cache_path(path), CACHE_MAGIC, arrays, {"bn": path},
+                             {"states": network.states, "parents": network.parents})
+
+
+def read_cache(path):
+    """returns the DiscreteNetwork cached for the .bn file at path, or
+    None if there is no usable cache or the file changed since it was
+    written. The tables are read-only views of the mapped file."""
+    cached = array_cache.read(_cache_path(path), CACHE_MAGIC, {"bn": path})
+    if cached is None:
+        return None
+    header, tables = cached
+    try:
+        return DiscreteNetwork(header["states"], header["parents"], tables)
+    except (KeyError, ValueError):
+        return None
+
+
+def load_network(path, cache=False):
+    """returns the DiscreteNetwork in the .bn file at path. With cache,
+    it comes from the .bnc file when that is up to date, and the .bnc file
+    is (re)written after parsing when it is not."""
+    if cache:
+        with instrument.phase("bn.load.cache"):
+            network = read_cache(path)
+        instrument.count("bn.load.cache_miss" if network is None else "bn.load.cache_hit")
+        if network is not None:
+            return network
+    with instrument.phase("bn.load.parse"):
+        network = parse_network(path)
+    if cache:
+        with instrument.phase("bn.load.write_cache"):
+            write_cache(network, path)
+    return network
@@ -0,0 +1,222 @@
+from collections import namedtuple
+import contextlib
+import numpy
+import worker_pool
+from bn_inference import as_network
+
+# Approximate inference for belief networks (pgmpy BayesianNetworks or
+# DiscreteNetworks) too large for exact elimination. Both engines draw
+# many samples at once with numpy, split the work over a process pool
+# (worker_pool.model_pool), and keep sampling until the standard error of every
+# requested marginal is below tolerance.
+#   likelihood_weighting - forward samples with the evidence clamped,
+#                          weighted by the probability of the evidence.
+#   gibbs                - independent Gibbs chains started from
+#                          likelihood-weighted samples.
+# A run is repeatable for a fixed seed, workers and batch settings.
+
+# marginals maps each variable to a DiscreteFactor, errors to the array
+# of standard errors of its probabilities, and samples counts the
+# weighted samples (likelihood weighting) or chain sweeps (gibbs) used.
+Estimate = namedtuple("Estimate", ["marginals", "errors", "samples"])
+
+
+# NetworkSampler - the CPT arrays of a DiscreteNetwork, laid out for
+# drawing a whole batch of assignments at once. States are rows of an
+# (n, variables) int array, with columns in topological order.
+
+class NetworkSampler:
+    def __init__(self, network):
+        self.network = network
+        self.parents = []
+        self.children = []
+        self.cumulative = []
+        self.log_tables = []
+        for variable in network.variables:
+            table = network.tables[variable]
+            self.parents.append([network.index[p] for p in network.parents[variable]])
+            # state last, so indexing by the parents' columns gives (n, card)
+            self.cumulative.append(numpy.cumsum(numpy.moveaxis(table, 0, -1), axis=-1))
+            with numpy.errstate(divide='ignore'):
+                self.log_tables.append(numpy.log(table))
+        for j in range(len(network.variables)):
+            self.children.append([c for c, parents in enumerate(self.parents) if j in parents])
+
+    def encode(self, evidence):
+        """maps an evidence dict of state names to {column: state index}."""
+        return {self.network.index[v]: self.network.state_index(v, state)
+                for v, state in (evidence or {}).items()}
+
+    def _draw(self, cumulative, rng, n):
+        u = rng.random(n)[:, None] * cumulative[..., -1:]
+        # states with zero probability add nothing to the cumulative sum
+        # and so are never picked
+        return numpy.minimum((cumulative <= u).sum(axis=-1), cumulative.shape[-1] - 1)
+
+    def _log_cpd(self, j, samples):
+        """log P(column j | its parents) for every row of samples."""
+        index = (samples[:, j],) + tuple(samples[:, p] for p in self.parents[j])
+        return self.log_tables[j][index]
+
+    def likelihood_weighted(self, evidence, n, rng):
+        """draws n assignments with the evidence ({column: state}) fixed.
+        Returns (samples, log weights), the weight being the probability
+        of the evidence given each sample's other values."""
+        samples = numpy.empty((n, len(self.parents)), dtype=numpy.intp)
+        log_weights = numpy.zeros(n)
+        for j, parents in enumerate(self.parents):
+            if j in evidence:
+                samples[:, j] = evidence[j]
+                log_weights += self._log_cpd(j, samples)
+            else:
+                cumulative = self.cumulative[j][tuple(samples[:, p] for p in parents)]
+                samples[:, j] = self._draw(numpy.broadcast_to(cumulative, (n, cumulative.shape[-1])), rng, n)
+        return samples, log_weights
+
+    def gibbs_sweeps(self, evidence, chains, sweeps, burn_in, rng):
+        """runs chains Gibbs chains side by side for burn_in + sweeps
+        sweeps, resampling every unobserved column from its Markov blanket.
+        Returns a list with one (chains, card) int64 array per column,
+        counting the states each chain visited after burn-in. Zero entries
+        in the CPTs can split the state space into parts that single-site
+        moves never cross."""
+        start, log_weights = self.likelihood_weighted(evidence, 64 * chains, rng)
+        possible = numpy.flatnonzero(log_weights > -numpy.inf)
+        if len(possible) == 0:
+            raise ValueError("could not find a state consistent with the evidence")
+        state = start[rng.choice(possible, chains)]
+        free = [j for j in range(len(self.parents)) if j not in evidence]
+        counts = [numpy.zeros((chains, cumulative.shape[-1]), dtype=numpy.int64) for cumulative in self.cumulative]
+        rows = numpy.arange(chains)
+        for sweep in range(burn_in + sweeps):
+            for j in free:
+                card = self.cumulative[j].shape[-1]
+                logits = numpy.empty((chains, card))
+                for x in range(card):
+                    state[:, j] = x
+                    logits[:, x] = self._log_cpd(j, state)
+                    for c in self.children[j]:
+                        logits[:, x] += self._log_cpd(c, state)
+                logits -= logits.max(axis=1, keepdims=True)
+                state[:, j] = self._draw(numpy.cumsum(numpy.exp(logits), axis=1), rng, chains)
+            if sweep >= burn_in:
+                for j, count in enumerate(counts):
+                    count[rows, state[:, j]] += 1
+        return counts
+
+
+def _weighted_counts(sampler, evidence, columns, n, seed):
+    samples, log_weights = sampler.likelihood_weighted(evidence, n, numpy.random.default_rng(seed))
+    shift = log_weights.max()
+    if shift == -numpy.inf:
+        return shift, [numpy.zeros(sampler.cumulative[j].shape[-1]) for j in columns], 0.0, 0.0
+    weights = numpy.exp(log_weights - shift)
+    counts = [numpy.bincount(samples[:, j], weights, minlength=sampler.cumulative[j].shape[-1])
+              for j in columns]
+    return shift, counts, weights.sum(), (weights ** 2).sum()
+
+
+def _chain_frequencies(sampler, evidence, columns, chains, sweeps, burn_in, seed):
+    counts = sampler.gibbs_sweeps(evidence, chains, sweeps, burn_in, numpy.random.default_rng(seed))
+    return [counts[j] / sweeps for j in columns]
+
+
+@contextlib.contextmanager
+def _runner(sampler, workers):
+    """yields run(task, args, seeds), which calls task(sampler, *args,
+    seed) once per seed and returns the results in seed order. With
+    workers > 1 the calls go to one process pool kept for the whole run."""
+    if workers <= 1:
+        yield lambda task, args, seeds: [task(sampler, *args, seed) for seed in seeds]
+        return
+    with worker_pool.model_pool(sampler, workers) as pool:
+        def run(task, args, seeds):
+            results = [worker_pool.submit(pool, task, *args, seed) for seed in seeds]
+            return [result.get() for result in results]
+        yield run
+
+
+def _binomial_error(p, n):
+    """standard error of a proportion p seen in n samples, with p pulled
+    towards 1/2 by one pseudo-count each way so that states not seen yet
+    do not look certain."""
+    p = (p * n + 1) / (n + 2)
+    return numpy.sqrt(p * (1 - p) / n)
+
+
+def _estimate(network, variables, probabilities, errors, samples):
+    return Estimate({v: network.factor([v], p) for v, p in zip(variables, probabilities)},
+                    dict(zip(variables, errors)), samples)
+
+
+def likelihood_weighting(model, variables, evidence=None, tolerance=0.005, batch_size=10000,
+                         max_samples=1000000, workers=1, seed=None):
+    """estimates P(v | evidence) for each of variables by likelihood
+    weighting. Rounds of workers batches of batch_size samples run until
+    every probability's standard error, sqrt(p (1 - p) / effective sample
+    size), is below tolerance, or max_samples samples have been drawn."""
+    network = as_network(model)
+    sampler = NetworkSampler(network)
+    encoded = sampler.encode(evidence)
+    columns = [network.index[v] for v in variables]
+    seeds = numpy.random.SeedSequence(seed)
+    workers = max(workers, 1)
+    # weights are kept relative to exp(shift), the largest weight seen
+    shift, counts, total, squares, n = -numpy.inf, None, 0.0, 0.0, 0
+    with _runner(sampler, workers) as run:
+        while n < max_samples:
+            for part in run(_weighted_counts, (encoded, columns, batch_size), seeds.spawn(workers)):
+                part_shift, part_counts, part_total, part_squares = part
+                if part_shift == -numpy.inf:
+                    continue
+                if counts is None:
+                    shift, counts, total, squares = part
+                    continue
+                new_shift = max(shift, part_shift)
+                old, new = numpy.exp(shift - new_shift), numpy.exp(part_shift - new_shift)
+                counts = [c * old + p * new for c, p in zip(counts, part_counts)]
+                total = total * old + part_total * new
+                squares = squares * old ** 2 + part_squares * new ** 2
+                shift = new_shift
+            n += workers * batch_size
+            if total > 0:
+                probabilities = [c / total for c in counts]
+                effective = total ** 2 / squares
+                errors = [_binomial_error(p, effective) for p in probabilities]
+                if max(e.max() for e in errors) < tolerance:
+                    break
+    if total == 0:
+        raise ValueError(f"no sample is consistent with evidence {evidence}")
+    return _estimate(network, variables, probabilities, errors, n)
+
+
+def gibbs(model, variables, evidence=None, tolerance=0.01, chains=256, sweeps=200, burn_in=50,
+          max_chains=8192, workers=1, seed=None):
+    """estimates P(v | evidence) for each of variables with Gibbs
+    sampling. Each round runs workers groups of chains independent chains,
+    and the estimate averages the chains. Its standard error is the
+    spread of the per-chain estimates over sqrt(number of chains), but no
+    less than the binomial error of all sweeps pooled. Rounds run until
+    that is below tolerance or max_chains chains have run."""
+    network = as_network(model)
+    sampler = NetworkSampler(network)
+    encoded = sampler.encode(evidence)
+    columns = [network.index[v] for v in variables]
+    seeds = numpy.random.SeedSequence(seed)
+    workers = max(workers, 1)
+    frequencies = [[] for _ in variables]
+    n_chains = 0
+    with _runner(sampler, workers) as run:
+        while n_chains < max_chains:
+            for part in run(_chain_frequencies, (encoded, columns, chains, sweeps, burn_in), seeds.spawn(workers)):
+                for collected, chain_frequencies in zip(frequencies, part):
+                    collected.append(chain_frequencies)
+            n_chains += workers * chains
+            per_chain = [numpy.concatenate(collected) for collected in frequencies]
+            probabilities = [f.mean(axis=0) for f in per_chain]
+            errors = [numpy.maximum(f.std(axis=0, ddof=1) / numpy.sqrt(len(f)),
+                                    _binomial_error(p, len(f) * sweeps))
+                      for f, p in zip(per_chain, probabilities)]
+            if max(e.max() for e in errors) < tolerance:
+                break
+    return _estimate(network, variables, probabilities, errors, n_chains * sweeps)
@@ -0,0 +1,207 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+import pandas
+from pgmpy.factors.discrete import TabularCPD
+from pgmpy.inference import VariableElimination
+import alarm
+import carnet
+import instrument
+import bn_inference
+import bn_model
+import bn_sampling
+
+
+class TestCachedInference(unittest.TestCase):
+    def test_matches_variable_elimination(self):
+        exact = VariableElimination(carnet.car_model)
+        cached = bn_inference.CachedInference(carnet.car_model)
+        for variables, evidence in [(["Battery"], {"Moves": "no"}),
+                                    (["Starts"], {"Radio": "turns on", "Gas": "Full"}),
+                                    (["Ignition", "Gas"], {"Moves": "no"})]:
+            expected = exact.query(variables, evidence, show_progress=False)
+            self.assertEqual(cached.query(variables, evidence), expected)
+
+    def test_hits_misses_and_eviction(self):
+        infer = bn_inference.CachedInference(alarm.alarm_model, maxsize=2)
+        infer.query(["JohnCalls", "MaryCalls"], {"Burglary": "yes", "Earthquake": "no"})
+        infer.query(["MaryCalls", "JohnCalls"], {"Earthquake": "no", "Burglary": "yes"})
+        self.assertEqual(infer.cache_info(), bn_inference.CacheInfo(1, 1, 2, 1))
+        infer.query(["Alarm"], {"MaryCalls": "yes"})
+        infer.query(["Alarm"], {"JohnCalls": "yes"})
+        self.assertEqual(infer.cache_info().currsize, 2)
+        infer.query(["JohnCalls", "MaryCalls"], {"Burglary": "yes", "Earthquake": "no"})
+        self.assertEqual(infer.cache_info().misses, 4)
+
+    def test_instrumented_queries(self):
+        instrument.reset()
+        instrument.enable()
+        self.addCleanup(instrument.reset)
+        self.addCleanup(instrument.disable)
+        infer = bn_inference.CachedInference(alarm.alarm_network)
+        for _ in range(3):
+            infer.query(["Alarm"], {"MaryCalls": "yes"})
+        stats = instrument.snapshot()
+        self.assertEqual(stats["counters"]["bn.query.cache_miss"], 1)
+        self.assertEqual(stats["counters"]["bn.query.cache_hit"], 2)
+        self.assertEqual(stats["phases"]["bn.query"]["count"], 3)
+        self.assertEqual(stats["phases"]["bn.query.engine"]["count"], 1)
+        self.assertEqual(stats["phases"]["bn.query.engine_build"]["count"], 1)
+
+    def test_results_are_copies(self):
+        infer = bn_inference.CachedInference(alarm.alarm_model)
+        first = infer.query(["Alarm"], {"MaryCalls": "yes"})
+        first.values[:] = 0
+        second = infer.query(["Alarm"], {"MaryCalls": "yes"})
+        self.assertAlmostEqual(second.values.sum(), 1.0)
+
+    def test_add_cpds_invalidates(self):
+        model = alarm.alarm_model.copy()
+        infer = bn_inference.CachedInference(model)
+        before = infer.query(["Burglary"])
+        model.add_cpds(TabularCPD(variable="Burglary", variable_card=2, values=[[0.5], [0.5]],
+                                  state_names={"Burglary": ["no", "yes"]}))
+        after = infer.query(["Burglary"])
+        self.assertEqual(infer.cache_info().misses, 2)
+        numpy.testing.assert_allclose(after.values, [0.5, 0.5])
+        self.assertNotEqual(before, after)
+
+
+class TestJunctionTree(unittest.TestCase):
+    def test_marginals_match_variable_elimination(self):
+        exact = VariableElimination(carnet.car_model)
+        for evidence in [{}, {"Moves": "no"}, {"Radio": "turns on", "Gas": "Full"},
+                         {"Moves": "no", "Gas": "Empty"}]:
+            marginals = carnet.car_tree.marginals(evidence)
+            self.assertEqual(set(marginals), set(carnet.car_model.nodes()))
+            for variable, factor in marginals.items():
+                if variable in evidence:
+                    self.assertAlmostEqual(factor.get_value(**{variable: evidence[variable]}), 1.0)
+                    continue
+                expected = exact.query([variable], evidence, show_progress=False)
+                numpy.testing.assert_allclose(factor.values, expected.values, atol=1e-12)
+
+    def test_query_and_impossible_evidence(self):
+        exact = VariableElimination(alarm.alarm_model)
+        joint = alarm.alarm_tree.query(["Burglary", "Earthquake"], {"JohnCalls": "yes"})
+        expected = exact.query(["Burglary", "Earthquake"], {"JohnCalls": "yes"}, show_progress=False)
+        numpy.testing.assert_allclose(joint.values, expected.values, atol=1e-12)
+        with self.assertRaises(ValueError):
+            carnet.car_tree.marginals({"Starts": "yes", "Ignition": "Works", "Gas": "Empty", "KeyPresent": "no"})
+        with self.assertRaises(ValueError):
+            alarm.alarm_tree.marginals({"Alarm": "maybe"})
+
+    def test_follows_changes_to_the_module_model(self):
+        model = carnet.car_model
+        original = model.get_cpds("Gas")
+        self.addCleanup(model.add_cpds, original)
+        numpy.testing.assert_allclose(carnet.car_tree.probabilities()["Gas"], [0.4, 0.6])
+        model.add_cpds(TabularCPD(variable="Gas", variable_card=2, values=[[0.9], [0.1]],
+                                  state_names={"Gas": ["Full", "Empty"]}))
+        numpy.testing.assert_allclose(carnet.car_infer.query(["Gas"]).values, [0.9, 0.1])
+        numpy.testing.assert_allclose(carnet.car_tree.probabilities()["Gas"], [0.9, 0.1])
+        numpy.testing.assert_allclose(bn_inference.batch_query(carnet.car_network, "Gas", [{}]), [[0.9, 0.1]])
+        model.add_cpds(original)
+        numpy.testing.assert_allclose(carnet.car_tree.probabilities()["Gas"], [0.4, 0.6])
+        numpy.testing.assert_allclose(carnet.car_network.batch_query("Gas", [{}]), [[0.4, 0.6]])
+
+
+class TestBatchQuery(unittest.TestCase):
+    def test_matches_single_queries(self):
+        table = pandas.DataFrame({"Radio": ["turns on", None, "Doesn't turn on", "turns on"],
+                                  "Gas": ["Full", "Empty", None, "Full"],
+                                  "Moves": ["no", "no", None, "no"]})
+        posteriors = bn_inference.batch_query(carnet.car_model, "Battery", table)
+        self.assertEqual(posteriors.shape, (4, 2))
+        exact = VariableElimination(carnet.car_model)
+        for row, posterior in zip(table.to_dict("records"), posteriors):
+            evidence = {v: state for v, state in row.items() if isinstance(state, str)}
+            expected = exact.query(["Battery"], evidence, show_progress=False)
+            numpy.testing.assert_allclose(posterior, expected.values, atol=1e-12)
+
+    def test_dict_rows_and_impossible_evidence(self):
+        network = bn_inference.DiscreteNetwork.from_model(carnet.car_model)
+        posteriors = network.batch_query("Starts", [
+            {"Ignition": "Works", "Gas": "Empty", "KeyPresent": "no", "Moves": "yes", "Starts": "yes"},
+            {}])
+        self.assertTrue(numpy.isnan(posteriors[0]).all())
+        numpy.testing.assert_allclose(posteriors[1], carnet.car_tree.marginals()["Starts"].values)
+        with self.assertRaises(ValueError):
+            network.batch_query("Starts", [{"Gas": "Half"}])
+
+
+class TestSampling(unittest.TestCase):
+    def assertCloseToExact(self, estimate, exact):
+        for variable, factor in estimate.marginals.items():
+            bound = 4 * estimate.errors[variable] + 1e-3
+            self.assertTrue((abs(factor.values - exact[variable].values) < bound).all(),
+                            f"{variable}: {factor.values} vs {exact[variable].values}")
+
+    def test_likelihood_weighting(self):
+        evidence = {"JohnCalls": "yes", "MaryCalls": "yes"}
+        estimate = bn_sampling.likelihood_weighting(alarm.alarm_model, ["Burglary", "Alarm"], evidence,
+                                                    tolerance=0.005, seed=3)
+        self.assertTrue(all(e.max() < 0.005 for e in estimate.errors.values()))
+        self.assertCloseToExact(estimate, alarm.alarm_tree.marginals(evidence))
+        again = bn_sampling.likelihood_weighting(alarm.alarm_model, ["Burglary", "Alarm"], evidence,
+                                                 tolerance=0.005, seed=3)
+        numpy.testing.assert_array_equal(again.marginals["Alarm"].values, estimate.marginals["Alarm"].values)
+        parallel = bn_sampling.likelihood_weighting(carnet.car_model, ["Battery", "KeyPresent"], {"Moves": "no"},
+                                                    tolerance=0.005, workers=2, seed=0)
+        self.assertCloseToExact(parallel, carnet.car_tree.marginals({"Moves": "no"}))
+
+    def test_gibbs(self):
+        evidence = {"Radio": "turns on", "Gas": "Full"}
+        estimate = bn_sampling.gibbs(carnet.car_model, ["Battery", "Starts", "Moves"], evidence,
+                                     tolerance=0.005, seed=0)
+        self.assertCloseToExact(estimate, carnet.car_tree.marginals(evidence))
+        with self.assertRaises(ValueError):
+            bn_sampling.gibbs(carnet.car_model, ["Battery"],
+                              {"Starts": "yes", "Ignition": "Works", "Gas": "Empty", "KeyPresent": "no"})
+
+
+class TestModelFiles(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def write(self, text):
+        path = os.path.join(self.directory, "net.bn")
+        with open(path, "w") as f:
+            f.write(text)
+        return path
+
+    def test_round_trip_and_cache(self):
+        path = os.path.join(self.directory, "carnet.bn")
+        shutil.copy("carnet.bn", path)
+        parsed = bn_model.load_network(path, cache=True)
+        self.assertTrue(os.path.exists(os.path.join(self.directory, "carnet.bnc")))
+        cached = bn_model.read_cache(path)
+        self.assertEqual(cached.variables, parsed.variables)
+        self.assertEqual(cached.states, parsed.states)
+        for v in parsed.variables:
+            numpy.testing.assert_array_equal(cached.tables[v], parsed.tables[v])
+            self.assertEqual(cached.to_model().get_cpds(v), carnet.car_model.get_cpds(v))
+
+        bn_model.write_network(cached, path)
+        self.assertIsNone(bn_model.read_cache(path))
+        self.assertEqual(bn_model.parse_network(path).states, parsed.states)
+
+    def test_validation(self):
+        header = "variable A yes no\nvariable B \"on it\" off\nparents B A\nprob A 0.5 0.5\n"
+        network = bn_model.parse_network(self.write(header + "prob B yes 1 0\nprob B no 0.25 0.75\n"))
+        self.assertEqual(network.states["B"], ["on it", "off"])
+        for body, message in [("prob B yes 1 0\n", "no prob row for B given A=no"),
+                              ("prob B yes 1 0\nprob B no 0.5 0.6\n", "not a distribution"),
+                              ("prob B yes 1 0\nprob B yes 1 0\nprob B no 1 0\n", "repeated row"),
+                              ("prob B maybe 1 0\nprob B no 1 0\n", "no state 'maybe'"),
+                              ("prob B yes 1 0\nprob B no 1 0\nparents A B\n", "cycle"),
+                              ("prob B yes 1 0\nprob B no 1 0\nprob C 1\n", "undeclared variable C")]:
+            with self.assertRaisesRegex(ValueError, message):
+                bn_model.parse_network(self.write(header + body))
+
+
+if __name__ == '__main__':
+    unittest.main()
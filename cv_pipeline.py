@@ -0,0 +1,278 @@
+from bisect import bisect_left
+import json
+import math
+import os
+import time
+import joblib
+import numpy
+import pandas as pd
+from scipy.stats import rankdata
+from sklearn.base import clone, is_classifier
+from sklearn.metrics import check_scoring
+from sklearn.model_selection import ParameterGrid, check_cv
+from sklearn.utils import _safe_indexing
+
+# Cross-validation for the experiments in sklearn_decisiontrees.py.
+# Every (grid point, fold) pair is one task, and all tasks share a single
+# joblib pool, so folds and grid points run in parallel together. The
+# cores are split between the pool and the estimators' own threads
+# (n_jobs and OpenMP/BLAS), so the two levels never oversubscribe.
+# With a cache directory, each task's scores and fitted model are kept on
+# disk under a hash of everything that decides them (estimator class and
+# parameters, data, fold indices, scoring). Extending a grid then only
+# fits the new points.
+# CrossValidator.halving is the adaptive alternative: successive halving
+# over a resource such as n_estimators or max_iter, where the surviving
+# candidates' fold models are warm-started rather than refitted.
+
+# estimator parameters that change how fast a fit runs but not its result
+# (a warm-started forest or booster ends up as if fitted from scratch)
+EXECUTION_PARAMS = ("n_jobs", "verbose", "warm_start")
+
+
+def _fit_and_score(model, X, y, train, test, scorer, return_train_score, inner_jobs,
+                   cache_dir, key, keep_model, return_model=False, previous_fit_time=0.0):
+    """fits model (a fresh clone, or a fitted one to warm-start) on one
+    fold and scores it. fit_time includes previous_fit_time, the time
+    spent on the earlier fits a warm start builds on."""
+    if "n_jobs" in model.get_params():
+        model.set_params(n_jobs=inner_jobs)
+    X_train, y_train = _safe_indexing(X, train), _safe_indexing(y, train)
+    X_test, y_test = _safe_indexing(X, test), _safe_indexing(y, test)
+    begin = time.perf_counter()
+    model.fit(X_train, y_train)
+    fit_time = time.perf_counter() - begin + previous_fit_time
+    begin = time.perf_counter()
+    test_score = float(scorer(model, X_test, y_test))
+    score_time = time.perf_counter() - begin
+    result = {"fit_time": fit_time, "score_time": score_time, "test_score": test_score}
+    if return_train_score:
+        result["train_score"] = float(scorer(model, X_train, y_train))
+    if cache_dir is not None:
+        path = os.path.join(cache_dir, key)
+        if keep_model:
+            temp = f"{path}.joblib.{os.getpid()}.tmp"
+            joblib.dump(model, temp)
+            os.replace(temp, path + ".joblib")
+        # the scores go last, so a cached result always has its model
+        temp = f"{path}.json.{os.getpid()}.tmp"
+        with open(temp, 'w') as f:
+            json.dump(result, f)
+        os.replace(temp, path + ".json")
+    return (result, model) if return_model else result
+
+
+# CrossValidator - evaluates parameter grids by cross-validation, like
+# GridSearchCV without the refit, and returns GridSearchCV's cv_results_
+# table as a DataFrame.
+
+class CrossValidator:
+    def __init__(self, cv=5, scoring=None, cache_dir=None, n_jobs=-1, return_train_score=True,
+                 keep_models=True):
+        """cv and scoring are as for GridSearchCV. n_jobs is the total
+        number of cores to use; as in joblib, a negative value leaves
+        -n_jobs - 1 physical cores unused (-1: all of them). keep_models
+        also stores every fitted fold model in cache_dir. Cached results are
+        only reused for identical inputs, so estimators should fix their
+        random_state."""
+        self.cv = cv
+        self.scoring = scoring
+        self.cache_dir = cache_dir
+        self.n_jobs = n_jobs
+        self.return_train_score = return_train_score
+        self.keep_models = keep_models
+        self.fitted = 0   # tasks fitted by the last search
+        self.reused = 0   # tasks read from the cache by the last search
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _folds(self, estimator, X, y):
+        cv = check_cv(self.cv, y, classifier=is_classifier(estimator))
+        return list(cv.split(X, y))
+
+    def _keys(self, estimator, points, X, y, folds):
+        """one cache key per (point, fold), in that order."""
+        data = joblib.hash((X, y))
+        fold_hashes = [joblib.hash((train, test)) for train, test in folds]
+        keys = []
+        for params in points:
+            model = clone(estimator).set_params(**params)
+            settings = {name: value for name, value in model.get_params(deep=True).items()
+                        if name.split("__")[-1] not in EXECUTION_PARAMS}
+            identity = joblib.hash((type(model).__module__, type(model).__name__, repr(sorted(settings.items())),
+                                    data, repr(self.scoring)))
+            keys.extend(joblib.hash((identity, fold)) for fold in fold_hashes)
+        return keys
+
+    def _cached(self, key):
+        if self.cache_dir is None:
+            return None
+        try:
+            with open(os.path.join(self.cache_dir, key + ".json")) as f:
+                result = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if self.return_train_score and "train_score" not in result:
+            return None
+        if self.keep_models and not os.path.exists(os.path.join(self.cache_dir, key + ".joblib")):
+            return None
+        return result
+
+    def evaluate(self, estimator, param_grid, X, y):
+        """cross-validates estimator at every point of param_grid (a dict
+        or list of dicts, as for GridSearchCV) and returns the cv_results
+        DataFrame. Only the (point, fold) pairs not found in the cache are
+        fitted."""
+        points = list(ParameterGrid(param_grid))
+        folds = self._folds(estimator, X, y)
+        keys = self._keys(estimator, points, X, y, folds)
+        scorer = check_scoring(estimator, scoring=self.scoring)
+        results = [self._cached(key) for key in keys]
+        pending = [i for i, result in enumerate(results) if result is None]
+        self.reused = len(results) - len(pending)
+        self.fitted = len(pending)
+
+        def task(i, inner):
+            point, fold = divmod(i, len(folds))
+            train, test = folds[fold]
+            model = clone(estimator).set_params(**points[point])
+            return joblib.delayed(_fit_and_score)(
+                model, X, y, train, test, scorer, self.return_train_score, inner,
+                self.cache_dir, keys[i], self.keep_models)
+
+        for i, result in zip(pending, self._parallel(task, pending)):
+            results[i] = result
+        return self._table(points, results, len(folds))
+
+    def cores(self):
+        """the number of cores n_jobs stands for."""
+        n_jobs = -1 if self.n_jobs is None else self.n_jobs
+        if n_jobs < 0:
+            return max(1, joblib.cpu_count(only_physical_cores=True) + 1 + n_jobs)
+        return n_jobs
+
+    def _parallel(self, task, pending):
+        """runs task(i, inner) for each i in pending on one joblib pool and
+        returns the results in order. The pool is sized so that its
+        processes times inner, the threads each estimator gets, fits in
+        n_jobs cores."""
+        if not pending:
+            return []
+        cores = self.cores()
+        outer = max(1, min(cores, len(pending)))
+        inner = max(1, cores // outer)
+        tasks = [task(i, inner) for i in pending]
+        # inner_max_num_threads caps OpenMP/BLAS threads in each worker
+        with joblib.parallel_config(backend="loky", inner_max_num_threads=inner):
+            return joblib.Parallel(n_jobs=outer)(tasks)
+
+    def halving(self, estimator, param_grid, X, y, resource, max_resource, min_resource=None, factor=3):
+        """successive halving: every point of param_grid is cross-validated
+        with resource (an estimator parameter such as n_estimators or
+        max_iter) set to min_resource. The best 1/factor of them continue
+        with factor times the resource, until max_resource is reached. Fold
+        models are warm-started from the previous rung, so a survivor only
+        pays for the added trees or iterations. Without min_resource, the
+        rungs count down from max_resource by factor, as many as it takes
+        to get down to about one candidate.
+        Returns a cv_results DataFrame with one row per (candidate, rung),
+        like HalvingGridSearchCV, with the rung in "iter", the resource in
+        "n_resources" and param_<resource>. Candidates that reached the
+        last rung rank first."""
+        points = list(ParameterGrid(param_grid))
+        if min_resource is None:
+            rungs = 1 + math.ceil(math.log(max(len(points), 1)) / math.log(factor))
+            schedule = [max(1, max_resource // factor ** i) for i in reversed(range(rungs))]
+        else:
+            schedule = [min_resource]
+            while schedule[-1] < max_resource:
+                schedule.append(min(schedule[-1] * factor, max_resource))
+        schedule = sorted(set(schedule))
+        folds = self._folds(estimator, X, y)
+        scorer = check_scoring(estimator, scoring=self.scoring)
+        self.fitted = self.reused = 0
+
+        candidates = list(range(len(points)))
+        models = {}   # (candidate, fold) -> model fitted at the previous rung
+        fit_times = {}
+        rows, results, rungs_seen = [], [], []
+        for rung, amount in enumerate(schedule):
+            rung_points = [dict(points[c], **{resource: amount}) for c in candidates]
+            keys = self._keys(estimator, rung_points, X, y, folds)
+            rung_results = [self._cached(key) for key in keys]
+            pending = [i for i, result in enumerate(rung_results) if result is None]
+            self.reused += len(rung_results) - len(pending)
+            self.fitted += len(pending)
+
+            def task(i, inner):
+                c, fold = candidates[i // len(folds)], i % len(folds)
+                train, test = folds[fold]
+                # a fold whose scores came from the cache has no model to
+                # warm-start, and is fitted from scratch
+                model = models.get((c, fold))
+                if model is None:
+                    model = clone(estimator).set_params(**points[c])
+                if "warm_start" in model.get_params():
+                    model.set_params(warm_start=True)
+                model.set_params(**{resource: amount})
+                return joblib.delayed(_fit_and_score)(
+                    model, X, y, train, test, scorer, self.return_train_score, inner,
+                    self.cache_dir, keys[i], self.keep_models, True, fit_times.get((c, fold), 0.0))
+
+            for i, (result, model) in zip(pending, self._parallel(task, pending)):
+                rung_results[i] = result
+                models[candidates[i // len(folds)], i % len(folds)] = model
+            for i, result in enumerate(rung_results):
+                fit_times[candidates[i // len(folds)], i % len(folds)] = result["fit_time"]
+            rows.extend(rung_points)
+            results.extend(rung_results)
+            rungs_seen.extend([(rung, amount)] * len(candidates))
+            if rung == len(schedule) - 1:
+                break
+            means = [numpy.mean([r["test_score"] for r in rung_results[j * len(folds):(j + 1) * len(folds)]])
+                     for j in range(len(candidates))]
+            keep = max(1, math.ceil(len(candidates) / factor))
+            order = sorted(range(len(candidates)), key=lambda j: -means[j])[:keep]
+            candidates = [candidates[j] for j in sorted(order)]
+            models = {key: model for key, model in models.items() if key[0] in candidates}
+
+        table = self._table(rows, results, len(folds))
+        table.insert(0, "iter", [r for r, _ in rungs_seen])
+        table.insert(1, "n_resources", [a for _, a in rungs_seen])
+        keys = list(zip(-table["iter"], -table["mean_test_score"]))
+        ordered = sorted(keys)
+        table["rank_test_score"] = numpy.array([bisect_left(ordered, key) + 1 for key in keys], dtype=numpy.int32)
+        return table
+
+    def fold_models(self, estimator, params, X, y):
+        """returns the fitted fold models cached for estimator with params
+        on X, y (None for folds that were not kept)."""
+        folds = self._folds(estimator, X, y)
+        models = []
+        for key in self._keys(estimator, [params], X, y, folds):
+            path = os.path.join(self.cache_dir, key + ".joblib") if self.cache_dir else None
+            models.append(joblib.load(path) if path and os.path.exists(path) else None)
+        return models
+
+    def _table(self, points, results, n_folds):
+        def matrix(name):
+            return numpy.array([result[name] for result in results]).reshape(len(points), n_folds)
+
+        table = {}
+        for name in ("fit_time", "score_time"):
+            values = matrix(name)
+            table[f"mean_{name}"] = values.mean(axis=1)
+            table[f"std_{name}"] = values.std(axis=1)
+        for name in sorted({name for params in points for name in params}):
+            table[f"param_{name}"] = pd.array([params.get(name) for params in points], dtype=object)
+        table["params"] = points
+        sets = ("test", "train") if self.return_train_score else ("test",)
+        for kind in sets:
+            scores = matrix(f"{kind}_score")
+            for fold in range(n_folds):
+                table[f"split{fold}_{kind}_score"] = scores[:, fold]
+            table[f"mean_{kind}_score"] = scores.mean(axis=1)
+            table[f"std_{kind}_score"] = scores.std(axis=1)
+            if kind == "test":
+                table["rank_test_score"] = rankdata(-scores.mean(axis=1), method="min").astype(numpy.int32)
+        return pd.DataFrame(table)
@@ -0,0 +1,96 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import numpy
+import pandas as pd
+from sklearn.datasets import load_breast_cancer
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.model_selection import GridSearchCV, KFold
+from sklearn.tree import DecisionTreeClassifier
+import cv_pipeline
+import tree_bench
+
+
+class TestCrossValidator(unittest.TestCase):
+    def setUp(self):
+        self.X, self.y = load_breast_cancer(return_X_y=True, as_frame=True)
+        self.cv = KFold(n_splits=3, shuffle=True, random_state=0)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_matches_grid_search(self):
+        model = DecisionTreeClassifier(random_state=0)
+        grid = {"max_depth": [2, 4], "criterion": ["gini", "entropy"]}
+        results = cv_pipeline.CrossValidator(self.cv, n_jobs=2).evaluate(model, grid, self.X, self.y)
+        expected = pd.DataFrame(GridSearchCV(model, grid, cv=self.cv, return_train_score=True)
+                                .fit(self.X, self.y).cv_results_)
+        self.assertEqual(list(results.columns), list(expected.columns))
+        self.assertEqual(list(results["params"]), list(expected["params"]))
+        for column in ("mean_test_score", "split2_train_score", "rank_test_score"):
+            numpy.testing.assert_allclose(results[column], expected[column])
+
+    def test_negative_n_jobs_count_back_from_all_cores(self):
+        with mock.patch.object(cv_pipeline.joblib, "cpu_count", return_value=8):
+            self.assertEqual([cv_pipeline.CrossValidator(n_jobs=n).cores() for n in (-1, -2, -20, None, 3)],
+                             [8, 7, 1, 8, 3])
+
+    def test_extending_the_grid_reuses_the_cache(self):
+        validator = cv_pipeline.CrossValidator(self.cv, cache_dir=self.directory)
+        model = RandomForestClassifier(random_state=0, n_jobs=4)
+        first = validator.evaluate(model, {"n_estimators": [3, 6]}, self.X, self.y)
+        self.assertEqual((validator.fitted, validator.reused), (6, 0))
+        extended = validator.evaluate(model.set_params(n_jobs=1), {"n_estimators": [3, 6, 9]}, self.X, self.y)
+        self.assertEqual((validator.fitted, validator.reused), (3, 6))
+        numpy.testing.assert_allclose(extended["mean_test_score"][:2], first["mean_test_score"])
+        models = validator.fold_models(model, {"n_estimators": 6}, self.X, self.y)
+        self.assertEqual([m.n_estimators for m in models], [6, 6, 6])
+        validator.evaluate(model, {"n_estimators": [3]}, self.X[:300], self.y[:300])
+        self.assertEqual(validator.fitted, 3)
+
+    def test_halving_warm_starts_and_matches_full_fits(self):
+        validator = cv_pipeline.CrossValidator(self.cv, cache_dir=self.directory, n_jobs=1)
+        model = RandomForestClassifier(random_state=0)
+        grid = {"max_depth": [1, 2, 4, None], "max_features": ["sqrt", 0.5]}
+        results = validator.halving(model, grid, self.X, self.y, "n_estimators", 18, factor=3)
+        self.assertEqual(list(results["iter"]), [0] * 8 + [1] * 3 + [2])
+        self.assertEqual(list(results["n_resources"]), [2] * 8 + [6] * 3 + [18])
+        self.assertEqual(list(results["param_n_estimators"]), list(results["n_resources"]))
+        self.assertEqual(results["rank_test_score"].iloc[-1], 1)
+        self.assertEqual(validator.fitted, 36)
+        # warm-started forests are the forests a full fit would give, so
+        # they share cache entries with evaluate
+        best = results["params"].iloc[-1]
+        full = validator.evaluate(model, {k: [v] for k, v in best.items()}, self.X, self.y)
+        self.assertEqual((validator.fitted, validator.reused), (0, 3))
+        numpy.testing.assert_allclose(full["mean_test_score"], results["mean_test_score"].iloc[-1:])
+        cold = cv_pipeline.CrossValidator(self.cv).evaluate(model, {k: [v] for k, v in best.items()},
+                                                             self.X, self.y)
+        numpy.testing.assert_allclose(cold["mean_test_score"], full["mean_test_score"])
+
+
+class TestTreeBench(unittest.TestCase):
+    def test_report(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        X_train, y_train, X_test, y_test = tree_bench.scaled_breast_cancer(700, 100)
+        self.assertEqual((X_train.shape, X_test.shape), ((700, 30), (100, 30)))
+        results = [tree_bench.bench_model(name, make_model, n_rows, repeat=1, single_calls=5,
+                                          batch_size=50, batch_calls=3)
+                   for name, make_model in tree_bench.MODELS.items() for n_rows in (200, 400)]
+        for result in results:
+            self.assertLessEqual(result["single_latency"]["p50"], result["single_latency"]["p99"])
+            self.assertGreater(result["model_bytes"], 0)
+            self.assertGreater(result["accuracy"], 0.8)
+        basename = os.path.join(directory, "report")
+        written = tree_bench.write_report({"environment": tree_bench.environment(), "results": results},
+                                          basename)
+        self.assertIn(basename + ".html", written)
+        with open(basename + ".json") as f:
+            self.assertEqual(json.load(f)["results"], results)
+
+
+if __name__ == '__main__':
+    unittest.main()
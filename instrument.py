@@ -0,0 +1,179 @@
+import atexit
+import collections
+import contextlib
+import cProfile
+import functools
+import json
+import math
+import os
+import threading
+import time
+
+# Opt-in instrumentation for the HMM and belief-network code. The hooks
+# in HMM.py, bn_inference.py and bn_model.py record
+#   phases   - wall time per named phase (count, total, max and a
+#              histogram in power-of-two microsecond buckets), e.g.
+#              hmm.load.parse_emit, hmm.viterbi.trellis, bn.query.engine
+#   counters - event and work counts, e.g. hmm.load.cache_hit,
+#              hmm.viterbi.cells (trellis cells filled), bn.query.cache_miss
+# It is off unless switched on, and then every hook is one check of the
+# module-level enabled flag. Switch it on with
+#   INSTRUMENT_STATS=stats.json      aggregates written there at exit
+#   INSTRUMENT_PROFILE=run.prof      cProfile of the run written there at
+#                                    exit (view with python -m pstats, or
+#                                    turn into a flamegraph with snakeviz
+#                                    or flameprof)
+# in the environment, the --instrument / --profile flags of HMM.py,
+# HMM_server.py, alarm.py and carnet.py, or enable().
+
+STATS_VARIABLE = "INSTRUMENT_STATS"
+PROFILE_VARIABLE = "INSTRUMENT_PROFILE"
+
+enabled = False
+
+_lock = threading.Lock()
+_counters = collections.Counter()
+_phases = {}   # name -> [count, total seconds, max seconds, Counter of buckets]
+_stats_path = None
+_profile_path = None
+_profiler = None
+_registered = False
+
+
+def enable(stats_path=None, profile_path=None):
+    """starts recording. With stats_path the aggregates are written there
+    at exit; with profile_path a cProfile of everything from now on is
+    written there at exit."""
+    global enabled, _stats_path, _profile_path, _profiler, _registered
+    enabled = True
+    _stats_path = stats_path or _stats_path
+    if profile_path and _profiler is None:
+        _profile_path = profile_path
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+    if not _registered:
+        atexit.register(dump)
+        _registered = True
+
+
+def disable():
+    """stops recording (and profiling); what was recorded is kept."""
+    global enabled
+    enabled = False
+    if _profiler is not None:
+        _profiler.disable()
+
+
+def reset():
+    """forgets everything recorded so far."""
+    with _lock:
+        _counters.clear()
+        _phases.clear()
+
+
+def count(name, n=1):
+    if enabled:
+        with _lock:
+            _counters[name] += n
+
+
+def record(name, seconds):
+    """adds one timing of phase name."""
+    bucket = 1 << max(0, math.ceil(math.log2(max(seconds * 1e6, 1))))
+    with _lock:
+        entry = _phases.get(name)
+        if entry is None:
+            entry = _phases[name] = [0, 0.0, 0.0, collections.Counter()]
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2] = max(entry[2], seconds)
+        entry[3][bucket] += 1
+
+
+class _Phase:
+    __slots__ = ("name", "begin")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.begin = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, time.perf_counter() - self.begin)
+        return False
+
+
+_OFF = contextlib.nullcontext()
+
+
+def phase(name):
+    """a context manager timing its block as phase name (a shared no-op
+    while recording is off)."""
+    return _Phase(name) if enabled else _OFF
+
+
+def timed(name):
+    """decorator timing every call of a function as phase name."""
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            begin = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - begin)
+        return wrapper
+    return decorate
+
+
+def snapshot():
+    """the aggregates so far: {"counters": {name: n}, "phases": {name:
+    {count, total_s, mean_s, max_s, histogram_us}}}, where histogram_us
+    maps each bucket's upper bound in microseconds to its count."""
+    with _lock:
+        phases = {name: {"count": n, "total_s": total, "mean_s": total / n, "max_s": longest,
+                         "histogram_us": {str(bound): buckets[bound] for bound in sorted(buckets)}}
+                  for name, (n, total, longest, buckets) in sorted(_phases.items())}
+        return {"counters": dict(sorted(_counters.items())), "phases": phases}
+
+
+def dump(stats_path=None, profile_path=None):
+    """writes the snapshot as JSON to stats_path and the profile to
+    profile_path (by default, the paths given to enable). Returns the
+    files written."""
+    written = []
+    stats_path = stats_path or _stats_path
+    if stats_path:
+        temp = f"{stats_path}.{os.getpid()}.tmp"
+        with open(temp, 'w') as f:
+            json.dump(dict(snapshot(), pid=os.getpid(), written=time.time()), f, indent=1)
+        os.replace(temp, stats_path)
+        written.append(stats_path)
+    profile_path = profile_path or _profile_path
+    if profile_path and _profiler is not None:
+        _profiler.create_stats()
+        _profiler.dump_stats(profile_path)
+        written.append(profile_path)
+    return written
+
+
+def add_arguments(parser):
+    """adds --instrument and --profile to an argparse parser."""
+    parser.add_argument("--instrument", type=str, default=None, metavar="PATH",
+                        help="record phase timings and counters, and write them to this JSON file at exit")
+    parser.add_argument("--profile", type=str, default=None, metavar="PATH",
+                        help="profile the run with cProfile and write the stats to this file at exit")
+
+
+def from_arguments(args):
+    """switches recording on if the parsed arguments ask for it."""
+    if args.instrument or args.profile:
+        enable(args.instrument, args.profile)
+
+
+if os.environ.get(STATS_VARIABLE) or os.environ.get(PROFILE_VARIABLE):
+    enable(os.environ.get(STATS_VARIABLE) or None, os.environ.get(PROFILE_VARIABLE) or None)
@@ -3,42 +3,49 @@ from sklearn.datasets import load_breast_cancer
 from sklearn import tree
 from sklearn.model_selection import KFold
 from sklearn.ensemble import RandomForestClassifier, HistGradientBoostingClassifier
-import pandas as pd
-from sklearn.model_selection import GridSearchCV, KFold
+import os
+import sys
 import joblib
+from cv_pipeline import CrossValidator
+import tree_bench
+
+# fitted fold models and scores are kept here; rerunning the script (or
+# adding grid points) only fits what has not been evaluated yet
+CACHE_DIR = ".cv_cache"
+
+# "grid" cross-validates every point of param_grids. "halving" searches
+# the wider halving_grids by successive halving over the number of trees
+# or boosting iterations, so most candidates only ever get a few.
+SEARCH = "grid"
+
+X, y = load_breast_cancer(return_X_y=True, as_frame=True)
 
 
 ### This code shows how to use KFold to do cross_validation.
 ### This is just one of many ways to manage training and test sets in sklearn.
+### CrossValidator fits the folds in parallel.
 
-breast_cancer = load_breast_cancer()
-X, y = breast_cancer.data, breast_cancer.target
-scores = []
 kf = KFold(n_splits=5)
-for train_index, test_index in kf.split(X) :
-    X_train, X_test, y_train, y_test = \
-        (X[train_index], X[test_index], y[train_index], y[test_index])
-    # clf = tree.DecisionTreeClassifier()
-    clf = RandomForestClassifier(n_estimators=50, criterion="gini")
-    clf.fit(X_train, y_train)
-    scores.append(clf.score(X_test, y_test))
+# clf = tree.DecisionTreeClassifier()
+clf = RandomForestClassifier(n_estimators=50, criterion="gini", random_state=0)
+fold_results = CrossValidator(cv=kf, cache_dir=CACHE_DIR).evaluate(clf, {}, X, y)
+scores = [float(fold_results[f"split{i}_test_score"][0]) for i in range(kf.get_n_splits())]
 
 print(scores)
 print("----------------------------------------------------")
 print(f'mean score: {sum(scores)/len(scores)}')
 
 ## Part 2. This code (from https://scikit-learn.org/1.5/auto_examples/ensemble/plot_forest_hist_grad_boosting_comparison.html)
-## shows how to use GridSearchCV to do a hyperparameter search to compare two techniques.
-from sklearn.datasets import load_breast_cancer
-
-X,y = load_breast_cancer(return_X_y=True, as_frame=True)
+## shows how to use a grid search to do a hyperparameter search to compare two techniques.
+## CrossValidator.evaluate returns the same table as GridSearchCV's cv_results_,
+## running grid points and folds together on all cores.
 
 N_CORES = joblib.cpu_count(only_physical_cores=True)
 print(f"Number of physical cores: {N_CORES}")
 
 models = {
     "Random Forest": RandomForestClassifier(
-        min_samples_leaf=5, random_state=0, n_jobs=N_CORES
+        min_samples_leaf=5, random_state=0
     ),
     "Hist Gradient Boosting": HistGradientBoostingClassifier(
         max_leaf_nodes=15, random_state=0, early_stopping=False
@@ -48,22 +55,34 @@ param_grids = {
     "Random Forest": {"n_estimators": [5, 10, 15, 20]},
     "Hist Gradient Boosting": {"max_iter": [25, 50, 75, 100]},
 }
+# the parameter each search grows, and its largest value
+resources = {
+    "Random Forest": ("n_estimators", 20),
+    "Hist Gradient Boosting": ("max_iter", 100),
+}
+halving_grids = {
+    "Random Forest": {"min_samples_leaf": [1, 2, 5, 10], "max_features": ["sqrt", "log2", 0.5]},
+    "Hist Gradient Boosting": {"max_leaf_nodes": [7, 15, 31], "learning_rate": [0.05, 0.1, 0.3]},
+}
 cv = KFold(n_splits=5, shuffle=True, random_state=0)
+validator = CrossValidator(cv=cv, cache_dir=CACHE_DIR, n_jobs=N_CORES)
 
 results = []
 for name, model in models.items():
-    grid_search = GridSearchCV(
-        estimator=model,
-        param_grid=param_grids[name],
-        return_train_score=True,
-        cv=cv,
-    ).fit(X, y)
-    result = {"model": name, "cv_results": pd.DataFrame(grid_search.cv_results_)}
+    if SEARCH == "halving":
+        resource, max_resource = resources[name]
+        cv_results = validator.halving(model, halving_grids[name], X, y, resource, max_resource)
+    else:
+        cv_results = validator.evaluate(model, param_grids[name], X, y)
+    result = {"model": name, "cv_results": cv_results}
     results.append(result)
 
 print(results)
 
 #### Part 3: This shows how to generate a scatter plot of your results
+#### Without a display the plot is written to speed_score.html (and .png
+#### with kaleido) instead. For latency percentiles, model sizes and
+#### larger datasets, run tree_bench.py.
 
 import plotly.colors as colors
 import plotly.express as px
@@ -83,7 +102,7 @@ colors_list = colors.qualitative.Plotly * (
 for idx, result in enumerate(results):
     cv_results = result["cv_results"].round(3)
     model_name = result["model"]
-    param_name = list(param_grids[model_name].keys())[0]
+    param_name = resources[model_name][0]
     cv_results[param_name] = cv_results["param_" + param_name]
     cv_results["model"] = model_name
 
@@ -137,4 +156,8 @@ fig.update_layout(
     legend=dict(x=0.72, y=0.05, traceorder="normal", borderwidth=1),
     title=dict(x=0.5, text="Speed-score trade-off of tree-based ensembles"),
 )
-fig.show()
\ No newline at end of file
+if os.environ.get("DISPLAY") or sys.platform in ("darwin", "win32"):
+    fig.show()
+else:
+    for path in tree_bench.write_figure(fig, "speed_score"):
+        print("wrote", path)
\ No newline at end of file
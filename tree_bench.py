@@ -0,0 +1,270 @@
+import argparse
+import html
+import json
+import os
+import pickle
+import platform
+import sys
+import time
+import numpy
+import sklearn
+from sklearn.datasets import load_breast_cancer
+from sklearn.ensemble import RandomForestClassifier, HistGradientBoostingClassifier
+
+# Speed/accuracy benchmark for the two ensembles compared in
+# sklearn_decisiontrees.py, run without any display. For each dataset
+# size it measures training throughput, prediction latency percentiles
+# for single rows and for batches, the pickled size of the fitted model
+# and its held-out accuracy. The data is load_breast_cancer resampled
+# with noise up to the requested number of rows.
+#   python tree_bench.py --rows 1000 10000 100000 --out tree_bench
+# writes tree_bench.json and tree_bench.html, and tree_bench.png when
+# plotly and kaleido are installed. Without plotly the HTML report draws
+# its charts as inline SVG.
+
+MODELS = {
+    "Random Forest": lambda: RandomForestClassifier(n_estimators=20, min_samples_leaf=5, random_state=0),
+    "Hist Gradient Boosting": lambda: HistGradientBoostingClassifier(
+        max_iter=100, max_leaf_nodes=15, random_state=0, early_stopping=False),
+}
+ROWS = (1000, 10000, 100000)
+PERCENTILES = (50, 95, 99)
+
+
+def scaled_breast_cancer(n_train, n_test, noise=0.1, seed=0):
+    """returns (X_train, y_train, X_test, y_test) with rows drawn with
+    replacement from load_breast_cancer, each feature jittered by noise
+    times its standard deviation, so larger sets are not just copies. The
+    test rows come from a quarter of the original rows that the training
+    rows never do, so accuracy is not inflated by near-duplicates."""
+    X, y = load_breast_cancer(return_X_y=True)
+    rng = numpy.random.default_rng(seed)
+    order = rng.permutation(len(X))
+    held_out = len(X) // 4
+    scale = X.std(axis=0) * noise
+
+    def draw(source, n):
+        rows = rng.choice(source, size=n)
+        return X[rows] + rng.normal(size=(n, X.shape[1])) * scale, y[rows]
+
+    return draw(order[held_out:], n_train) + draw(order[:held_out], n_test)
+
+
+def latencies(fn, calls):
+    """seconds taken by each of calls calls of fn, after one warm-up call."""
+    fn()
+    times = numpy.empty(calls)
+    for i in range(calls):
+        begin = time.perf_counter()
+        fn()
+        times[i] = time.perf_counter() - begin
+    return times
+
+
+def _percentiles(times):
+    return {f"p{q}": float(numpy.percentile(times, q)) for q in PERCENTILES}
+
+
+def bench_model(name, make_model, n_rows, repeat=3, single_calls=200, batch_size=1000, batch_calls=20,
+                test_fraction=0.25):
+    """fits a fresh make_model() on n_rows scaled rows repeat times and
+    returns a result dict for the best fit: train rows/s, single-row and
+    batch predict latency percentiles (seconds), batch predict rows/s,
+    pickled model bytes and test accuracy."""
+    X_train, y_train, X_test, y_test = scaled_breast_cancer(
+        n_rows, max(int(n_rows * test_fraction), batch_size), seed=n_rows)
+    fit_seconds = numpy.inf
+    for _ in range(repeat):
+        model = make_model()
+        begin = time.perf_counter()
+        model.fit(X_train, y_train)
+        fit_seconds = min(fit_seconds, time.perf_counter() - begin)
+    row = X_test[:1]
+    batch = X_test[:batch_size]
+    single = latencies(lambda: model.predict(row), single_calls)
+    batched = latencies(lambda: model.predict(batch), batch_calls)
+    return {
+        "model": name,
+        "rows": n_rows,
+        "fit_seconds": fit_seconds,
+        "train_rows_per_s": n_rows / fit_seconds,
+        "single_latency": _percentiles(single),
+        "batch_size": len(batch),
+        "batch_latency": _percentiles(batched),
+        "batch_rows_per_s": len(batch) / float(numpy.median(batched)),
+        "model_bytes": len(pickle.dumps(model)),
+        "accuracy": float((model.predict(X_test) == y_test).mean()),
+    }
+
+
+def environment():
+    return {"python": platform.python_version(), "numpy": numpy.__version__, "sklearn": sklearn.__version__,
+            "machine": platform.machine(), "processor": platform.processor(), "cpus": os.cpu_count()}
+
+
+def write_table(results, out=sys.stdout):
+    out.write(f"{'model':<24} {'rows':>7} {'train rows/s':>13} {'1-row p50 ms':>13} {'1-row p99 ms':>13} "
+              f"{'batch rows/s':>13} {'model KiB':>10} {'accuracy':>9}\n")
+    for r in results:
+        out.write(f"{r['model']:<24} {r['rows']:>7} {r['train_rows_per_s']:>13.0f} "
+                  f"{r['single_latency']['p50'] * 1e3:>13.3f} {r['single_latency']['p99'] * 1e3:>13.3f} "
+                  f"{r['batch_rows_per_s']:>13.0f} {r['model_bytes'] / 1024:>10.1f} {r['accuracy']:>9.3f}\n")
+
+
+# the charts in the report: (title, x label, y label, value of a result)
+# plotted against the number of training rows, one line per model
+CHARTS = [
+    ("Training throughput", "training rows", "rows/s", lambda r: r["train_rows_per_s"]),
+    ("Single-row latency (p99)", "training rows", "seconds", lambda r: r["single_latency"]["p99"]),
+    ("Batch throughput", "training rows", "rows/s", lambda r: r["batch_rows_per_s"]),
+    ("Model size", "training rows", "bytes", lambda r: r["model_bytes"]),
+    ("Accuracy", "training rows", "accuracy", lambda r: r["accuracy"]),
+]
+COLORS = ("#636efa", "#ef553b", "#00cc96", "#ab63fa")
+
+
+def _series(results):
+    """{model: results sorted by rows}"""
+    series = {}
+    for r in sorted(results, key=lambda r: r["rows"]):
+        series.setdefault(r["model"], []).append(r)
+    return series
+
+
+def _svg_chart(results, title, xlabel, ylabel, value, width=420, height=280):
+    """a log-log line chart (linear y for values within [0, 1]) as SVG."""
+    series = _series(results)
+    xs = [r["rows"] for r in results]
+    ys = [value(r) for r in results]
+    log_y = min(ys) > 0 and max(ys) > 1
+    ty = numpy.log10 if log_y else (lambda v: v)
+    x0, x1 = numpy.log10(min(xs)), numpy.log10(max(xs))
+    y0, y1 = ty(min(ys)), ty(max(ys))
+    if x1 == x0:
+        x0, x1 = x0 - 0.5, x1 + 0.5
+    if y1 == y0:
+        y0, y1 = y0 - 0.5, y1 + 0.5
+    left, right, top, bottom = 60, 10, 30, 40
+
+    def point(r):
+        x = left + (numpy.log10(r["rows"]) - x0) / (x1 - x0) * (width - left - right)
+        y = height - bottom - (ty(value(r)) - y0) / (y1 - y0) * (height - top - bottom)
+        return f"{x:.1f},{y:.1f}"
+
+    parts = [f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" font-size="11">',
+             f'<text x="{width / 2}" y="16" text-anchor="middle" font-size="13">{html.escape(title)}</text>',
+             f'<rect x="{left}" y="{top}" width="{width - left - right}" height="{height - top - bottom}" '
+             f'fill="none" stroke="#ccc"/>',
+             f'<text x="{width / 2}" y="{height - 6}" text-anchor="middle">{html.escape(xlabel)} (log)</text>',
+             f'<text x="12" y="{height / 2}" text-anchor="middle" transform="rotate(-90 12 {height / 2})">'
+             f'{html.escape(ylabel)}{" (log)" if log_y else ""}</text>',
+             f'<text x="{left - 4}" y="{top + 10}" text-anchor="end">{max(ys):.3g}</text>',
+             f'<text x="{left - 4}" y="{height - bottom}" text-anchor="end">{min(ys):.3g}</text>',
+             f'<text x="{left}" y="{height - bottom + 14}">{min(xs)}</text>',
+             f'<text x="{width - right}" y="{height - bottom + 14}" text-anchor="end">{max(xs)}</text>']
+    for i, (model, rows) in enumerate(series.items()):
+        color = COLORS[i % len(COLORS)]
+        points = [point(r) for r in rows]
+        parts.append(f'<polyline points="{" ".join(points)}" fill="none" stroke="{color}" stroke-width="2"/>')
+        parts.extend(f'<circle cx="{p.split(",")[0]}" cy="{p.split(",")[1]}" r="3" fill="{color}"/>'
+                     for p in points)
+        parts.append(f'<text x="{left + 8}" y="{top + 14 + 13 * i}" fill="{color}">{html.escape(model)}</text>')
+    parts.append('</svg>')
+    return "\n".join(parts)
+
+
+def plotly_figure(results):
+    """the report charts as one plotly figure, or None without plotly."""
+    try:
+        from plotly.subplots import make_subplots
+        import plotly.graph_objects as go
+    except ImportError:
+        return None
+    fig = make_subplots(rows=1, cols=len(CHARTS), subplot_titles=[title for title, *_ in CHARTS])
+    for i, (model, rows) in enumerate(_series(results).items()):
+        for col, (title, xlabel, ylabel, value) in enumerate(CHARTS, 1):
+            fig.add_trace(go.Scatter(x=[r["rows"] for r in rows], y=[value(r) for r in rows], name=model,
+                                     legendgroup=model, showlegend=col == 1,
+                                     line=dict(color=COLORS[i % len(COLORS)])), row=1, col=col)
+            fig.update_xaxes(type="log", title_text=xlabel, row=1, col=col)
+            fig.update_yaxes(type="log" if ylabel != "accuracy" else "linear", title_text=ylabel, row=1, col=col)
+    fig.update_layout(title=dict(x=0.5, text="Speed/accuracy of tree-based ensembles"),
+                      width=360 * len(CHARTS), height=420)
+    return fig
+
+
+def write_figure(fig, basename):
+    """writes a plotly figure to basename.html, and to basename.png when
+    kaleido is installed. Returns the files written. plotly.js is
+    embedded in the page, so it renders offline and in CI artifacts."""
+    written = [basename + ".html"]
+    fig.write_html(written[0], include_plotlyjs=True)
+    try:
+        fig.write_image(basename + ".png")
+        written.append(basename + ".png")
+    except (ImportError, ValueError, RuntimeError):
+        pass  # no static image export available
+    return written
+
+
+def write_report(report, basename):
+    """writes basename.json and a static basename.html (plus basename.png
+    with plotly and kaleido). Returns the files written."""
+    with open(basename + ".json", 'w') as f:
+        json.dump(report, f, indent=1)
+    results = report["results"]
+    fig = plotly_figure(results)
+    if fig is not None:
+        return [basename + ".json"] + write_figure(fig, basename)
+
+    rows = "\n".join(
+        "<tr>" + "".join(f"<td>{html.escape(str(cell))}</td>" for cell in (
+            r["model"], r["rows"], f"{r['train_rows_per_s']:.0f}",
+            f"{r['single_latency']['p50'] * 1e3:.3f}", f"{r['single_latency']['p95'] * 1e3:.3f}",
+            f"{r['single_latency']['p99'] * 1e3:.3f}", f"{r['batch_latency']['p50'] * 1e3:.2f}",
+            f"{r['batch_rows_per_s']:.0f}", f"{r['model_bytes'] / 1024:.1f}", f"{r['accuracy']:.3f}")) + "</tr>"
+        for r in results)
+    charts = "\n".join(_svg_chart(results, *chart) for chart in CHARTS)
+    environment = html.escape(", ".join(f"{k} {v}" for k, v in report["environment"].items()))
+    with open(basename + ".html", 'w') as f:
+        f.write(f"""<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Tree ensemble benchmark</title>
+<style>body {{ font-family: sans-serif; }} td, th {{ padding: 2px 8px; text-align: right; }}
+td:first-child {{ text-align: left; }} svg {{ margin: 4px; }}</style></head>
+<body><h1>Speed/accuracy of tree-based ensembles</h1>
+<p>{environment}</p>
+<table><tr><th>model</th><th>rows</th><th>train rows/s</th><th>1-row p50 ms</th><th>1-row p95 ms</th>
+<th>1-row p99 ms</th><th>batch p50 ms (batch of {results[0]['batch_size'] if results else 0})</th>
+<th>batch rows/s</th><th>model KiB</th><th>accuracy</th></tr>
+{rows}
+</table>
+<div>
+{charts}
+</div></body></html>
+""")
+    return [basename + ".json", basename + ".html"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark random forests against histogram gradient boosting")
+    parser.add_argument("--models", nargs="*", default=list(MODELS), choices=list(MODELS), help="models to time")
+    parser.add_argument("--rows", nargs="*", type=int, default=list(ROWS), help="training set sizes")
+    parser.add_argument("--repeat", type=int, default=3, help="fits per size; the fastest is kept")
+    parser.add_argument("--single-calls", type=int, default=200, help="single-row predictions timed")
+    parser.add_argument("--batch-size", type=int, default=1000, help="rows per batch prediction")
+    parser.add_argument("--batch-calls", type=int, default=20, help="batch predictions timed")
+    parser.add_argument("--out", type=str, default="tree_bench", help="basename of the report files")
+    args = parser.parse_args()
+
+    results = []
+    for n_rows in args.rows:
+        for name in args.models:
+            results.append(bench_model(name, MODELS[name], n_rows, args.repeat, args.single_calls,
+                                       args.batch_size, args.batch_calls))
+    write_table(results)
+    for path in write_report({"environment": environment(), "results": results}, args.out):
+        print("wrote", path)
+
+
+if __name__ == "__main__":
+    main()
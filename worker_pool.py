@@ -0,0 +1,47 @@
+import contextlib
+import multiprocessing
+
+# Process pools whose workers all hold one large read-only object (an
+# HMM, a belief-network sampler, a training corpus), shared by the
+# parallel decoding in HMM.py, the E-step in HMM_train.py and the
+# samplers in bn_sampling.py. Only each task's own arguments are sent
+# to the workers.
+
+# the object every worker of the open pool holds. Under fork it is
+# inherited from the parent (copy-on-write, never pickled); otherwise it
+# is sent once per worker through the pool initializer.
+_worker_model = None
+
+
+def _init_worker(model):
+    global _worker_model
+    _worker_model = model
+
+
+def _model_task(task):
+    function, args = task
+    return function(_worker_model, *args)
+
+
+@contextlib.contextmanager
+def model_pool(model, workers):
+    """a multiprocessing pool whose workers all hold model. Hand it work
+    with submit(pool, function, *args), which runs function(model, *args)
+    in a worker; only the args travel with each task."""
+    global _worker_model
+    if "fork" in multiprocessing.get_all_start_methods():
+        _worker_model = model
+        pool = multiprocessing.get_context("fork").Pool(workers)
+    else:
+        pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=(model,))
+    try:
+        yield pool
+    finally:
+        pool.terminate()
+        pool.join()
+        _worker_model = None
+
+
+def submit(pool, function, *args):
+    """queues function(model, *args) on a model_pool; returns the AsyncResult."""
+    return pool.apply_async(_model_task, ((function, args),))